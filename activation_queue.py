@@ -0,0 +1,84 @@
+import logging
+import threading
+from datetime import datetime
+
+log = logging.getLogger('mlm.queue')
+
+# ===== ACTIVATION QUEUE =====
+# Activations are stored as events by the request that makes them; workers
+# claim them in sequence order and pay the upline in the background. With
+# workers=0 events are processed inline by the request that submits them.
+
+
+class ActivationQueue:
+    """Background worker pool that pays out stored activation events"""
+
+    def __init__(self, store, handler, workers=2, poll_interval=1.0):
+        self.store = store
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.processed = 0
+        self.failed = 0
+        self.last_lag_seconds = 0.0
+        self._wakeup = threading.Condition()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers - len(self._threads)):
+            t = threading.Thread(target=self._run, name=f"activation-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, event):
+        """Wake a worker for a freshly stored event, or drain the queue inline"""
+        if not self.workers:
+            self.drain()
+            return
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def drain(self):
+        """Process pending events in the calling thread until none are left"""
+        while True:
+            event = self.store.claim_event()
+            if not event:
+                return
+            self.process(event)
+
+    def _run(self):
+        while True:
+            event = self.store.claim_event()
+            if event:
+                self.process(event)
+                continue
+            with self._wakeup:
+                self._wakeup.wait(self.poll_interval)
+
+    def process(self, event):
+        status, error = 'done', None
+        try:
+            self.handler(event)
+        except Exception as e:
+            status, error = 'failed', str(e)
+            log.exception('activation event failed', extra={'event_id': event['event_id']})
+        processed_at = datetime.now()
+        self.store.complete_event(event['event_id'], status, processed_at.isoformat(), error)
+        self.store.commit()
+        if status == 'done':
+            self.processed += 1
+        else:
+            self.failed += 1
+        self.last_lag_seconds = (processed_at - datetime.fromisoformat(event['created_at'])).total_seconds()
+
+    def stats(self):
+        stats = self.store.event_stats()
+        oldest = stats['oldest_created_at']
+        return {
+            'workers': self.workers,
+            'depth': stats['depth'],
+            'lag_seconds': (datetime.now() - datetime.fromisoformat(oldest)).total_seconds() if oldest else 0.0,
+            'last_lag_seconds': self.last_lag_seconds,
+            'processed': self.processed,
+            'failed': self.failed
+        }
@@ -1,9 +1,32 @@
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for
+from flask import Flask, Response, request, jsonify, render_template, session, redirect, url_for, stream_with_context, g
 from flask_cors import CORS
+import click
 import uuid
 import os
+import math
+import time
+import io
+import csv
 import json
+import base64
+import gc
+import threading
+from contextlib import nullcontext
 from datetime import datetime
+from storage import (
+    JsonStore, DuplicateUserError, ConflictError, sort_key, ledger_key, search_key, read_snapshot, write_snapshot
+)
+from activation_queue import ActivationQueue
+from locking import UserLocks
+from auth import PasswordHasher, HasherBusy, LoginThrottle, is_hashed
+from caching import VersionedCache
+from feed import Feed, ADMIN_CHANNEL, sse
+from assets import AssetPipeline, IMMUTABLE, gzip_json
+from importer import FORMATS, read_rows, plan_import
+from instrumentation import (
+    log, registry, http_requests, http_latency, stage, timed_stage, instrument_methods,
+    setup_logging, SlowRequestProfiler
+)
 
 app = Flask(__name__, template_folder='templates')
 CORS(app, supports_credentials=True)
@@ -11,10 +34,43 @@ CORS(app, supports_credentials=True)
 app.config['SECRET_KEY'] = 'mlm-app-secret-key-2025'
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
-app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
 
-# ===== FILE-BASED DATABASE =====
+# ===== LOGGING & METRICS =====
+# LOG_FORMAT=json|text. /metrics is open unless METRICS_TOKEN is set, then it
+# wants "Authorization: Bearer <token>". The slow request profiler can also
+# be switched at runtime through /api/admin/profiler.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+PROFILE_SLOW_REQUESTS = os.environ.get('PROFILE_SLOW_REQUESTS', '0') == '1'
+PROFILE_THRESHOLD_MS = float(os.environ.get('PROFILE_THRESHOLD_MS', 500))
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 1.0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+
+setup_logging(LOG_LEVEL, LOG_FORMAT)
+profiler = SlowRequestProfiler(PROFILE_SLOW_REQUESTS, PROFILE_THRESHOLD_MS, PROFILE_SAMPLE_RATE, PROFILE_DIR)
+
+# ===== DATABASE =====
+# STORAGE_BACKEND=json keeps users in this process (snapshot + WAL files);
+# STORAGE_BACKEND=mongo shares them between workers through MongoDB.
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'json')
 DB_FILE = "users_database.json"
+SNAPSHOT_FILE = "users_database.snap"
+WAL_FILE = "users_database.wal"
+LEDGER_FILE = "users_database.ledger"
+SNAPSHOT_EVERY = int(os.environ.get('SNAPSHOT_EVERY', 1000))
+# SNAPSHOT_ENCODING=binary writes snapshots to SNAPSHOT_FILE, which loads
+# several times faster than DB_FILE; either is read (the newer one if both
+# are there), and `flask convert-snapshot` converts by hand
+SNAPSHOT_ENCODING = os.environ.get('SNAPSHOT_ENCODING', 'json')
+# SHARED_DATABASE=1 (json only) runs several workers on one JSON database:
+# gunicorn preloads the app (see gunicorn.conf.py), so the master loads it
+# once and the forked workers share its memory copy-on-write, each applying
+# the others' writes from the WAL (see JsonStore.share). Periodic snapshots
+# stop; the WAL is compacted when the master next starts.
+SHARED_DATABASE = STORAGE_BACKEND == 'json' and os.environ.get('SHARED_DATABASE', '0') == '1'
+MONGO_URI = os.environ.get('MONGO_URI', 'mongodb://localhost:27017')
+MONGO_DB = os.environ.get('MONGO_DB', 'mlm')
 MAX_DIRECTS = 12
 ACTIVATION_COST = 100
 
@@ -36,27 +92,105 @@ DIRECT_REQUIREMENTS = {
 
 # ===== MATCHING INCOME =====
 MATCHING_PER_PAIR = 10.00
-
-def load_db():
-    """Load users from JSON file"""
-    if os.path.exists(DB_FILE):
-        try:
-            with open(DB_FILE, 'r') as f:
-                return json.load(f)
-        except:
-            return {}
-    return {}
-
-def save_db(db):
-    """Save users to JSON file"""
-    try:
-        with open(DB_FILE, 'w') as f:
-            json.dump(db, f, indent=2, default=str)
-        print(f"💾 Database saved to {DB_FILE}")
-    except Exception as e:
-        print(f"Error saving database: {e}")
-
-users_db = load_db()
+# immediate: every activation pays matching income to its whole upline as it
+# is processed. settlement: activations only flag their upline, and a
+# settlement run pays every flagged member in one pass, every
+# SETTLEMENT_INTERVAL seconds (0: only when an admin or `flask
+# settle-matching` starts one).
+MATCHING_MODE = os.environ.get('MATCHING_MODE', 'immediate')
+SETTLEMENT_INTERVAL = float(os.environ.get('SETTLEMENT_INTERVAL', 60))
+SETTLEMENT_BATCH = 1000
+
+# ===== ACTIVATION QUEUE =====
+# Background threads paying upline income for activations; 0 pays inline
+ACTIVATION_WORKERS = int(os.environ.get('ACTIVATION_WORKERS', 2))
+
+# ===== CONCURRENCY =====
+# lock: signups and activations hold per-user locks, safe for any number of
+# threads in one process. optimistic: writes carry the version they read
+# and retry on conflict, safe across workers sharing MongoDB or a shared
+# JSON database.
+CONCURRENCY_MODE = os.environ.get('CONCURRENCY_MODE',
+                                  'optimistic' if STORAGE_BACKEND == 'mongo' or SHARED_DATABASE else 'lock')
+OPTIMISTIC_RETRIES = 10
+user_locks = UserLocks()
+
+# ===== LOGIN =====
+# PASSWORD_HASH_METHOD is any werkzeug method with its cost, e.g.
+# scrypt:32768:8:1 or pbkdf2:sha256:600000; existing hashes are upgraded
+# to it on the next successful login.
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 4))
+PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', 64))
+LOGIN_MAX_FAILURES = int(os.environ.get('LOGIN_MAX_FAILURES', 5))
+LOGIN_MAX_FAILURES_PER_IP = int(os.environ.get('LOGIN_MAX_FAILURES_PER_IP', 50))
+LOGIN_FAILURE_WINDOW = int(os.environ.get('LOGIN_FAILURE_WINDOW', 300))
+# Threads hashing the plaintext passwords of a bulk import, next to the pool
+IMPORT_HASH_WORKERS = int(os.environ.get('IMPORT_HASH_WORKERS', 4))
+hasher = PasswordHasher(PASSWORD_HASH_METHOD, PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE)
+username_throttle = LoginThrottle(LOGIN_MAX_FAILURES, LOGIN_FAILURE_WINDOW)
+address_throttle = LoginThrottle(LOGIN_MAX_FAILURES_PER_IP, LOGIN_FAILURE_WINDOW)
+
+# ===== RESPONSE CACHE =====
+# Dashboard and profile JSON is kept per user (RESPONSE_CACHE_SIZE entries,
+# least recently used dropped first) and served with an ETag, so a polling
+# page that already has it gets a 304. See view_version for what moves it.
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 10000))
+cache_lookups = registry.counter(
+    'mlm_cache_lookups_total', 'Versioned cache lookups by cache and result', ('cache', 'result'))
+response_cache = VersionedCache('response', RESPONSE_CACHE_SIZE, cache_lookups)
+
+# ===== LIVE FEED =====
+# /api/feed/stream (server-sent events) and /api/feed/poll push income,
+# joins and activations to the panels. Every open stream holds a server
+# thread, so FEED_MAX_CONNECTIONS caps them per worker well below the
+# threads it runs (256, see Procfile) and leaves the rest to other requests;
+# past it the feed answers 503 with a Retry-After. A stream ends after
+# FEED_STREAM_SECONDS and the browser reconnects, resuming from the last
+# event it got. Where several processes share the database (SHARED_DATABASE,
+# mongo) events go through the store and every worker follows it every
+# FEED_FOLLOW_SECONDS, so a panel hears of changes made by any of them.
+FEED_HISTORY = int(os.environ.get('FEED_HISTORY', 50))
+FEED_MAX_CONNECTIONS = int(os.environ.get('FEED_MAX_CONNECTIONS', 64))
+FEED_SHARED = SHARED_DATABASE or STORAGE_BACKEND == 'mongo'
+FEED_FOLLOW_SECONDS = float(os.environ.get('FEED_FOLLOW_SECONDS', 0.5))
+FEED_HEARTBEAT_SECONDS = float(os.environ.get('FEED_HEARTBEAT_SECONDS', 15))
+FEED_STREAM_SECONDS = float(os.environ.get('FEED_STREAM_SECONDS', 300))
+FEED_POLL_SECONDS = float(os.environ.get('FEED_POLL_SECONDS', 25))
+feed = Feed(FEED_HISTORY, max_listeners=FEED_MAX_CONNECTIONS)
+
+# ===== PAGES & ASSETS =====
+# The pages are rendered once here and served from memory, their inline CSS
+# and JS as content-hashed assets under ASSETS_URL (see assets.py). JSON
+# responses of API_GZIP_MIN_BYTES or more are gzipped for clients taking it.
+ASSETS_URL = '/assets/'
+PAGES = ['index.html', 'login.html', 'signup.html', 'user_panel.html', 'admin_panel.html']
+API_GZIP_MIN_BYTES = int(os.environ.get('API_GZIP_MIN_BYTES', 1024))
+API_GZIP_LEVEL = int(os.environ.get('API_GZIP_LEVEL', 6))
+assets = AssetPipeline(ASSETS_URL)
+with app.app_context():
+    for page in PAGES:
+        assets.add_page(page, render_template(page))
+
+def open_store():
+    """Create the storage backend selected by STORAGE_BACKEND"""
+    if STORAGE_BACKEND == 'mongo':
+        from mongo_store import MongoStore
+        return MongoStore(MONGO_URI, MONGO_DB)
+    return JsonStore(DB_FILE, WAL_FILE, snapshot_every=SNAPSHOT_EVERY, ledger_file=LEDGER_FILE,
+                     snapshot_encoding=SNAPSHOT_ENCODING, snapshot_file=SNAPSHOT_FILE)
+
+store = open_store()
+instrument_methods(store, {
+    'find_by_username': 'index_lookup',
+    'find_by_email': 'index_lookup',
+    'find_by_referral_code': 'index_lookup',
+    'get_upline': 'upline',
+    'get_subtree': 'subtree',
+    'payout': 'payout',
+    'commit': 'persist',
+    'snapshot': 'snapshot'
+})
 
 # Admin user
 ADMIN_USER = {
@@ -80,37 +214,38 @@ ADMIN_USER = {
     "power_leg_user": None,
     "other_leg_users": [],
     "matched_pairs": 0,
+    "team_size": 1,
+    "active_team_size": 1,
     "total_income": 0,
     "commission_received": 0,
     "phone": "",
     "country": "India",
     "state": "",
-    "dob": "",
-    "income_history": []
+    "dob": ""
 }
 
-if "admin-1" not in users_db:
-    users_db["admin-1"] = ADMIN_USER
-    save_db(users_db)
-
 def generate_referral_code():
-    return str(uuid.uuid4())[:8].upper()
-
-def count_team(user_id, db):
-    """Count total team members (used for power leg calculation)"""
-    count = 1
-    user = db.get(user_id)
-    if not user:
-        return 0
-    
-    for direct_id in user.get('direct_referrals', []):
-        count += count_team(direct_id, db)
-    
-    return count
-
-def calculate_power_leg(user_id, db):
+    # 8 hex digits collide every few hundred thousand codes
+    while True:
+        code = str(uuid.uuid4())[:8].upper()
+        if not store.find_by_referral_code(code):
+            return code
+
+@timed_stage('count_team')
+def count_team(user_id, store):
+    """Count total team members by walking the downline (reference for the counters)"""
+    return len(store.get_subtree(user_id))
+
+# ===== TEAM COUNTERS =====
+# Every user carries the size of its own subtree (itself included) as
+# `team_size` and the number of activated members in it as `active_team_size`.
+# The storage layer bumps them along the sponsor chain when a user joins or is
+# (de)activated, so leg sizes are plain lookups on the direct's record.
+
+@timed_stage('power_leg')
+def calculate_power_leg(user_id, store):
     """Calculate power leg and other leg counts"""
-    user = db.get(user_id)
+    user = store.get_user(user_id)
     if not user:
         return {'power_leg': 0, 'other_leg': 0}
     
@@ -120,35 +255,75 @@ def calculate_power_leg(user_id, db):
         return {'power_leg': 0, 'other_leg': 0}
     
     power_leg_user_id = directs[0]
-    power_leg_count = count_team(power_leg_user_id, db)
+    direct_users = store.get_users(directs)
+    power_leg = direct_users.get(power_leg_user_id, {})
     
     other_leg_count = 0
+    other_leg_active = 0
     for i in range(1, len(directs)):
-        other_leg_count += count_team(directs[i], db)
+        direct = direct_users.get(directs[i], {})
+        other_leg_count += direct.get('team_size', 0)
+        other_leg_active += direct.get('active_team_size', 0)
     
     return {
-        'power_leg': power_leg_count,
+        'power_leg': power_leg.get('team_size', 0),
         'other_leg': other_leg_count,
+        'power_leg_active': power_leg.get('active_team_size', 0),
+        'other_leg_active': other_leg_active,
         'power_leg_user': power_leg_user_id
     }
 
-def distribute_activation_income(user_id, db):
-    """When user activates, distribute level income to upline sponsors"""
-    user = db.get(user_id)
-    if not user or not user.get('sponsor_id'):
-        return
-    
-    current_sponsor_id = user.get('sponsor_id')
-    level = 1
+def is_active_at(user, seq):
+    """Was the user active when activation event `seq` was recorded?"""
+    if user.get('activation_status') != 'active':
+        return False
+    activation_seq = user.get('activation_seq')
+    return activation_seq is None or activation_seq < seq
+
+def publish(channel_ids, event_type, data):
+    if FEED_SHARED:
+        store.publish_feed({'channels': channel_ids, 'type': event_type, 'data': data})
+    else:
+        feed.publish(channel_ids, event_type, data)
+
+def follow_feed():
+    """Republish what every process sharing the database publishes on this one's feed"""
+    cursor = None
+    while True:
+        try:
+            events, cursor = store.feed_since(cursor)
+            for e in events:
+                feed.publish(e['channels'], e['type'], e['data'], e['id'])
+        except Exception:
+            log.exception('following the feed failed')
+        time.sleep(FEED_FOLLOW_SECONDS)
+
+def push_income(user_id, entry):
+    """Tell user_id's panel (and the admins') about a payout it just received"""
+    publish([user_id], 'income', dict(entry, user_id=user_id))
+
+def push_joined(user):
+    """Tell the new member's whole upline (and the admins) that it joined"""
+    # Another process may have listeners on it
+    listened = FEED_SHARED or feed.active()
+    upline = [u['user_id'] for u in store.get_upline(user['user_id'])] if listened else []
+    publish(upline, 'member_joined', {
+        'user_id': user['user_id'],
+        'username': user['username'],
+        'sponsor_id': user['sponsor_id'],
+        'created_at': user['created_at']
+    })
+
+def push_activated(user_id, event_id, date):
+    publish([user_id], 'activated', {'user_id': user_id, 'event_id': event_id, 'date': date})
+
+def distribute_activation_income(user_id, store, event):
+    """When user activates, distribute level income to upline sponsors, returns (payouts, amount)"""
+    upline = store.get_upline(user_id, limit=30)
+    payouts = amount = 0
     
-    while current_sponsor_id and level <= 30:
-        sponsor = db.get(current_sponsor_id)
-        if not sponsor:
-            break
-        
-        if sponsor.get('activation_status') != 'active':
-            current_sponsor_id = sponsor.get('sponsor_id')
-            level += 1
+    for level, sponsor in enumerate(upline, start=1):
+        if not is_active_at(sponsor, event['seq']):
             continue
         
         sponsor_directs = len(sponsor.get('direct_referrals', []))
@@ -156,84 +331,366 @@ def distribute_activation_income(user_id, db):
         
         if sponsor_directs >= required_directs:
             income = LEVEL_INCOME.get(level, 0)
-            sponsor['activation_wallet'] = sponsor.get('activation_wallet', 0) + income
-            sponsor['total_income'] = sponsor.get('total_income', 0) + income
-            
-            if 'income_history' not in sponsor:
-                sponsor['income_history'] = []
-            sponsor['income_history'].append({
+            entry = {
+                'entry_id': f"{event['event_id']}:L{level}",
+                'event_id': event['event_id'],
                 'type': 'activation_wallet',
                 'from_user': user_id,
                 'level': level,
                 'amount': income,
                 'date': datetime.now().isoformat()
-            })
-            
-            print(f"💰 {sponsor['username']} earned ${income} from Level {level}")
+            }
+            if store.payout(sponsor['user_id'], 'activation_wallet', income, entry):
+                push_income(sponsor['user_id'], entry)
+                payouts += 1
+                amount += income
+                log.debug('level income paid', extra={
+                    'user_id': sponsor['user_id'], 'amount': income, 'income_level': level,
+                    'event_id': event['event_id']
+                })
+    return payouts, amount
+
+def calculate_matching_income(user_id, store, event):
+    """Calculate and distribute matching income, returns the amount paid"""
+    while True:
+        user = store.get_user(user_id)
+        if not user or not is_active_at(user, event['seq']):
+            return 0
+        
+        leg_data = calculate_power_leg(user_id, store)
+        power_leg = leg_data['power_leg']
+        other_leg = leg_data['other_leg']
+        
+        new_matching = min(power_leg, other_leg)
+        old_matching = user.get('matched_pairs', 0)
+        
+        if new_matching <= old_matching:
+            return 0
         
-        current_sponsor_id = sponsor.get('sponsor_id')
-        level += 1
-
-def calculate_matching_income(user_id, db):
-    """Calculate and distribute matching income"""
-    user = db.get(user_id)
-    if not user or user.get('activation_status') != 'active':
-        return
-    
-    leg_data = calculate_power_leg(user_id, db)
-    power_leg = leg_data['power_leg']
-    other_leg = leg_data['other_leg']
-    
-    new_matching = min(power_leg, other_leg)
-    old_matching = user.get('matched_pairs', 0)
-    
-    if new_matching > old_matching:
         pairs_increment = new_matching - old_matching
         income = pairs_increment * MATCHING_PER_PAIR
         
-        user['matching_wallet'] = user.get('matching_wallet', 0) + income
-        user['total_income'] = user.get('total_income', 0) + income
-        user['matched_pairs'] = new_matching
-        
-        if 'income_history' not in user:
-            user['income_history'] = []
-        user['income_history'].append({
+        entry = {
+            'entry_id': f"{event['event_id']}:M{user_id}",
+            'event_id': event['event_id'],
             'type': 'matching_wallet',
             'pairs': pairs_increment,
             'amount': income,
             'date': datetime.now().isoformat()
-        })
+        }
+        paid = store.payout(user_id, 'matching_wallet', income, entry,
+                            inc={'matched_pairs': pairs_increment}, expect={'matched_pairs': old_matching})
         
-        print(f"💰 {user['username']} earned ${income} from {pairs_increment} matching pairs")
-
-def create_user(data):
-    user_id = str(uuid.uuid4())
-    referral_code = generate_referral_code()
-    sponsor_code = data.get('referral_code')
-
-    sponsor_user_id = None
-    for uid, u in users_db.items():
-        if u.get('referral_code') == sponsor_code:
-            sponsor_user_id = uid
+        if paid:
+            push_income(user_id, entry)
+            log.debug('matching income paid', extra={
+                'user_id': user_id, 'amount': income, 'pairs': pairs_increment, 'event_id': event['event_id']
+            })
+            return income
+        # Another worker moved matched_pairs first; re-read and try again
+
+def flag_matching(user_id, seq):
+    """Flag the upline of activation `seq` for the next matching settlement.
+
+    Every walk flags up to the first sponsor already flagged as of a later
+    activation, and settlements unflag members before their sponsors, so
+    everything above that sponsor is flagged too and the walk stops there
+    instead of going on to the root.
+    """
+    flags = {}
+    sponsor_id = store.get_user(user_id).get('sponsor_id')
+    while sponsor_id:
+        sponsor = store.get_user(sponsor_id)
+        if not sponsor or sponsor.get('matching_dirty_seq', 0) >= seq:
             break
-    
-    if not sponsor_user_id:
-        return None, "Invalid Referral Code"
+        flags[sponsor_id] = seq
+        sponsor_id = sponsor.get('sponsor_id')
+    if flags:
+        store.mark_matching_dirty(flags)
+
+settlement_lock = threading.Lock()
+
+def settle_matching():
+    """Pay matching income to every flagged member in one pass, returns the settlement record
+    (None if nobody was flagged)"""
+    with settlement_lock:
+        flagged = store.matching_dirty_users()
+        if not flagged:
+            return None
+        start = time.perf_counter()
+        settlement_id = str(uuid.uuid4())
+        created_at = datetime.now().isoformat()
+        # Bottom-up: a member's team is always smaller than its sponsor's
+        flagged.sort(key=lambda u: u.get('team_size', 1))
+        users_paid = pairs = amount = 0
+        for i in range(0, len(flagged), SETTLEMENT_BATCH):
+            chunk = flagged[i:i + SETTLEMENT_BATCH]
+            directs = store.get_users([d for u in chunk for d in u.get('direct_referrals', [])])
+            now = datetime.now().isoformat()
+            for user in chunk:
+                user_id, seq = user['user_id'], user.get('matching_dirty_seq')
+                if seq is None:
+                    # Settled by another worker sharing the database since it was listed
+                    continue
+                legs = [directs.get(d, {}).get('team_size', 0) for d in user.get('direct_referrals', [])]
+                old_matching = user.get('matched_pairs', 0)
+                pairs_increment = min(legs[0], sum(legs[1:])) - old_matching if legs else 0
+                if is_active_at(user, seq) and pairs_increment > 0:
+                    income = pairs_increment * MATCHING_PER_PAIR
+                    entry = {
+                        'entry_id': f"{settlement_id}:M{user_id}",
+                        'event_id': settlement_id,
+                        'type': 'matching_wallet',
+                        'pairs': pairs_increment,
+                        'amount': income,
+                        'date': now
+                    }
+                    if not store.payout(user_id, 'matching_wallet', income, entry,
+                                        inc={'matched_pairs': pairs_increment},
+                                        expect={'matched_pairs': old_matching}):
+                        # Another settlement paid it first and unflags it
+                        continue
+                    push_income(user_id, entry)
+                    users_paid += 1
+                    pairs += pairs_increment
+                    amount += income
+                store.clear_matching_dirty(user_id, seq)
+            store.commit()
+
+        record = {
+            'event_id': settlement_id,
+            'seq': store.next_event_seq(),
+            'type': 'matching_settlement',
+            'users_settled': len(flagged),
+            'users_paid': users_paid,
+            'pairs': pairs,
+            'amount': amount,
+            'status': 'done',
+            'created_at': created_at,
+            'processed_at': datetime.now().isoformat(),
+            'error': None
+        }
+        store.enqueue_event(record)
+        store.commit()
+    log.info('matching settled', extra={
+        'event_id': settlement_id, 'users_settled': len(flagged), 'users_paid': users_paid,
+        'amount': amount, 'seconds': round(time.perf_counter() - start, 3)
+    })
+    return record
+
+def run_settlements():
+    while True:
+        time.sleep(SETTLEMENT_INTERVAL)
+        try:
+            settle_matching()
+        except Exception:
+            log.exception('matching settlement failed')
+            # What it applied before failing; a shared database stays locked until then
+            store.commit()
+
+def pay_activation_event(event):
+    """Pay level income and matching income to the upline of an activated user"""
+    with stage('level_payout'):
+        level_payouts, level_amount = distribute_activation_income(event['user_id'], store, event)
+
+    matching_payouts = matching_amount = 0
+    with stage('matching_payout'):
+        if MATCHING_MODE == 'settlement':
+            flag_matching(event['user_id'], event['seq'])
+        else:
+            for sponsor in store.get_upline(event['user_id']):
+                paid = calculate_matching_income(sponsor['user_id'], store, event)
+                if paid:
+                    matching_payouts += 1
+                    matching_amount += paid
+
+    log.info('activation paid', extra={
+        'event_id': event['event_id'], 'user_id': event['user_id'], 'level_payouts': level_payouts,
+        'level_amount': level_amount, 'matching_payouts': matching_payouts, 'matching_amount': matching_amount
+    })
+
+activation_queue = ActivationQueue(store, pay_activation_event, workers=ACTIVATION_WORKERS)
+
+def guarded(user_ids):
+    """Hold the locks of user_ids in lock mode"""
+    if CONCURRENCY_MODE == 'lock':
+        return user_locks.hold(user_ids)
+    return nullcontext()
+
+def expected_version(user):
+    """The `expect` an optimistic write of user carries"""
+    if CONCURRENCY_MODE == 'optimistic':
+        return {'version': user.get('version', 0)}
+    return None
+
+def process_activation(user_id, cost, expect=None):
+    """Activate a user now and queue the upline payouts, returns the activation event
+    (None if the user no longer matches expect)"""
+    now = datetime.now().isoformat()
+    seq = store.next_event_seq()
+    event = {
+        'event_id': str(uuid.uuid4()),
+        'seq': seq,
+        'type': 'activation',
+        'user_id': user_id,
+        'cost': cost,
+        'status': 'pending',
+        'created_at': now,
+        'processed_at': None,
+        'error': None
+    }
+    if not store.activate(user_id, now, cost, seq=seq, expect=expect):
+        return None
+    store.enqueue_event(event)
+    store.commit()
+    push_activated(user_id, event['event_id'], now)
+    activation_queue.submit(event)
+    return event
+
+def activate_member(user_id, cost):
+    """Activate an inactive user exactly once, returns the event or None if already active.
+
+    Raises ConflictError if the user kept changing for OPTIMISTIC_RETRIES tries.
+    """
+    for _ in range(OPTIMISTIC_RETRIES):
+        with guarded([user_id]):
+            user = store.get_user(user_id)
+            if not user or user.get('activation_status') == 'active':
+                return None
+            event = process_activation(user_id, cost, expect=expected_version(user))
+        if event:
+            return event
+    raise ConflictError(user_id)
+
+def activate_batch(items):
+    """Activate many users in one commit with the same payouts as activating them one by one.
+
+    items is a list of (user_id, cost, expect) in activation order, expect
+    being what the member was checked against. A member that changed since
+    is re-read like in activate_member: it is skipped if it got activated
+    meanwhile, and after OPTIMISTIC_RETRIES tries. Returns (event_id,
+    summary, matching_paid, skipped); event_id is None if nobody was
+    activated.
+
+    Leg sizes do not
+    change while the batch runs, so an upline gets matching income at most
+    once: when it was already active before the last batch member below it
+    activated. One walk up from each member, newest first, records that
+    member's seq on every ancestor not yet reached by a newer member and
+    stops once it reaches one that was, so every affected ancestor is
+    visited once for matching. Level income still looks 30 levels up.
+    """
+    now = datetime.now().isoformat()
+    event_id = str(uuid.uuid4())
+    seqs = []
+    activated = []
+    skipped = []
+    for user_id, cost, expect in items:
+        seq = store.next_event_seq()
+        for _ in range(OPTIMISTIC_RETRIES):
+            if store.activate(user_id, now, cost, seq=seq, expect=expect):
+                activated.append((user_id, cost))
+                seqs.append(seq)
+                break
+            user = store.get_user(user_id)
+            if not user or user.get('activation_status') == 'active':
+                skipped.append({'user_id': user_id, 'message': 'Already active'})
+                break
+            expect = expected_version(user)
+        else:
+            skipped.append({'user_id': user_id, 'message': 'User kept changing, try again'})
+    items = activated
+    if not items:
+        store.commit()
+        return None, [], 0, skipped
+
+    nodes = {}
+
+    def node(uid):
+        if uid not in nodes:
+            nodes[uid] = store.get_user(uid)
+        return nodes[uid]
+
+    latest_seq_below = {}
+    level_payouts = [[] for _ in items]
+    for i in reversed(range(len(items))):
+        user_id = items[i][0]
+        seq = seqs[i]
+        current_id = node(user_id).get('sponsor_id')
+        level = 1
+        while current_id:
+            sponsor = node(current_id)
+            if not sponsor:
+                break
+            if level <= 30 and is_active_at(sponsor, seq):
+                if len(sponsor.get('direct_referrals', [])) >= DIRECT_REQUIREMENTS.get(level, 12):
+                    level_payouts[i].append((sponsor, level))
+            if current_id in latest_seq_below:
+                if level >= 30:
+                    break
+            else:
+                latest_seq_below[current_id] = seq
+            current_id = sponsor.get('sponsor_id')
+            level += 1
 
-    sponsor = users_db[sponsor_user_id]
-    
-    if len(sponsor.get('direct_referrals', [])) >= MAX_DIRECTS:
-        return None, f"Sponsor has reached maximum limit of {MAX_DIRECTS} direct members. Cannot add more."
-    
-    if any(u['username'].lower() == data['username'].lower() for u in users_db.values()):
-        return None, "Username already exists"
-    if any(u['email'].lower() == data['email'].lower() for u in users_db.values()):
-        return None, "Email already registered"
+    summary = []
+    for i, (user_id, cost) in enumerate(items):
+        paid = 0
+        for sponsor, level in level_payouts[i]:
+            income = LEVEL_INCOME.get(level, 0)
+            entry = {
+                'entry_id': f"{event_id}:{user_id}:L{level}",
+                'event_id': event_id,
+                'type': 'activation_wallet',
+                'from_user': user_id,
+                'level': level,
+                'amount': income,
+                'date': now
+            }
+            if store.payout(sponsor['user_id'], 'activation_wallet', income, entry):
+                push_income(sponsor['user_id'], entry)
+            paid += income
+        summary.append({
+            'user_id': user_id,
+            'username': node(user_id)['username'],
+            'cost': cost,
+            'seq': seqs[i],
+            'level_income_paid': paid,
+            'uplines_paid': len(level_payouts[i])
+        })
 
-    user = {
-        "user_id": user_id,
+    if MATCHING_MODE == 'settlement':
+        store.mark_matching_dirty(latest_seq_below)
+        matching_paid = 0
+    else:
+        matching_before = {uid: nodes[uid].get('matching_wallet', 0) for uid in latest_seq_below}
+        for ancestor_id, seq in latest_seq_below.items():
+            calculate_matching_income(ancestor_id, store, {'event_id': event_id, 'seq': seq})
+        matching_paid = sum(
+            store.get_user(uid).get('matching_wallet', 0) - before for uid, before in matching_before.items()
+        )
+
+    store.enqueue_event({
+        'event_id': event_id,
+        'seq': seqs[-1],
+        'type': 'batch_activation',
+        'user_ids': [user_id for user_id, _ in items],
+        'status': 'done',
+        'created_at': now,
+        'processed_at': datetime.now().isoformat(),
+        'error': None
+    })
+    store.commit()
+    for user_id, _ in items:
+        push_activated(user_id, event_id, now)
+    return event_id, summary, matching_paid, skipped
+
+def new_member(data, sponsor_user_id, password, created_at=None):
+    """A new inactive member record; password is already hashed"""
+    return {
+        "user_id": str(uuid.uuid4()),
         "username": data['username'],
-        "password": data['password'],
+        "password": password,
         "email": data['email'],
         "first_name": data['first_name'],
         "last_name": data['last_name'],
@@ -247,31 +704,189 @@ def create_user(data):
         "activation_status": "inactive",
         "activation_date": None,
         "activation_cost": ACTIVATION_COST,
-        "created_at": datetime.now().isoformat(),
+        "created_at": created_at or datetime.now().isoformat(),
         "wallet_balance": 0,
         "activation_wallet": 0,
         "matching_wallet": 0,
-        "referral_code": referral_code,
+        "referral_code": generate_referral_code(),
         "sponsor_id": sponsor_user_id,
         "direct_referrals": [],
         "power_leg_user": None,
         "other_leg_users": [],
         "matched_pairs": 0,
+        "team_size": 1,
+        "active_team_size": 0,
         "total_income": 0,
-        "commission_received": 0,
-        "income_history": []
+        "commission_received": 0
     }
 
-    sponsor['direct_referrals'].append(user_id)
+def create_user(data):
+    sponsor_code = data.get('referral_code')
 
-    leg_data = calculate_power_leg(sponsor_user_id, users_db)
-    sponsor['power_leg_user'] = leg_data.get('power_leg_user')
-    sponsor['other_leg_users'] = [d for d in sponsor['direct_referrals'] if d != leg_data.get('power_leg_user')]
+    sponsor = store.find_by_referral_code(sponsor_code)
+    if not sponsor:
+        return None, "Invalid Referral Code"
 
-    users_db[user_id] = user
-    save_db(users_db)
-    print(f"✅ Created INACTIVE user: {user['username']}")
-    return user, None
+    sponsor_user_id = sponsor['user_id']
+
+    if store.find_by_username(data['username']):
+        return None, "Username already exists"
+    if store.find_by_email(data['email']):
+        return None, "Email already registered"
+
+    user = new_member(data, sponsor_user_id, hasher.hash(data['password']))
+
+    # The directs limit is checked against the sponsor as it is when the
+    # user goes in: under its lock, or by inserting only if its version
+    # is still the one read here
+    for _ in range(OPTIMISTIC_RETRIES):
+        with guarded([sponsor_user_id]):
+            sponsor = store.get_user(sponsor_user_id)
+            if len(sponsor.get('direct_referrals', [])) >= MAX_DIRECTS:
+                return None, f"Sponsor has reached maximum limit of {MAX_DIRECTS} direct members. Cannot add more."
+            try:
+                store.insert_user(user, expect_sponsor=expected_version(sponsor))
+            except DuplicateUserError as e:
+                if e.field == 'referral_code':
+                    # Handed out to someone else since generate_referral_code looked
+                    user['referral_code'] = generate_referral_code()
+                    continue
+                return None, "Email already registered" if e.field == 'email' else "Username already exists"
+            except ConflictError:
+                continue
+            store.commit()
+        log.info('user created', extra={'user_id': user['user_id'], 'sponsor_id': sponsor_user_id})
+        push_joined(user)
+        return user, None
+    return None, "Sponsor is busy, please try again"
+
+def import_members(rows, dry_run=False):
+    """Insert the members of parsed import rows (see importer.py) in one batch, returns the report"""
+    seconds = {}
+    start = time.perf_counter()
+    plan, rejects = plan_import(rows, store, MAX_DIRECTS)
+    seconds['plan'] = time.perf_counter() - start
+    result = {'rows': len(plan) + len(rejects), 'planned': len(plan), 'imported': 0, 'dry_run': dry_run,
+              'rejected': rejects, 'seconds': seconds, 'users_per_second': 0}
+    if dry_run or not plan:
+        seconds['plan'] = round(seconds['plan'], 3)
+        return result
+
+    start = time.perf_counter()
+    # Passwords already hashed by werkzeug go in as they are
+    plain = [i for i, (_, fields, _) in enumerate(plan) if not is_hashed(fields['password'])]
+    hashes = hasher.hash_many([plan[i][1]['password'] for i in plain], IMPORT_HASH_WORKERS)
+    passwords = dict(zip(plain, hashes))
+    seconds['hash'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    now = datetime.now().isoformat()
+    existing = {sponsor[1] for _, _, sponsor in plan if sponsor[0] == 'user'}
+    with guarded(existing):
+        # Signups may have filled an existing sponsor since the plan
+        room = {}
+        expect = {}
+        for sponsor_id in existing:
+            sponsor = store.get_user(sponsor_id)
+            room[sponsor_id] = MAX_DIRECTS - len(sponsor.get('direct_referrals', []))
+            if CONCURRENCY_MODE == 'optimistic':
+                expect[sponsor_id] = expected_version(sponsor)
+        users = []
+        rows_of = {}
+        user_ids = {}
+        for i, (number, fields, sponsor) in enumerate(plan):
+            if sponsor[0] == 'row':
+                if sponsor[1] not in user_ids:
+                    rejects.append({'row': number, 'username': fields['username'],
+                                    'message': f"Sponsor row {sponsor[1]} was not imported"})
+                    continue
+                sponsor_user_id = user_ids[sponsor[1]]
+            else:
+                sponsor_user_id = sponsor[1]
+                if room[sponsor_user_id] <= 0:
+                    rejects.append({'row': number, 'username': fields['username'],
+                                    'message': f"Sponsor has reached maximum limit of {MAX_DIRECTS} direct members"})
+                    continue
+                room[sponsor_user_id] -= 1
+            user = new_member(fields, sponsor_user_id, passwords.get(i, fields['password']),
+                              fields['created_at'] or now)
+            users.append(user)
+            rows_of[user['user_id']] = (number, fields['username'])
+            user_ids[number] = user['user_id']
+        skipped = store.insert_users(users, expect)
+        store.commit()
+    seconds['insert'] = time.perf_counter() - start
+
+    messages = {
+        'username': "Username already exists",
+        'email': "Email already registered",
+        'sponsor': "Sponsor changed during the import, please retry this row"
+    }
+    for s in skipped:
+        number, username = rows_of[s['user_id']]
+        rejects.append({'row': number, 'username': username, 'message': messages[s['reason']]})
+    rejects.sort(key=lambda r: r['row'])
+    imported = len(users) - len(skipped)
+    total = sum(seconds.values())
+    result.update(imported=imported, seconds={k: round(v, 3) for k, v in seconds.items()},
+                  users_per_second=round(imported / total, 1) if total else 0)
+    log.info('members imported', extra={'imported': imported, 'rejected': len(rejects), 'seconds': round(total, 3)})
+    return result
+
+@app.before_request
+def start_request():
+    """Tag the request with an id for the logs and start the profiler if this one is sampled"""
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    g.request_start = time.perf_counter()
+    g.profile = profiler.start()
+
+@app.after_request
+def finish_request(response):
+    duration = time.perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    http_requests.inc(request.method, route, str(response.status_code))
+    http_latency.observe(duration, request.method, route)
+    profile = g.pop('profile', None)
+    if profile:
+        profiler.finish(profile, duration * 1000, g.request_id, route)
+    response.headers['X-Request-ID'] = g.request_id
+    log.info('request', extra={
+        'method': request.method, 'path': request.path, 'route': route,
+        'status': response.status_code, 'duration_ms': round(duration * 1000, 3)
+    })
+    return response
+
+@app.after_request
+def compress_response(response):
+    return gzip_json(response, request.accept_encodings, API_GZIP_MIN_BYTES, API_GZIP_LEVEL)
+
+@app.before_request
+def wait_for_load():
+    """Hold requests until the database is loaded; /ready and the assets answer at once"""
+    if ready.is_set() or request.path == '/ready' or request.path.startswith(ASSETS_URL):
+        return None
+    if startup['state'] == 'failed' or not ready.wait(READY_WAIT_SECONDS):
+        return jsonify({'success': False, 'message': 'Server is starting, please retry'}), 503, \
+            {'Retry-After': '5'}
+
+@app.before_request
+def catch_up():
+    """Apply what the other workers committed since this one last looked, so a worker reads its peers' writes"""
+    if SHARED_DATABASE and ready.is_set():
+        store.refresh()
+
+@app.teardown_request
+def stop_profile(exc):
+    profile = g.pop('profile', None)
+    if profile:
+        profile.disable()
+
+@app.teardown_request
+def release_database(exc):
+    """A shared database stays locked from a request's first write to its commit; commit whatever a
+    request that stopped early (a failed expect, an error) left"""
+    if SHARED_DATABASE:
+        store.commit()
 
 # ADD THIS DECORATOR HERE
 @app.before_request
@@ -282,78 +897,121 @@ def before_request():
             return
         user_id = session.get('user_id')
         if not user_id:
-            if request.path not in ['/', '/login', '/signup']:
+            if request.path not in ['/', '/login', '/signup', '/metrics', '/ready']:
                 return redirect(url_for('login_page'))
 
 # Routes
+def send_body(body, cache_control):
+    """A prebuilt Body in the best encoding the client accepts, or a 304"""
+    encoding = body.negotiate(request.accept_encodings)
+    response = Response(body.encodings[encoding], mimetype=body.mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = cache_control
+    response.set_etag(f"{body.etag}-{encoding}")
+    return response.make_conditional(request)
+
+def send_page(name):
+    return send_body(assets.pages[name], 'no-cache')
+
+@app.route(ASSETS_URL + '<name>')
+def static_asset(name):
+    body = assets.assets.get(name)
+    if not body:
+        return jsonify({'error': 'Not found'}), 404
+    return send_body(body, IMMUTABLE)
+
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return send_page('index.html')
 
+# The page routes only pick a template, so they route on what login put in
+# the session; the APIs the pages call still check the user on every hit.
+# /login is where a panel sends a session the APIs refused, so it alone
+# looks the user up and drops sessions whose user is gone.
 @app.route('/login')
 def login_page():
     user_id = session.get('user_id')
-    user = users_db.get(user_id)
-    if user_id and user:
-        if user['is_admin']:
-            return redirect(url_for('admin_dashboard'))
-        return redirect(url_for('user_dashboard'))
-    return render_template('login.html')
+    if user_id:
+        if store.get_user(user_id):
+            if session.get('is_admin'):
+                return redirect(url_for('admin_dashboard'))
+            return redirect(url_for('user_dashboard'))
+        session.clear()
+    return send_page('login.html')
 
 @app.route('/signup')
 def signup_page():
-    user_id = session.get('user_id')
-    user = users_db.get(user_id)
-    if user_id and user and not user.get('is_admin'):
+    if session.get('user_id') and not session.get('is_admin'):
         return redirect(url_for('user_dashboard'))
-    return render_template('signup.html')
+    return send_page('signup.html')
 
 @app.route('/dashboard')
 def user_dashboard():
-    user_id = session.get('user_id')
-    user = users_db.get(user_id)
-    if not user_id or not user or user.get('is_admin'):
+    if not session.get('user_id') or session.get('is_admin'):
         return redirect(url_for('login_page'))
-    return render_template('user_panel.html')
+    return send_page('user_panel.html')
 
 @app.route('/admin/dashboard')
 def admin_dashboard():
-    user_id = session.get('user_id')
-    user = users_db.get(user_id)
-    if not user_id or not user or not user.get('is_admin'):
+    if not session.get('user_id') or not session.get('is_admin'):
         return redirect(url_for('login_page'))
-    return render_template('admin_panel.html')
+    return send_page('admin_panel.html')
 
 # AUTH API ENDPOINTS
 @app.route('/api/auth/login', methods=['POST'])
 def api_login():
     try:
         data = request.get_json() or {}
-        username = data.get('username', '').lower()
+        username = data.get('username', '')
         password = data.get('password', '')
+        if not isinstance(username, str) or not isinstance(password, str):
+            return jsonify({'success': False, 'message': 'username and password must be strings'}), 400
+        username = username.lower()
+        address = request.remote_addr or ''
+
+        retry_after = max(username_throttle.retry_after(username), address_throttle.retry_after(address))
+        if retry_after:
+            return jsonify({'success': False, 'message': 'Too many failed attempts, try again later'}), \
+                429, {'Retry-After': str(math.ceil(retry_after))}
 
-        for uid, user in users_db.items():
-            if user['username'].lower() == username and user['password'] == password:
-                if user['status'] == 'inactive':
-                    return jsonify({'success': False, 'message': 'Account inactive'}), 403
-                session['user_id'] = uid
-                session['username'] = user['username']
-                session['is_admin'] = user['is_admin']
-                print(f"✅ Login: {username}")
-                return jsonify({
-                    'success': True,
-                    'message': 'Login successful',
-                    'user_id': uid,
-                    'username': user['username'],
-                    'is_admin': user['is_admin'],
-                    'name': f"{user['first_name']} {user['last_name']}"
-                }), 200
-
-        print(f"❌ Login failed: {username}")
+        user = store.find_by_username(username)
+        try:
+            valid = hasher.verify(user.get('password') if user else None, password)
+        except HasherBusy:
+            return jsonify({'success': False, 'message': 'Server busy, please try again'}), 503
+        if valid:
+            uid = user['user_id']
+            if user['status'] == 'inactive':
+                return jsonify({'success': False, 'message': 'Account inactive'}), 403
+            username_throttle.succeeded(username)
+            if hasher.needs_rehash(user['password']):
+                try:
+                    store.set_fields(uid, {'password': hasher.hash(password)})
+                    store.commit()
+                except HasherBusy:
+                    pass  # upgraded on a later login
+            session['user_id'] = uid
+            session['username'] = user['username']
+            session['is_admin'] = user['is_admin']
+            log.info('login', extra={'user_id': uid})
+            return jsonify({
+                'success': True,
+                'message': 'Login successful',
+                'user_id': uid,
+                'username': user['username'],
+                'is_admin': user['is_admin'],
+                'name': f"{user['first_name']} {user['last_name']}"
+            }), 200
+
+        username_throttle.failed(username)
+        address_throttle.failed(address)
+        log.info('login failed', extra={'username': username})
         return jsonify({'success': False, 'message': 'Invalid credentials'}), 401
 
     except Exception as e:
-        print(f"Login error: {e}")
+        log.exception('login error')
         return jsonify({'success': False, 'message': str(e)}), 500
 
 @app.route('/api/auth/signup', methods=['POST'])
@@ -366,7 +1024,10 @@ def api_signup():
         if missing:
             return jsonify({'success': False, 'message': f'Missing: {", ".join(missing)}'}), 400
 
-        user, error = create_user(data)
+        try:
+            user, error = create_user(data)
+        except HasherBusy:
+            return jsonify({'success': False, 'message': 'Server busy, please try again'}), 503
         if error:
             return jsonify({'success': False, 'message': error}), 400
 
@@ -380,7 +1041,7 @@ def api_signup():
         }), 201
 
     except Exception as e:
-        print(f"Signup error: {e}")
+        log.exception('signup error')
         return jsonify({'success': False, 'message': str(e)}), 500
 
 @app.route('/api/auth/logout', methods=['POST'])
@@ -390,21 +1051,48 @@ def api_logout():
 
 @app.route('/api/check-username/<username>', methods=['GET'])
 def check_username(username):
-    exists = any(u['username'].lower() == username.lower() for u in users_db.values())
+    exists = store.find_by_username(username) is not None
     return jsonify({'exists': exists}), 200
 
+def view_version(user):
+    """What a user's dashboard and profile are built from.
+
+    version moves when the user activates or gains a direct, branch_version
+    when anyone below them joins or activates (their leg sizes) and
+    total_income with every payout they receive.
+    """
+    return (user.get('version', 0), user.get('branch_version', 0), user.get('total_income', 0))
+
+def cached_json(view, user, build):
+    """JSON of build() for user, rebuilt only when view_version(user) moves; 304 if If-None-Match still matches"""
+    key = (view, user['user_id'])
+    version = view_version(user)
+    cached = response_cache.get(key, version)
+    if cached is None:
+        response = jsonify(build())
+        response.add_etag()
+        cached = (response.get_data(), response.get_etag()[0])
+        response_cache.put(key, version, cached)
+    body, etag = cached
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
 # USER API ENDPOINTS
 @app.route('/api/user/profile', methods=['GET'])
 def get_profile():
     user_id = session.get('user_id')
-    user = users_db.get(user_id)
+    user = store.get_user(user_id)
     if not user_id or not user or user.get('is_admin'):
         return jsonify({'success': False, 'message': 'Unauthorized'}), 401
-    
-    leg_data = calculate_power_leg(user_id, users_db)
+    return cached_json('profile', user, lambda: profile_body(user))
+
+def profile_body(user):
+    leg_data = calculate_power_leg(user['user_id'], store)
     direct_count = len(user.get('direct_referrals', []))
     
-    return jsonify({
+    return {
         'success': True,
         'user': {
             'user_id': user['user_id'],
@@ -430,13 +1118,13 @@ def get_profile():
             'activation_cost': user.get('activation_cost'),
             'created_at': user.get('created_at')
         }
-    }), 200
+    }
 
 @app.route('/api/user/activate', methods=['POST'])
 def activate_user():
     """User activates account with $100"""
     user_id = session.get('user_id')
-    user = users_db.get(user_id)
+    user = store.get_user(user_id)
     if not user_id or not user or user.get('is_admin'):
         return jsonify({'success': False, 'message': 'Unauthorized'}), 401
     
@@ -447,35 +1135,30 @@ def activate_user():
     payment_status = data.get('payment_status', 'success')
     
     if payment_status == 'success':
-        user['activation_status'] = 'active'
-        user['activation_date'] = datetime.now().isoformat()
-        user['wallet_balance'] -= ACTIVATION_COST
-        
-        distribute_activation_income(user_id, users_db)
-        
-        current_sponsor_id = user.get('sponsor_id')
-        while current_sponsor_id:
-            calculate_matching_income(current_sponsor_id, users_db)
-            sponsor = users_db.get(current_sponsor_id)
-            if not sponsor:
-                break
-            current_sponsor_id = sponsor.get('sponsor_id')
-        
-        save_db(users_db)
-        return jsonify({'success': True, 'message': f'Account activated! ${ACTIVATION_COST} deducted.'}), 200
+        try:
+            event = activate_member(user_id, ACTIVATION_COST)
+        except ConflictError:
+            return jsonify({'success': False, 'message': 'Account is busy, please try again'}), 409
+        if not event:
+            return jsonify({'success': False, 'message': 'Already active'}), 400
+        return jsonify({
+            'success': True,
+            'message': f'Account activated! ${ACTIVATION_COST} deducted.',
+            'event_id': event['event_id']
+        }), 200
     else:
         return jsonify({'success': False, 'message': 'Payment failed'}), 400
 
 @app.route('/api/user/referrals', methods=['GET'])
 def get_referrals():
     user_id = session.get('user_id')
-    user = users_db.get(user_id)
+    user = store.get_user(user_id)
     if not user_id or not user:
         return jsonify({'success': False, 'message': 'Unauthorized'}), 401
 
     referrals = []
     for i, ref_id in enumerate(user.get('direct_referrals', [])):
-        ref_user = users_db.get(ref_id)
+        ref_user = store.get_user(ref_id)
         if ref_user:
             is_power = (i == 0)
             referrals.append({
@@ -501,14 +1184,16 @@ def get_referrals():
 @app.route('/api/user/dashboard', methods=['GET'])
 def get_dashboard():
     user_id = session.get('user_id')
-    user = users_db.get(user_id)
+    user = store.get_user(user_id)
     if not user_id or not user:
         return jsonify({'success': False, 'message': 'Unauthorized'}), 401
+    return cached_json('dashboard', user, lambda: dashboard_body(user))
 
-    leg_data = calculate_power_leg(user_id, users_db)
+def dashboard_body(user):
+    leg_data = calculate_power_leg(user['user_id'], store)
     direct_count = len(user.get('direct_referrals', []))
     
-    return jsonify({
+    return {
         'success': True,
         'dashboard': {
             'wallet_balance': user.get('wallet_balance', 0),
@@ -528,109 +1213,337 @@ def get_dashboard():
             'referral_code': user['referral_code'],
             'created_at': user.get('created_at')
         }
+    }
+
+LEVEL_TEAM_PAGE_SIZE = 100
+LEVEL_TEAM_MAX_PAGE_SIZE = 1000
+
+@app.route('/api/user/level-team', methods=['GET'])
+def get_level_team():
+    """Members exactly `level` levels below the caller, in joining order.
+
+    Query params: level (default 1), limit, offset.
+    """
+    user_id = session.get('user_id')
+    user = store.get_user(user_id)
+    if not user_id or not user:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
+
+    try:
+        level = int(request.args.get('level', 1))
+        limit = min(int(request.args.get('limit', LEVEL_TEAM_PAGE_SIZE)), LEVEL_TEAM_MAX_PAGE_SIZE)
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'level, limit and offset must be numbers'}), 400
+    if level < 1 or limit < 1 or offset < 0:
+        return jsonify({'success': False, 'message': 'level and limit must be positive'}), 400
+
+    member_ids = store.get_downline_ids(user_id, level)
+    page_ids = member_ids[offset:offset + limit]
+    found = store.get_users(page_ids)
+    members = []
+    for member_id in page_ids:
+        u = found.get(member_id)
+        if u:
+            members.append({
+                'user_id': u['user_id'],
+                'username': u['username'],
+                'name': f"{u['first_name']} {u['last_name']}",
+                'sponsor_id': u.get('sponsor_id'),
+                'activation_status': u.get('activation_status'),
+                'joined': u.get('created_at')
+            })
+
+    return jsonify({
+        'success': True,
+        'level': level,
+        'total': len(member_ids),
+        'members': members
     }), 200
 
+TREE_DEFAULT_DEPTH = 3
+TREE_MAX_DEPTH = 10
+TREE_CACHE_SIZE = int(os.environ.get('TREE_CACHE_SIZE', 1024))
+# (root_id, depth) -> tree at root's branch_version; any signup or
+# activation under root bumps it, so a stale entry is simply not used
+tree_cache = VersionedCache('tree', TREE_CACHE_SIZE, cache_lookups)
+
+def tree_node(u):
+    directs = u.get('direct_referrals', [])
+    return {
+        "user_id": u['user_id'],
+        "username": u['username'],
+        "name": f"{u['first_name']} {u['last_name']}",
+        "referral_code": u['referral_code'],
+        "activation_status": u.get('activation_status'),
+        "created_at": u.get('created_at'),
+        "direct_count": len(directs),
+        "team_size": u.get('team_size', 1),
+        "has_more": bool(directs),
+        "directs": []
+    }
+
+def build_tree(root, depth, store):
+    """Materialize `depth` levels below root breadth-first, one store read per level"""
+    tree = tree_node(root)
+    frontier = [(root, tree)]
+    for _ in range(depth):
+        wanted = [d for u, _ in frontier for d in u.get('direct_referrals', [])]
+        if not wanted:
+            break
+        found = store.get_users(wanted)
+        next_frontier = []
+        for u, node in frontier:
+            node['has_more'] = False
+            for direct_id in u.get('direct_referrals', []):
+                child = found.get(direct_id)
+                if child:
+                    child_node = tree_node(child)
+                    node['directs'].append(child_node)
+                    next_frontier.append((child, child_node))
+        frontier = next_frontier
+    return tree
+
 @app.route('/api/user/tree', methods=['GET'])
 def get_tree_view():
+    """Downline tree, `depth` levels below `cursor` (a member of the caller's team, default the caller).
+
+    Nodes with has_more=true have directs that were not expanded; request
+    them again with cursor=<their user_id>.
+    """
     user_id = session.get('user_id')
-    user = users_db.get(user_id)
+    user = store.get_user(user_id)
     if not user_id or not user:
         return jsonify({'success': False, 'message': 'Unauthorized'}), 401
 
-    def get_subtree(uid):
-        u = users_db.get(uid)
-        if not u:
-            return None
-        tree = {
-            "user_id": u['user_id'],
-            "username": u['username'],
-            "name": f"{u['first_name']} {u['last_name']}",
-            "referral_code": u['referral_code'],
-            "created_at": u.get('created_at'),
-            "directs": []
-        }
-        for direct_id in u.get('direct_referrals', []):
-            subtree = get_subtree(direct_id)
-            if subtree:
-                tree["directs"].append(subtree)
-        return tree
+    try:
+        depth = max(0, min(int(request.args.get('depth', TREE_DEFAULT_DEPTH)), TREE_MAX_DEPTH))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'depth must be a number'}), 400
+
+    root_id = request.args.get('cursor') or user_id
+    root = store.get_user(root_id)
+    if not root or not store.is_in_team(root_id, user_id):
+        return jsonify({'success': False, 'message': 'Member not found in your team'}), 404
+
+    key = (root_id, depth)
+    version = root.get('branch_version', 0)
+    tree = tree_cache.get(key, version)
+    if tree is None:
+        tree = build_tree(root, depth, store)
+        tree_cache.put(key, version, tree)
+
+    return jsonify({'success': True, 'depth': depth, 'tree': tree}), 200
+
+TEAM_SEARCH_PAGE_SIZE = 20
+TEAM_SEARCH_MAX_PAGE_SIZE = 100
+
+@app.route('/api/user/team/search', methods=['GET'])
+def search_team():
+    """Members of the caller's downline whose username, first, last or full name starts with q.
+
+    Query params: q, min_level, max_level, activation_status, limit, cursor.
+    Members come ordered by the name they matched on, then user_id.
+    """
+    user_id = session.get('user_id')
+    user = store.get_user(user_id)
+    if not user_id or not user:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
 
-    tree = get_subtree(user_id)
-    return jsonify({'success': True, 'tree': tree}), 200
+    args = request.args
+    prefix = args.get('q', '').strip().lower()
+    if not prefix:
+        return jsonify({'success': False, 'message': 'q is required'}), 400
+    filters = {'activation_status': args.get('activation_status')} if args.get('activation_status') else {}
+    try:
+        for field in ('min_level', 'max_level'):
+            if args.get(field):
+                filters[field] = int(args[field])
+        after = decode_cursor(args['cursor'], size=2) if args.get('cursor') else None
+        limit = min(int(args.get('limit', TEAM_SEARCH_PAGE_SIZE)), TEAM_SEARCH_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid level, cursor or limit'}), 400
+    if limit < 1 or any(level < 1 for level in (filters.get('min_level', 1), filters.get('max_level', 1))):
+        return jsonify({'success': False, 'message': 'levels and limit must be positive'}), 400
+
+    page = store.search_team(user_id, prefix, filters, after=after, limit=limit)
+    members = [{
+        'user_id': u['user_id'],
+        'username': u['username'],
+        'name': f"{u['first_name']} {u['last_name']}",
+        'sponsor_id': u.get('sponsor_id'),
+        'activation_status': u.get('activation_status'),
+        'joined': u.get('created_at'),
+        'level': level
+    } for u, level in page]
+    next_cursor = encode_cursor(list(search_key(page[-1][0], prefix))) if len(page) == limit else None
+
+    return jsonify({'success': True, 'members': members, 'next_cursor': next_cursor}), 200
+
+INCOME_HISTORY_PAGE_SIZE = 100
+INCOME_HISTORY_MAX_PAGE_SIZE = 1000
 
 @app.route('/api/user/income-history', methods=['GET'])
 def get_income_history():
+    """Income ledger of the logged in user, a page at a time.
+
+    Query params: limit, cursor, type, date_from, date_to, order (asc|desc).
+    totals holds the count and amount per type over the whole filtered range.
+    """
     user_id = session.get('user_id')
-    user = users_db.get(user_id)
+    user = store.get_user(user_id)
     if not user_id or not user:
         return jsonify({'success': False, 'message': 'Unauthorized'}), 401
 
+    args = request.args
+    filters = {k: args.get(k) for k in ('type', 'date_from', 'date_to') if args.get(k)}
+    descending = args.get('order', 'asc') == 'desc'
+    try:
+        after = decode_cursor(args['cursor'], size=2) if args.get('cursor') else None
+        limit = min(int(args.get('limit', INCOME_HISTORY_PAGE_SIZE)), INCOME_HISTORY_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid cursor or limit'}), 400
+    if limit < 1:
+        return jsonify({'success': False, 'message': 'limit must be positive'}), 400
+
+    page = store.query_income(user_id, filters, descending=descending, after=after, limit=limit)
+    next_cursor = encode_cursor(list(ledger_key(page[-1]))) if len(page) == limit else None
+
     return jsonify({
         'success': True,
-        'income_history': user.get('income_history', [])
+        'income_history': page,
+        'totals': store.income_totals(user_id, filters),
+        'next_cursor': next_cursor
     }), 200
 
 # ADMIN API ENDPOINTS
+ADMIN_USERS_PAGE_SIZE = 100
+ADMIN_USERS_MAX_PAGE_SIZE = 1000
+ADMIN_USERS_SORT_FIELDS = ['created_at', 'username', 'activation_date', 'total_income',
+                           'activation_wallet', 'matching_wallet', 'wallet_balance']
+ADMIN_USER_FIELDS = ['user_id', 'username', 'email', 'name', 'phone', 'status', 'activation_status',
+                     'activation_wallet', 'matching_wallet', 'total_income', 'created_at',
+                     'wallet_balance', 'directs', 'max_directs']
+
+def admin_user_row(u, fields):
+    row = {
+        'user_id': u['user_id'],
+        'username': u['username'],
+        'email': u['email'],
+        'name': f"{u['first_name']} {u['last_name']}",
+        'phone': u.get('mobile', ''),
+        'status': u.get('status', ''),
+        'activation_status': u.get('activation_status'),
+        'activation_wallet': u.get('activation_wallet', 0),
+        'matching_wallet': u.get('matching_wallet', 0),
+        'total_income': u.get('total_income', 0),
+        'created_at': u.get('created_at'),
+        'wallet_balance': u.get('wallet_balance', 0),
+        'directs': len(u.get('direct_referrals', [])),
+        'max_directs': MAX_DIRECTS
+    }
+    return {f: row[f] for f in fields}
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def decode_cursor(cursor, size=3):
+    key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not isinstance(key, list) or len(key) != size:
+        raise ValueError('bad cursor')
+    return key
+
 @app.route('/api/admin/users', methods=['GET'])
 def admin_get_users():
+    """List members a page at a time, or stream them all with format=ndjson|csv.
+
+    Query params: limit, cursor, status, activation_status, created_from,
+    created_to, sort, order (asc|desc), fields (comma separated), format.
+    """
     user_id = session.get('user_id')
-    user = users_db.get(user_id)
+    user = store.get_user(user_id)
     if not user_id or not user or not user.get('is_admin'):
         return jsonify({'success': False, 'message': 'Admin access required'}), 403
 
-    all_users = [
-        {
-            'user_id': u['user_id'],
-            'username': u['username'],
-            'email': u['email'],
-            'name': f"{u['first_name']} {u['last_name']}",
-            'phone': u.get('mobile', ''),
-            'status': u.get('status', ''),
-            'activation_status': u.get('activation_status'),
-            'activation_wallet': u.get('activation_wallet', 0),
-            'matching_wallet': u.get('matching_wallet', 0),
-            'total_income': u.get('total_income', 0),
-            'created_at': u.get('created_at'),
-            'wallet_balance': u.get('wallet_balance', 0),
-            'directs': len(u.get('direct_referrals', [])),
-            'max_directs': MAX_DIRECTS
-        }
-        for u in users_db.values()
-        if not u.get('is_admin')
-    ]
+    args = request.args
+    filters = {k: args.get(k) for k in ('status', 'activation_status', 'created_from', 'created_to') if args.get(k)}
+    sort = args.get('sort', 'created_at')
+    descending = args.get('order', 'asc') == 'desc'
+    output = args.get('format', 'json')
+    fields = [f for f in args.get('fields', '').split(',') if f] or ADMIN_USER_FIELDS
+
+    if sort not in ADMIN_USERS_SORT_FIELDS:
+        return jsonify({'success': False, 'message': f'sort must be one of {", ".join(ADMIN_USERS_SORT_FIELDS)}'}), 400
+    unknown = [f for f in fields if f not in ADMIN_USER_FIELDS]
+    if unknown:
+        return jsonify({'success': False, 'message': f'Unknown fields: {", ".join(unknown)}'}), 400
+    if output not in ('json', 'ndjson', 'csv'):
+        return jsonify({'success': False, 'message': 'format must be json, ndjson or csv'}), 400
+    try:
+        after = decode_cursor(args['cursor']) if args.get('cursor') else None
+        limit = min(int(args.get('limit', ADMIN_USERS_PAGE_SIZE)), ADMIN_USERS_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid cursor or limit'}), 400
+    if limit < 1:
+        return jsonify({'success': False, 'message': 'limit must be positive'}), 400
+
+    if output != 'json':
+        # Full export: rows are rendered one at a time as the client reads them
+        rows = store.query_users(filters, sort=sort, descending=descending, after=after)
+
+        def generate_ndjson():
+            for u in rows:
+                yield json.dumps(admin_user_row(u, fields), default=str) + '\n'
+
+        def generate_csv():
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(fields)
+            for u in rows:
+                row = admin_user_row(u, fields)
+                writer.writerow([row[f] for f in fields])
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+            yield buf.getvalue()
+
+        if output == 'csv':
+            return Response(stream_with_context(generate_csv()), mimetype='text/csv',
+                            headers={'Content-Disposition': 'attachment; filename=users.csv'})
+        return Response(stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+
+    page = list(store.query_users(filters, sort=sort, descending=descending, after=after, limit=limit))
+    next_cursor = encode_cursor(list(sort_key(page[-1], sort))) if len(page) == limit else None
 
     return jsonify({
         'success': True,
-        'total_users': len(all_users),
-        'users': all_users
+        'total_users': store.count_users_matching(filters),
+        'users': [admin_user_row(u, fields) for u in page],
+        'next_cursor': next_cursor
     }), 200
 
 @app.route('/api/admin/stats', methods=['GET'])
 def admin_stats():
     user_id = session.get('user_id')
-    admin = users_db.get(user_id)
+    admin = store.get_user(user_id)
     if not user_id or not admin or not admin.get('is_admin'):
         return jsonify({'success': False, 'message': 'Admin access required'}), 403
 
-    total_users = len([u for u in users_db.values() if not u.get('is_admin')])
-    active_users = len([u for u in users_db.values() if u.get('status') == 'active' and not u.get('is_admin')])
-    pending_users = len([u for u in users_db.values() if u.get('status') == 'pending' and not u.get('is_admin')])
-    activated_users = len([u for u in users_db.values() if u.get('activation_status') == 'active' and not u.get('is_admin')])
-    inactive_users = total_users - activated_users
-    total_activation_wallet = sum(u.get('activation_wallet', 0) for u in users_db.values() if not u.get('is_admin'))
-    total_matching_wallet = sum(u.get('matching_wallet', 0) for u in users_db.values() if not u.get('is_admin'))
+    stats = store.get_stats()
+    total_users = stats.get('users', 0)
+    activated_users = stats.get('activation_status:active', 0)
 
     return jsonify({
         'success': True,
         'stats': {
             'total_users': total_users,
-            'active_users': active_users,
-            'pending_users': pending_users,
+            'active_users': stats.get('status:active', 0),
+            'pending_users': stats.get('status:pending', 0),
             'activated_users': activated_users,
-            'inactive_users': inactive_users,
-            'total_wallet_balance': sum(u.get('wallet_balance', 0) for u in users_db.values() if not u.get('is_admin')),
-            'total_activation_wallet': total_activation_wallet,
-            'total_matching_wallet': total_matching_wallet,
+            'inactive_users': total_users - activated_users,
+            'total_wallet_balance': float(stats.get('wallet_balance', 0)),
+            'total_activation_wallet': float(stats.get('activation_wallet', 0)),
+            'total_matching_wallet': float(stats.get('matching_wallet', 0)),
             'activation_cost': ACTIVATION_COST,
             'matching_per_pair': MATCHING_PER_PAIR
         }
@@ -640,11 +1553,11 @@ def admin_stats():
 def admin_activate_user(user_id):
     """Admin can activate user with custom cost ($100 or $0 for testing)"""
     user_id_admin = session.get('user_id')
-    admin = users_db.get(user_id_admin)
+    admin = store.get_user(user_id_admin)
     if not user_id_admin or not admin or not admin.get('is_admin'):
         return jsonify({'success': False, 'message': 'Admin access required'}), 403
 
-    user = users_db.get(user_id)
+    user = store.get_user(user_id)
     if not user:
         return jsonify({'success': False, 'message': 'User not found'}), 404
 
@@ -653,47 +1566,421 @@ def admin_activate_user(user_id):
     cost = float(data.get('cost', ACTIVATION_COST))
     
     if action == 'activate':
-        user['activation_status'] = 'active'
-        user['activation_date'] = datetime.now().isoformat()
-        user['wallet_balance'] -= cost
-        
-        distribute_activation_income(user_id, users_db)
-        
-        current_sponsor_id = user.get('sponsor_id')
-        while current_sponsor_id:
-            calculate_matching_income(current_sponsor_id, users_db)
-            sponsor = users_db.get(current_sponsor_id)
-            if not sponsor:
-                break
-            current_sponsor_id = sponsor.get('sponsor_id')
-        
-        save_db(users_db)
+        try:
+            event = activate_member(user_id, cost)
+        except ConflictError:
+            return jsonify({'success': False, 'message': 'User is busy, please try again'}), 409
+        if not event:
+            return jsonify({'success': False, 'message': 'User is already active'}), 400
         
         cost_text = f"${cost:.2f}" if cost > 0 else "FREE (Testing)"
         return jsonify({
             'success': True,
-            'message': f'User activated with {cost_text} cost. Income distributed to upline.'
+            'message': f'User activated with {cost_text} cost. Income distribution queued for upline.',
+            'event_id': event['event_id']
         }), 200
     else:
-        user['activation_status'] = 'inactive'
-        save_db(users_db)
+        with guarded([user_id]):
+            store.deactivate(user_id)
+            store.commit()
         return jsonify({'success': True, 'message': 'User deactivated'}), 200
 
+@app.route('/api/admin/users/activate-batch', methods=['POST'])
+def admin_activate_batch():
+    """Activate a list of users in order: {"users": [{"user_id": ..., "cost": ...}, ...]}"""
+    user_id_admin = session.get('user_id')
+    admin = store.get_user(user_id_admin)
+    if not user_id_admin or not admin or not admin.get('is_admin'):
+        return jsonify({'success': False, 'message': 'Admin access required'}), 403
+
+    data = request.get_json() or {}
+    entries = data.get('users')
+    if not isinstance(entries, list) or not entries:
+        return jsonify({'success': False, 'message': 'users must be a non-empty list'}), 400
+
+    ids = [entry.get('user_id') if isinstance(entry, dict) else entry for entry in entries]
+    with guarded(ids):
+        items = []
+        errors = []
+        seen = set()
+        for i, entry in enumerate(entries):
+            if not isinstance(entry, dict):
+                entry = {'user_id': entry}
+            uid = entry.get('user_id')
+            u = store.get_user(uid)
+            try:
+                cost = float(entry.get('cost', ACTIVATION_COST))
+            except (TypeError, ValueError):
+                errors.append({'index': i, 'user_id': uid, 'message': 'Invalid cost'})
+                continue
+            if not u or u.get('is_admin'):
+                errors.append({'index': i, 'user_id': uid, 'message': 'User not found'})
+            elif u.get('activation_status') == 'active':
+                errors.append({'index': i, 'user_id': uid, 'message': 'Already active'})
+            elif uid in seen:
+                errors.append({'index': i, 'user_id': uid, 'message': 'Duplicate user in batch'})
+            else:
+                seen.add(uid)
+                items.append((uid, cost, expected_version(u)))
+
+        if errors:
+            return jsonify({'success': False, 'message': 'Batch rejected, nothing was activated', 'errors': errors}), 400
+
+        event_id, summary, matching_paid, skipped = activate_batch(items)
+    if not event_id:
+        return jsonify({'success': False, 'message': 'Nothing was activated', 'errors': skipped}), 409
+    return jsonify({
+        'success': True,
+        'message': f'{len(summary)} users activated. Income distributed to upline.',
+        'event_id': event_id,
+        'activated': len(summary),
+        'level_income_paid': sum(s['level_income_paid'] for s in summary),
+        'matching_income_paid': matching_paid,
+        'users': summary,
+        'skipped': skipped
+    }), 200
+
+@app.route('/api/admin/import', methods=['POST'])
+def admin_import():
+    """Import members from a CSV or JSONL body (?format=, else by Content-Type); ?dry_run=1 only checks"""
+    user_id = session.get('user_id')
+    admin = store.get_user(user_id)
+    if not user_id or not admin or not admin.get('is_admin'):
+        return jsonify({'success': False, 'message': 'Admin access required'}), 403
+
+    fmt = request.args.get('format') or ('csv' if request.mimetype == 'text/csv' else 'jsonl')
+    if fmt not in FORMATS:
+        return jsonify({'success': False, 'message': f"format must be one of {', '.join(FORMATS)}"}), 400
+    lines = io.TextIOWrapper(request.stream, encoding='utf-8-sig', newline='')
+    result = import_members(read_rows(lines, fmt), dry_run=request.args.get('dry_run') == '1')
+    done = f"{result['planned']} members would be imported" if result['dry_run'] else \
+        f"{result['imported']} members imported"
+    return jsonify({
+        'success': True,
+        'message': f"{done}, {len(result['rejected'])} rows rejected",
+        'import': result
+    }), 200
+
+@app.route('/api/activation-events/<event_id>', methods=['GET'])
+def get_activation_event(event_id):
+    """Payout status of an activation; users see their own, admins see all"""
+    user_id = session.get('user_id')
+    user = store.get_user(user_id)
+    if not user_id or not user:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
+
+    event = store.get_event(event_id)
+    if not event or (event.get('user_id') != user_id and not user.get('is_admin')):
+        return jsonify({'success': False, 'message': 'Event not found'}), 404
+
+    return jsonify({'success': True, 'event': event}), 200
+
+@app.route('/api/admin/activation-queue', methods=['GET'])
+def admin_activation_queue():
+    user_id = session.get('user_id')
+    admin = store.get_user(user_id)
+    if not user_id or not admin or not admin.get('is_admin'):
+        return jsonify({'success': False, 'message': 'Admin access required'}), 403
+
+    return jsonify({'success': True, 'queue': activation_queue.stats()}), 200
+
+@app.route('/api/admin/matching/settle', methods=['POST'])
+def admin_settle_matching():
+    """Run a matching settlement now (MATCHING_MODE=settlement)"""
+    user_id = session.get('user_id')
+    admin = store.get_user(user_id)
+    if not user_id or not admin or not admin.get('is_admin'):
+        return jsonify({'success': False, 'message': 'Admin access required'}), 403
+
+    if MATCHING_MODE != 'settlement':
+        return jsonify({'success': False, 'message': 'Matching income is paid on every activation'}), 400
+    settlement = settle_matching()
+    message = f"{settlement['users_paid']} members paid" if settlement else 'Nobody to settle'
+    return jsonify({'success': True, 'message': message, 'settlement': settlement}), 200
+
+@app.cli.command('recompute')
+def recompute_command():
+    """Rebuild team counters from the sponsor tree and report drift"""
+    wait_ready()
+    drift = store.recompute_team_counts()
+    for d in drift:
+        print(f"⚠️  {d['user_id']}: team_size {d['team_size']} -> {d['expected_team_size']}, "
+              f"active_team_size {d['active_team_size']} -> {d['expected_active_team_size']}")
+    print(f"✅ Team counters rebuilt for {store.count_users()} users, {len(drift)} corrected")
+
+@app.cli.command('rebuild-ancestry')
+def rebuild_ancestry_command():
+    """Rebuild the ancestor index from sponsor links and report drift"""
+    wait_ready()
+    drift = store.rebuild_ancestry()
+    for d in drift:
+        print(f"⚠️  {d['user_id']}: upline {d['upline']} -> {d['expected_upline']}")
+    print(f"✅ Ancestor index rebuilt for {store.count_users()} users, {len(drift)} corrected")
+
+@app.cli.command('check-stats')
+def check_stats_command():
+    """Recompute the admin dashboard totals from every user and report drift"""
+    wait_ready()
+    drift = store.recompute_stats()
+    for d in drift:
+        print(f"⚠️  {d['stat']}: {d['stored']} -> {d['expected']}")
+    print(f"✅ Stats checked for {store.count_users()} users, {len(drift)} corrected")
+
+@app.cli.command('convert-snapshot')
+@click.argument('source')
+@click.argument('target')
+@click.option('--to', 'encoding', type=click.Choice(['json', 'binary']), required=True)
+def convert_snapshot_command(source, target, encoding):
+    """Rewrite a JSON or binary snapshot in the other encoding (stop the app first)"""
+    start = time.perf_counter()
+    data = read_snapshot(source)
+    write_snapshot(target, data['seq'], data['event_seq'], data['events'], data['users'], encoding)
+    print(f"✅ {len(data['users'])} users written to {target} ({encoding}) in {time.perf_counter() - start:.1f}s")
+
+@app.cli.command('import-members')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default=None, help='Defaults to the file extension')
+@click.option('--dry-run', is_flag=True, help='Only check the rows')
+@click.option('--out', default=None, help='Also write the report as JSON to this file')
+def import_members_command(path, fmt, dry_run, out):
+    """Import members with their sponsors from a CSV or JSONL file.
+
+    With the JSON backend this writes the database files directly: stop the
+    server first, or run both with SHARED_DATABASE=1. The command refuses to
+    start next to a server that owns the files.
+    """
+    wait_ready()
+    fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        result = import_members(read_rows(f, fmt), dry_run=dry_run)
+    for r in result['rejected'][:100]:
+        print(f"❌ row {r['row']} ({r['username']}): {r['message']}")
+    if out:
+        with open(out, 'w') as f:
+            json.dump(result, f, indent=2)
+    if dry_run:
+        print(f"✅ {result['planned']} of {result['rows']} rows would be imported, "
+              f"{len(result['rejected'])} rejected")
+        return
+    print(f"✅ {result['imported']} of {result['rows']} rows imported, {len(result['rejected'])} rejected, "
+          f"{result['users_per_second']} users/s ({result['seconds']})")
+
+@app.cli.command('audit-payouts')
+@click.option('--limit', default=100, help='Discrepancies reported, largest first')
+@click.option('--out', default=None, help='Also write the report as JSON to this file')
+def audit_payouts_command(limit, out):
+    """Recompute every wallet from the sponsor tree and the payout rules and report the users that differ"""
+    from audit import audit_payouts
+    wait_ready()
+    result = audit_payouts(store.iter_users(), LEVEL_INCOME, DIRECT_REQUIREMENTS, MATCHING_PER_PAIR, limit=limit)
+    for d in result['discrepancies']:
+        print(f"⚠️  {d['username']} ({d['user_id']}): {d['field']} {d['stored']}, "
+              f"expected {d['expected_min']}..{d['expected_max']}")
+    for field, totals in result['totals'].items():
+        print(f"💰 {field}: stored {totals['stored']}, expected {totals['expected_min']}..{totals['expected_max']}, "
+              f"{totals['users_wrong']} users wrong")
+    if out:
+        with open(out, 'w') as f:
+            json.dump(result, f, indent=2)
+    wrong = sum(totals['users_wrong'] for totals in result['totals'].values())
+    print(f"✅ {result['users']} users audited in {sum(result['seconds'].values()):.1f}s, {wrong} discrepancies")
+
+@app.cli.command('settle-matching')
+def settle_matching_command():
+    """Pay the matching income of every member flagged since the last settlement"""
+    wait_ready()
+    settlement = settle_matching()
+    if not settlement:
+        print("✅ Nobody to settle")
+        return
+    print(f"✅ Settlement {settlement['event_id']}: {settlement['users_settled']} members settled, "
+          f"{settlement['users_paid']} paid ${settlement['amount']:.2f} for {settlement['pairs']} pairs")
+
+@app.route('/api/feed/stream', methods=['GET'])
+def feed_stream():
+    """Server-sent events for the logged-in user: income, members joining below them, their activation.
+
+    Admins get every event. A reconnecting EventSource sends Last-Event-ID
+    and gets what it missed, as far as the channel's history goes back.
+    """
+    user_id = session.get('user_id')
+    user = store.get_user(user_id)
+    if not user_id or not user:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
+    if feed.full():
+        return jsonify({'success': False, 'message': 'Too many live connections, please retry'}), 503, \
+            {'Retry-After': '30'}
+    try:
+        last_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_id') or -1)
+    except ValueError:
+        last_id = -1
+    channel = ADMIN_CHANNEL if user.get('is_admin') else user_id
+
+    def generate():
+        yield 'retry: 3000\n\n'
+        for events in feed.listen(channel, last_id if last_id >= 0 else None,
+                                  FEED_HEARTBEAT_SECONDS, FEED_STREAM_SECONDS):
+            yield sse(events)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/feed/poll', methods=['GET'])
+def feed_poll():
+    """Long poll of the same events: waits up to `timeout` seconds for events after `after`"""
+    user_id = session.get('user_id')
+    user = store.get_user(user_id)
+    if not user_id or not user:
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
+    if feed.full():
+        return jsonify({'success': False, 'message': 'Too many live connections, please retry'}), 503, \
+            {'Retry-After': '30'}
+    try:
+        after = int(request.args.get('after', 0))
+        timeout = max(0.0, min(float(request.args.get('timeout', FEED_POLL_SECONDS)), FEED_POLL_SECONDS))
+    except ValueError:
+        return jsonify({'success': False, 'message': 'after and timeout must be numbers'}), 400
+    channel = ADMIN_CHANNEL if user.get('is_admin') else user_id
+    events = feed.wait(channel, after, timeout)
+    return jsonify({'success': True, 'events': events, 'last_id': events[-1]['id'] if events else after}), 200
+
+registry.gauge('mlm_feed_connections', 'Open live feed streams and long polls', lambda: feed.listeners)
+registry.gauge('mlm_activation_queue_depth', 'Activation events waiting to be paid out',
+               lambda: activation_queue.stats()['depth'])
+registry.gauge('mlm_activation_queue_lag_seconds', 'Age of the oldest unpaid activation event',
+               lambda: activation_queue.stats()['lag_seconds'])
+registry.counter_value('mlm_activation_events_processed_total', 'Activation events paid out by this process',
+                       lambda: activation_queue.processed)
+registry.counter_value('mlm_activation_events_failed_total', 'Activation events that failed in this process',
+                       lambda: activation_queue.failed)
+registry.gauge('mlm_response_cache_entries', 'Dashboard and profile responses cached in this process',
+               lambda: len(response_cache))
+registry.gauge('mlm_users', 'Members in the database', lambda: store.get_stats().get('users', 0))
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text exposition of this process's metrics"""
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return jsonify({'success': False, 'message': 'Unauthorized'}), 401
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/admin/profiler', methods=['GET', 'PUT'])
+def admin_profiler():
+    """Show or change the slow request profiler: enabled, threshold_ms, sample_rate"""
+    user_id = session.get('user_id')
+    user = store.get_user(user_id)
+    if not user_id or not user or not user.get('is_admin'):
+        return jsonify({'success': False, 'message': 'Admin access required'}), 403
+
+    if request.method == 'PUT':
+        data = request.get_json() or {}
+        if 'enabled' in data and not isinstance(data['enabled'], bool):
+            return jsonify({'success': False, 'message': 'enabled must be true or false'}), 400
+        try:
+            if 'threshold_ms' in data:
+                profiler.threshold_ms = float(data['threshold_ms'])
+            if 'sample_rate' in data:
+                profiler.sample_rate = min(max(float(data['sample_rate']), 0.0), 1.0)
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': 'threshold_ms and sample_rate must be numbers'}), 400
+        if 'enabled' in data:
+            profiler.enabled = data['enabled']
+        log.info('profiler settings changed', extra={'settings': {k: data[k] for k in data}})
+
+    return jsonify({'success': True, 'profiler': profiler.settings()}), 200
+
+@app.route('/ready', methods=['GET'])
+def readiness():
+    """200 once the database is loaded, 503 with the load progress until then"""
+    body = dict(startup, ready=ready.is_set(), progress=store.load_progress())
+    return jsonify(body), 200 if ready.is_set() else 503
+
 @app.errorhandler(404)
 def not_found(e):
     return jsonify({'error': 'Not found'}), 404
 
 @app.errorhandler(500)
 def server_error(e):
-    print(f"Server error: {e}")
+    log.error('server error', extra={'error': str(e)})
     return jsonify({'error': 'Server error'}), 500
 
+# ===== STARTUP =====
+# The database loads on a background thread (BACKGROUND_LOAD=1) so workers
+# answer /ready with the load progress right away; every other request waits
+# up to READY_WAIT_SECONDS for the load and then gets a 503. A shared
+# database loads in the master before it forks, so never in the background.
+# `flask <command>` other than run imports the app for a one-off job: it
+# loads the database up front and leaves paying activations and settlements
+# to the server.
+_cli = click.get_current_context(silent=True)
+CLI_COMMAND = _cli is not None and _cli.command.name != 'run'
+BACKGROUND_LOAD = os.environ.get('BACKGROUND_LOAD', '1') == '1' and not SHARED_DATABASE and not CLI_COMMAND
+READY_WAIT_SECONDS = float(os.environ.get('READY_WAIT_SECONDS', 30))
+ready = threading.Event()
+startup = {'state': 'loading', 'started_at': datetime.now().isoformat(), 'seconds': None, 'error': None}
+
+def start_background():
+    activation_queue.start()
+    if MATCHING_MODE == 'settlement' and SETTLEMENT_INTERVAL > 0:
+        threading.Thread(target=run_settlements, name='matching-settlement', daemon=True).start()
+    if FEED_SHARED:
+        threading.Thread(target=follow_feed, name='feed-follower', daemon=True).start()
+
+def after_fork():
+    """Set up a worker forked from a master that loaded a shared database; threads do not survive a fork"""
+    store.after_fork()
+    hasher.after_fork()
+    start_background()
+
+def warm_up():
+    """Load the store, make sure the admin exists and start paying queued activations"""
+    start = time.perf_counter()
+    try:
+        if not SHARED_DATABASE:
+            # A second process appending to the same WAL on its own would
+            # reuse its seqs and pay the same queued events
+            store.claim()
+        store.load()
+        if not store.get_user("admin-1"):
+            store.insert_user(dict(ADMIN_USER, password=hasher.hash(ADMIN_USER['password'])))
+            store.commit()
+        if SHARED_DATABASE:
+            store.share()
+            # Keep collections in the workers from writing to the loaded
+            # objects' headers, which would copy the pages they sit on
+            gc.freeze()
+        elif not CLI_COMMAND:
+            start_background()
+    except Exception as e:
+        startup.update(state='failed', error=str(e))
+        if CLI_COMMAND:
+            raise click.ClickException(str(e)) from e
+        log.exception('startup failed')
+        raise
+    startup.update(state='ready', seconds=round(time.perf_counter() - start, 3))
+    log.info('ready', extra={'seconds': startup['seconds'], 'users': store.count_users()})
+    ready.set()
+
+def wait_ready():
+    """Block until warm_up is done; raises if it failed"""
+    while not ready.wait(0.1):
+        if startup['state'] == 'failed':
+            raise RuntimeError(f"Startup failed: {startup['error']}")
+
+if BACKGROUND_LOAD:
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+else:
+    warm_up()
+
 if __name__ == "__main__":
+    wait_ready()
+    if SHARED_DATABASE:
+        start_background()
     port = int(os.environ.get('PORT', 10000))
     print(f"\n🚀 Server starting on port {port}")
     print(f"📝 Admin: admin / admin123")
-    print(f"📂 Database: {DB_FILE}")
-    print(f"📊 Users loaded: {len(users_db)}")
+    print(f"📂 Database: {MONGO_URI if STORAGE_BACKEND == 'mongo' else DB_FILE} ({STORAGE_BACKEND})")
+    print(f"📊 Users loaded: {store.count_users()}")
     print(f"👥 Max Directs per user: {MAX_DIRECTS}")
     print(f"💳 Activation Cost: ${ACTIVATION_COST}")
     print(f"💰 Matching Income: ${MATCHING_PER_PAIR} per pair")
@@ -0,0 +1,104 @@
+import gzip
+import hashlib
+import re
+
+try:
+    import brotli
+except ImportError:
+    # Optional: without it pages are sent gzipped
+    brotli = None
+
+# ===== ASSET PIPELINE =====
+# The page templates are static HTML with all their CSS and JS inline. Each
+# page is rendered once at startup, its inline <style> and <script> blocks
+# are moved out to files named after a hash of their content, and every
+# body is kept in memory plain, gzipped and (with the brotli package)
+# brotli'd, with an ETag. An asset name never changes content, so browsers
+# keep assets for a year; pages are revalidated against their ETag and
+# mostly answered with a 304.
+
+INLINE_BLOCK = re.compile(r'<(style|script)>(.*?)</\1>', re.S)
+ASSET_TYPES = {'style': ('css', 'text/css'), 'script': ('js', 'text/javascript')}
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def content_hash(data, length=16):
+    return hashlib.sha256(data).hexdigest()[:length]
+
+
+class Body:
+    """A response body in every encoding worth sending it in"""
+
+    def __init__(self, data, mimetype):
+        self.mimetype = mimetype
+        self.etag = content_hash(data)
+        self.encodings = {'identity': data}
+        compressed = gzip.compress(data, 9, mtime=0)
+        if len(compressed) < len(data):
+            self.encodings['gzip'] = compressed
+        if brotli:
+            compressed = brotli.compress(data, quality=11)
+            if len(compressed) < len(data):
+                self.encodings['br'] = compressed
+
+    def negotiate(self, accept_encodings):
+        """The smallest encoding the client accepts"""
+        for encoding in ('br', 'gzip'):
+            if encoding in self.encodings and accept_encodings[encoding]:
+                return encoding
+        return 'identity'
+
+
+class AssetPipeline:
+    def __init__(self, url_prefix='/assets/'):
+        self.url_prefix = url_prefix
+        self.pages = {}
+        self.assets = {}
+
+    def add_page(self, name, html):
+        """Keep a rendered page, its inline CSS and JS replaced by links to hashed assets"""
+        stem = name.rsplit('.', 1)[0]
+
+        def extract(match):
+            tag, content = match.groups()
+            extension, mimetype = ASSET_TYPES[tag]
+            data = content.encode()
+            filename = f"{stem}.{content_hash(data, 12)}.{extension}"
+            self.assets[filename] = Body(data, mimetype)
+            url = self.url_prefix + filename
+            if tag == 'style':
+                return f'<link rel="stylesheet" href="{url}">'
+            return f'<script src="{url}"></script>'
+
+        self.pages[name] = Body(INLINE_BLOCK.sub(extract, html).encode(), 'text/html')
+
+    def size(self):
+        """{encoding: bytes} over every page and asset"""
+        sizes = {}
+        for body in (*self.pages.values(), *self.assets.values()):
+            for encoding, data in body.encodings.items():
+                sizes[encoding] = sizes.get(encoding, 0) + len(data)
+        return sizes
+
+
+def gzip_json(response, accept_encodings, min_bytes=1024, level=6):
+    """Gzip a JSON response of at least min_bytes if the client takes gzip.
+
+    Streamed responses, bodies already encoded and bodiless statuses are
+    left alone. A strong ETag becomes weak, as the bytes no longer match
+    the representation it was computed from; If-None-Match still matches it.
+    """
+    if (response.mimetype != 'application/json' or response.is_streamed or response.direct_passthrough
+            or response.status_code in (204, 304) or 'Content-Encoding' in response.headers
+            or not accept_encodings['gzip']):
+        return response
+    data = response.get_data()
+    if len(data) < min_bytes:
+        return response
+    response.set_data(gzip.compress(data, level))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,268 @@
+import time
+from datetime import datetime
+
+import numpy as np
+
+# ===== PAYOUT AUDIT =====
+# Recomputes what every activation_wallet, matching_wallet and matched_pairs
+# should hold from the sponsor tree alone, with the payout rules passed in,
+# and lists the users whose stored values disagree. The tree becomes flat
+# arrays indexed by user (parent, creation time, activation time and seq,
+# first direct) and each rule is a handful of whole-array passes, so a
+# million users take seconds rather than a replay per user.
+#
+# The rules are applied as of each activation: level income to the sponsors
+# 1..30 levels up that were active before it, if their directs at the time
+# met the level's requirement, and matching on the smaller leg as the tree
+# stood at the latest activation below a member. The queue pays a little
+# after that, so a payout may also count members who joined in between;
+# every expected value is therefore a range, from "as of the activation" to
+# "as of now", and only stored values outside it are reported. Members are
+# audited on their current activation: one activated twice, or a sponsor
+# deactivated after being paid, shows up too.
+
+NEVER = np.iinfo(np.int64).min
+
+
+def _times(values):
+    """int64 microseconds for ISO strings or datetimes, NEVER where missing"""
+    values = ['NaT' if v is None or v == '' else v for v in values]
+    try:
+        parsed = np.array(values, dtype='datetime64[us]')
+    except ValueError:
+        parsed = np.array([v if v == 'NaT' or isinstance(v, datetime) else datetime.fromisoformat(v)
+                           for v in values], dtype='datetime64[us]')
+    return parsed.astype(np.int64)
+
+
+def network_arrays(users):
+    """The sponsor tree of `users` (any iterable of user mappings) as column arrays"""
+    ids, usernames, sponsors, first_directs = [], [], [], []
+    created, activated, seqs, active = [], [], [], []
+    activation_wallet, matching_wallet, matched_pairs = [], [], []
+    for u in users:
+        ids.append(u['user_id'])
+        usernames.append(u.get('username'))
+        sponsors.append(u.get('sponsor_id'))
+        directs = u.get('direct_referrals') or ()
+        first_directs.append(directs[0] if directs else None)
+        created.append(u.get('created_at'))
+        is_active = u.get('activation_status') == 'active'
+        active.append(is_active)
+        activated.append(u.get('activation_date') if is_active else None)
+        seq = u.get('activation_seq')
+        seqs.append(-1 if seq is None else seq)
+        activation_wallet.append(u.get('activation_wallet', 0))
+        matching_wallet.append(u.get('matching_wallet', 0))
+        matched_pairs.append(u.get('matched_pairs', 0))
+
+    n = len(ids)
+    index = {uid: i for i, uid in enumerate(ids)}
+    active = np.array(active, dtype=bool)
+    activated = _times(activated)
+    # An active member without a date has been active since before anything else
+    activated[active & (activated == NEVER)] = NEVER + 1
+    return {
+        'ids': ids,
+        'usernames': usernames,
+        'parent': np.fromiter((index.get(s, -1) for s in sponsors), np.int64, n),
+        'first_direct': np.fromiter((index.get(d, -1) for d in first_directs), np.int64, n),
+        'created': _times(created),
+        'active': active,
+        'activated': activated,
+        'seq': np.array(seqs, dtype=np.int64),
+        'activation_wallet': np.array(activation_wallet, dtype=np.float64),
+        'matching_wallet': np.array(matching_wallet, dtype=np.float64),
+        'matched_pairs': np.array(matched_pairs, dtype=np.float64)
+    }
+
+
+def _walk(net):
+    """Preorder, subtree sizes, depth and the latest activation (time and seq) strictly below every user.
+
+    The only per-user Python loops of the audit: a tree walk does not vectorize.
+    """
+    parent = net['parent']
+    n = len(parent)
+    children = np.argsort(parent, kind='stable')
+    first = np.searchsorted(parent[children], np.arange(n + 1))
+    children, first = children.tolist(), first.tolist()
+
+    depth = [0] * n
+    stack = np.flatnonzero(parent < 0).tolist()
+    order = []
+    while stack:
+        u = stack.pop()
+        order.append(u)
+        below = children[first[u]:first[u + 1]]
+        if below:
+            d = depth[u] + 1
+            for c in below:
+                depth[c] = d
+            stack.extend(below)
+
+    parents = parent.tolist()
+    own_time = np.where(net['active'], net['activated'], NEVER).tolist()
+    own_seq = np.where(net['active'], net['seq'], NEVER).tolist()
+    size = [1] * n
+    latest_time = [NEVER] * n
+    latest_seq = [NEVER] * n
+    for u in reversed(order):
+        p = parents[u]
+        if p >= 0:
+            size[p] += size[u]
+            t = max(latest_time[u], own_time[u])
+            if t > latest_time[p]:
+                latest_time[p] = t
+            s = max(latest_seq[u], own_seq[u])
+            if s > latest_seq[p]:
+                latest_seq[p] = s
+
+    return (np.array(order, dtype=np.int64), np.array(size, dtype=np.int64), max(depth, default=0),
+            np.array(latest_time, dtype=np.int64), np.array(latest_seq, dtype=np.int64))
+
+
+def level_income(net, level_incomes, direct_requirements):
+    """(as of each activation, as of now) level income every user should have received"""
+    parent, created, active, seq = net['parent'], net['created'], net['active'], net['seq']
+    n = len(parent)
+    has_sponsor = parent >= 0
+    directs_now = np.bincount(parent[has_sponsor], minlength=n)
+    default_requirement = max(direct_requirements.values(), default=0)
+
+    # Directs of s joined before t: children sorted by (sponsor, join rank)
+    by_created = np.argsort(created, kind='stable')
+    rank = np.empty(n, dtype=np.int64)
+    rank[by_created] = np.arange(n)
+    joined = np.sort(parent[has_sponsor] * n + rank[has_sponsor])
+
+    def directs_before(sponsors, before_rank):
+        return np.searchsorted(joined, sponsors * n + before_rank) - np.searchsorted(joined, sponsors * n)
+
+    low = np.zeros(n)
+    high = np.zeros(n)
+    members = np.flatnonzero(active & has_sponsor)
+    before_rank = np.searchsorted(created[by_created], net['activated'][members])
+    member_seq = seq[members]
+    sponsors = parent[members]
+    for level in range(1, max(level_incomes, default=0) + 1):
+        present = sponsors >= 0
+        sponsors, before_rank, member_seq = sponsors[present], before_rank[present], member_seq[present]
+        if not len(sponsors):
+            break
+        income = level_incomes.get(level, 0)
+        required = direct_requirements.get(level, default_requirement)
+        # app.is_active_at: active, and before this activation unless it predates seqs
+        paid = active[sponsors] & ((seq[sponsors] < 0) | (seq[sponsors] < member_seq))
+        paid_now = paid & (directs_now[sponsors] >= required)
+        paid_then = paid_now.copy()
+        if required > 0:
+            check = np.flatnonzero(paid_now)
+            paid_then[check] = directs_before(sponsors[check], before_rank[check]) >= required
+        low += np.bincount(sponsors[paid_then], minlength=n) * income
+        high += np.bincount(sponsors[paid_now], minlength=n) * income
+        sponsors = parent[sponsors]
+    return low, high
+
+
+def matching_pairs(net, order, size, depth, latest_time, latest_seq):
+    """(as of the latest activation below, as of now) pairs every user should have been paid for"""
+    parent, created, active, seq = net['parent'], net['created'], net['active'], net['seq']
+    n = len(parent)
+
+    # A member who joined after the latest activation below an upline was
+    # not in its legs when it was last paid. latest_time only grows going
+    # up, so those uplines are a chain starting at the member's sponsor:
+    # binary lifting finds its top, and +1 at the member with -1 at that top
+    # makes a subtree sum count, for every user, the members below it that
+    # joined after the latest activation below its sponsor.
+    top = np.arange(n)
+    jumps = np.append(parent, n)
+    jumps[jumps < 0] = n
+    guard = np.append(latest_time, np.iinfo(np.int64).max)
+    ladder = [jumps]
+    for _ in range(max(depth, 1).bit_length() - 1):
+        ladder.append(ladder[-1][ladder[-1]])
+    for step in reversed(ladder):
+        up = step[top]
+        top = np.where(guard[up] < created, up, top)
+    late = 1 - np.bincount(top, minlength=n)
+
+    preorder = np.empty(n, dtype=np.int64)
+    preorder[order] = np.arange(len(order))
+    prefix = np.concatenate(([0], np.cumsum(late[order])))
+    size_then = size - (prefix[preorder + size] - prefix[preorder])
+
+    has_sponsor = parent >= 0
+    first = net['first_direct']
+    has_directs = first >= 0
+
+    def legs(sizes):
+        total = np.bincount(parent[has_sponsor], weights=sizes[has_sponsor], minlength=n)
+        power = np.where(has_directs, sizes[first], 0)
+        return np.minimum(power, total - power)
+
+    # Matching is paid on activations below a member it was active for
+    paid = active & (latest_time != NEVER) & ((seq < 0) | (latest_seq > seq))
+    return np.where(paid, legs(size_then), 0), np.where(paid, legs(size), 0)
+
+
+def audit_payouts(users, level_incomes, direct_requirements, matching_per_pair, tolerance=0.005, limit=None):
+    """Discrepancy report of every stored wallet against the payout rules"""
+    seconds = {}
+    start = time.perf_counter()
+    net = network_arrays(users)
+    seconds['load'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    walk = _walk(net)
+    seconds['walk'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    level_low, level_high = level_income(net, level_incomes, direct_requirements)
+    seconds['level_income'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pairs_low, pairs_high = matching_pairs(net, *walk)
+    seconds['matching'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected = {
+        'activation_wallet': (level_low, level_high),
+        'matching_wallet': (pairs_low * matching_per_pair, pairs_high * matching_per_pair),
+        'matched_pairs': (pairs_low, pairs_high)
+    }
+    totals = {}
+    found = []
+    for field, (low, high) in expected.items():
+        stored = net[field]
+        difference = np.where(stored < low, stored - low, np.where(stored > high, stored - high, 0))
+        wrong = np.flatnonzero(np.abs(difference) > tolerance)
+        totals[field] = {
+            'stored': round(float(stored.sum()), 2),
+            'expected_min': round(float(low.sum()), 2),
+            'expected_max': round(float(high.sum()), 2),
+            'users_wrong': len(wrong)
+        }
+        found.extend((field, i, float(difference[i])) for i in wrong.tolist())
+    # Largest differences first; only the reported ones become dicts
+    found.sort(key=lambda f: -abs(f[2]))
+    discrepancies = [{
+        'user_id': net['ids'][i],
+        'username': net['usernames'][i],
+        'field': field,
+        'stored': float(net[field][i]),
+        'expected_min': float(expected[field][0][i]),
+        'expected_max': float(expected[field][1][i]),
+        'difference': round(difference, 2)
+    } for field, i, difference in (found[:limit] if limit is not None else found)]
+    seconds['diff'] = time.perf_counter() - start
+
+    return {
+        'users': len(net['ids']),
+        'activations': int(np.count_nonzero(net['active'] & (net['parent'] >= 0))),
+        'depth': walk[2],
+        'seconds': {k: round(v, 3) for k, v in seconds.items()},
+        'totals': totals,
+        'discrepancies': discrepancies
+    }
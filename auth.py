@@ -0,0 +1,125 @@
+import hmac
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# ===== PASSWORDS =====
+# Stored passwords are werkzeug salted hashes ("method$salt$hash"). Users
+# created before hashing still hold the plaintext; it is compared in
+# constant time and replaced by a hash on their next successful login.
+# Hashing is deliberately slow, so it runs on a small pool of threads and
+# a login storm waits for (or is refused) a slot instead of taking every
+# request thread with it. A login for a username that does not exist is
+# checked against a dummy hash, so it takes as long as a wrong password and
+# does not tell which usernames exist.
+
+HASH_PREFIXES = ('scrypt:', 'pbkdf2:')
+
+
+class HasherBusy(Exception):
+    """Raised when every hashing slot, running and waiting, is taken"""
+
+
+def is_hashed(stored):
+    return isinstance(stored, str) and stored.startswith(HASH_PREFIXES) and stored.count('$') == 2
+
+
+class PasswordHasher:
+    def __init__(self, method='scrypt:32768:8:1', workers=4, max_waiting=64):
+        self.method = method
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(workers + max_waiting)
+        self._dummy = generate_password_hash(secrets.token_hex(16), method)
+
+    def after_fork(self):
+        """A fresh pool for a forked process: the parent's threads did not come along"""
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hash')
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            return self.pool.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def hash_many(self, passwords, workers=4):
+        """Hash a batch (an import) on threads of its own, leaving the pool to logins"""
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='import-hash') as pool:
+            return list(pool.map(partial(generate_password_hash, method=self.method), passwords))
+
+    def verify(self, stored, password):
+        """Does password match the stored one? A missing stored password (unknown user) never does"""
+        if not isinstance(password, str):
+            return False
+        if not stored:
+            self._run(check_password_hash, self._dummy, password)
+            return False
+        if not is_hashed(stored):
+            return hmac.compare_digest(str(stored).encode(), password.encode())
+        return self._run(check_password_hash, stored, password)
+
+    def needs_rehash(self, stored):
+        """True for plaintext and for hashes made with another method or cost"""
+        return not is_hashed(stored) or not stored.startswith(self.method + '$')
+
+
+# ===== LOGIN THROTTLE =====
+
+class LoginThrottle:
+    """Failed logins per key in a sliding window; a key at the limit is refused until its oldest failure expires.
+
+    Only the most recent max_keys keys are remembered, so memory stays
+    bounded however many usernames or addresses are tried.
+    """
+
+    def __init__(self, max_failures=5, window=300, max_keys=100000):
+        self.max_failures = max_failures
+        self.window = window
+        self.max_keys = max_keys
+        self.failures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _recent(self, key, now):
+        attempts = self.failures.get(key)
+        if attempts is None:
+            return None
+        while attempts and attempts[0] <= now - self.window:
+            attempts.popleft()
+        if not attempts:
+            del self.failures[key]
+            return None
+        return attempts
+
+    def retry_after(self, key):
+        """Seconds until key may try again, 0 if it may now"""
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._recent(key, now)
+            if not attempts or len(attempts) < self.max_failures:
+                return 0
+            return attempts[0] + self.window - now
+
+    def failed(self, key):
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._recent(key, now)
+            if attempts is None:
+                attempts = self.failures[key] = deque(maxlen=self.max_failures)
+            attempts.append(now)
+            self.failures.move_to_end(key)
+            while len(self.failures) > self.max_keys:
+                self.failures.popitem(last=False)
+
+    def succeeded(self, key):
+        with self._lock:
+            self.failures.pop(key, None)
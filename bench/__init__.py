@@ -0,0 +1,8 @@
+"""Benchmarks for the MLM app.
+
+    python -m bench run --users 10000 --shape wide --out before.json
+    python -m bench compare before.json after.json
+
+A run generates a synthetic network in a temporary directory, loads the
+app on top of it and drives its endpoints through the Flask test client.
+"""
@@ -0,0 +1,336 @@
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from bench import generator, memory, report, shared, stress  # noqa: E402
+from bench.scenarios import SCENARIOS, Context  # noqa: E402
+
+DEFAULT_SCENARIOS = 'signup,activate,login,dashboard,dashboard_revalidate,power_leg,tree,admin_tree,team_search,admin_team_search,admin_stats,admin_users'
+
+
+def load(args, quiet):
+    """Generate the network, load the app on it in a scratch directory and start the report"""
+    workdir = tempfile.mkdtemp(prefix='mlm-bench-')
+    os.chdir(workdir)
+    os.environ['ACTIVATION_WORKERS'] = str(args.workers)
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ['STORAGE_BACKEND'] = args.backend
+    if args.backend == 'mongo':
+        os.environ['MONGO_URI'] = args.mongo_uri
+        os.environ['MONGO_DB'] = f"mlm_bench_{os.getpid()}"
+
+    start = time.perf_counter()
+    db = generator.generate(args.users, args.shape, args.active_ratio, args.max_directs, args.seed)
+    generate_seconds = time.perf_counter() - start
+    print(f"🌳 Generated {args.users} users ({args.shape}, depth {generator.tree_depth(db)}) "
+          f"in {generate_seconds:.1f}s")
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(quiet):
+        if args.backend == 'json':
+            generator.write_json_database(db, 'users_database.json', 'users_database.wal',
+                                          'users_database.ledger')
+        app_module = importlib.import_module('app')
+        app_module.wait_ready()
+        if args.backend == 'mongo':
+            members = {uid: u for uid, u in db.items() if not u.get('is_admin')}
+            generator.write_store(members, app_module.store)
+    load_seconds = time.perf_counter() - start
+
+    result = report.base_report(REPO_DIR)
+    result.update({
+        'backend': args.backend,
+        'workers': args.workers,
+        'dataset': {
+            'users': args.users,
+            'shape': args.shape,
+            'depth': generator.tree_depth(db),
+            'active_ratio': args.active_ratio,
+            'max_directs': args.max_directs,
+            'seed': args.seed,
+            'generate_seconds': round(generate_seconds, 2),
+            'load_seconds': round(load_seconds, 2)
+        }
+    })
+    return app_module, db, result
+
+
+def run(args):
+    names = [n for n in args.scenarios.split(',') if n]
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(unknown)} (choose from {', '.join(SCENARIOS)})")
+
+    quiet = open(os.devnull, 'w')
+    app_module, db, result = load(args, quiet)
+    result['scenarios'] = {}
+    ctx = Context(app_module, db, random.Random(args.seed), args.max_directs)
+    for name in names:
+        ctx.errors = 0
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(quiet):
+            latencies, extra = SCENARIOS[name](ctx, args.ops)
+        wall = time.perf_counter() - start
+        summary = report.summarize(latencies, wall, ctx.errors, extra)
+        result['scenarios'][name] = summary
+        print(f"⏱️  {name:<12} p50 {summary['p50_ms']:>9} ms  p99 {summary['p99_ms']:>9} ms  "
+              f"{summary['throughput_ops_s']:>8} ops/s  errors {summary['errors']}")
+
+    result['peak_rss_mb'] = report.peak_rss_mb()
+    print(f"📈 Peak RSS {result['peak_rss_mb']} MB")
+    out = os.path.join(args.cwd, args.out)
+    report.write_report(result, out)
+    print(f"💾 Report written to {out}")
+
+
+def stress_run(args):
+    quiet = open(os.devnull, 'w')
+    app_module, db, result = load(args, quiet)
+    ctx = Context(app_module, db, random.Random(args.seed), args.max_directs)
+    with contextlib.redirect_stdout(quiet):
+        result.update(stress.stress(ctx, args.threads, args.sponsors, args.signups, args.activations))
+
+    signup, activate = result['signup'], result['activate']
+    print(f"👥 {signup['attempts']} signups on {signup['sponsors']} sponsors from {args.threads} threads: "
+          f"{signup['created']} created in {signup['seconds']}s {signup['statuses']}")
+    print(f"⚡ {activate['attempts']} activations of {activate['users']} users: {activate['statuses']} "
+          f"in {activate['seconds']}s, queue drained in {result['drain_seconds']}s")
+    for failure in signup['failures'] + activate['failures']:
+        print(f"❌ {failure}")
+    for violation in result['violations'][:20]:
+        print(f"❌ {violation}")
+    out = os.path.join(args.cwd, args.out)
+    report.write_report(result, out)
+    print(f"💾 Report written to {out}")
+    if result['violations'] or signup['failures'] or activate['failures']:
+        sys.exit(f"{len(result['violations'])} violations")
+    print(f"✅ No violations ({result['concurrency_mode']} mode)")
+
+
+def shared_run(args):
+    if args.backend != 'json':
+        sys.exit('A shared database is a JSON one')
+    os.environ['SHARED_DATABASE'] = '1'
+    quiet = open(os.devnull, 'w')
+    app_module, db, result = load(args, quiet)
+    ctx = Context(app_module, db, random.Random(args.seed), args.max_directs)
+    with contextlib.redirect_stdout(quiet):
+        result.update(shared.shared(ctx, args.procs, args))
+
+    failures = []
+    if 'workers' in result:
+        signup, activate = result['signup'], result['activate']
+        print(f"👥 {signup['attempts']} signups and {activate['attempts']} activations from {args.procs} "
+              f"workers x {args.threads} threads in {result['storm_seconds']}s: {signup['created']} created, "
+              f"{activate['activated']} activated")
+        print(f"🧠 master   rss {result['master_memory']['rss_mb']:>7} MB")
+        for i, w in enumerate(result['workers']):
+            print(f"🧠 worker {i} rss {w['memory']['rss_mb']:>7} MB  pss {w['memory']['pss_mb']:>7} MB  "
+                  f"uss {w['memory']['uss_mb']:>7} MB  shared {w['memory']['shared_mb']:>7} MB")
+        failures = signup['failures'] + activate['failures']
+    for failure in failures:
+        print(f"❌ {failure}")
+    for violation in result['violations'][:20]:
+        print(f"❌ {violation}")
+    out = os.path.join(args.cwd, args.out)
+    report.write_report(result, out)
+    print(f"💾 Report written to {out}")
+    if result['violations'] or failures:
+        sys.exit(f"{len(result['violations'])} violations")
+    print(f"✅ Every worker holds the same network, no violations ({result['concurrency_mode']} mode)")
+
+
+def memory_run(args):
+    workdir = tempfile.mkdtemp(prefix='mlm-bench-')
+    snapshot_file = os.path.join(workdir, 'users_database.json')
+    db = generator.generate(args.users, args.shape, args.active_ratio, args.max_directs, args.seed)
+    generator.write_json_database(db, snapshot_file, os.path.join(workdir, 'users_database.wal'),
+                                  os.path.join(workdir, 'users_database.ledger'))
+    del db
+    print(f"🌳 Generated {args.users} users ({args.shape}), snapshot "
+          f"{os.path.getsize(snapshot_file) / 2 ** 20:.1f} MB")
+
+    result = report.base_report(REPO_DIR)
+    result.update({
+        'dataset': {'users': args.users, 'shape': args.shape, 'active_ratio': args.active_ratio,
+                    'seed': args.seed},
+        'layouts': memory.measure(snapshot_file)
+    })
+    for layout, figures in result['layouts'].items():
+        print(f"🧠 {layout:<7} {figures['mb']:>8} MB  {figures['bytes_per_user']:>6} B/user  "
+              f"load {figures['load_seconds']}s  scan {figures['scan_seconds']}s")
+    out = os.path.join(args.cwd, args.out)
+    report.write_report(result, out)
+    print(f"💾 Report written to {out}")
+
+
+def audit_run(args):
+    workdir = tempfile.mkdtemp(prefix='mlm-bench-')
+    os.chdir(workdir)
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    db = generator.generate(args.users, args.shape, args.active_ratio, args.max_directs, args.seed)
+    print(f"🌳 Generated {args.users} users ({args.shape}, depth {generator.tree_depth(db)})")
+    # Only for the payout rules; the app loads an empty database here
+    app_module = importlib.import_module('app')
+    from audit import audit_payouts
+
+    result = report.base_report(REPO_DIR)
+    result['dataset'] = {'users': args.users, 'shape': args.shape, 'active_ratio': args.active_ratio,
+                         'seed': args.seed}
+    result['audit'] = audit_payouts(db.values(), app_module.LEVEL_INCOME, app_module.DIRECT_REQUIREMENTS,
+                                    app_module.MATCHING_PER_PAIR, limit=args.limit)
+    seconds = result['audit']['seconds']
+    print(f"🔎 Audited {result['audit']['users']} users in {sum(seconds.values()):.2f}s "
+          f"({', '.join(f'{k} {v}s' for k, v in seconds.items())})")
+    for field, totals in result['audit']['totals'].items():
+        print(f"💰 {field:<17} stored {totals['stored']:>14}  expected {totals['expected_min']:>14}"
+              f"..{totals['expected_max']:<14} {totals['users_wrong']} users wrong")
+    result['peak_rss_mb'] = report.peak_rss_mb()
+    print(f"📈 Peak RSS {result['peak_rss_mb']} MB")
+    out = os.path.join(args.cwd, args.out)
+    report.write_report(result, out)
+    print(f"💾 Report written to {out}")
+
+
+def import_run(args):
+    workdir = tempfile.mkdtemp(prefix='mlm-bench-')
+    os.chdir(workdir)
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ['STORAGE_BACKEND'] = args.backend
+    if args.backend == 'mongo':
+        os.environ['MONGO_URI'] = args.mongo_uri
+        os.environ['MONGO_DB'] = f"mlm_bench_{os.getpid()}"
+    db = generator.generate(args.users, args.shape, args.active_ratio, args.max_directs, args.seed)
+    path = os.path.join(workdir, 'members.csv')
+    rows = generator.write_import_file(db, path, args.shuffle, args.plaintext, args.seed)
+    print(f"🌳 Wrote {rows} members ({args.shape}, depth {generator.tree_depth(db)}"
+          f"{', shuffled' if args.shuffle else ''}) to {path}")
+
+    quiet = open(os.devnull, 'w')
+    with contextlib.redirect_stdout(quiet):
+        app_module = importlib.import_module('app')
+        app_module.wait_ready()
+    from importer import read_rows
+
+    result = report.base_report(REPO_DIR)
+    result['dataset'] = {'users': args.users, 'shape': args.shape, 'shuffle': args.shuffle,
+                         'plaintext': args.plaintext, 'seed': args.seed}
+    result['backend'] = args.backend
+    with open(path, newline='') as f, contextlib.redirect_stdout(quiet):
+        imported = app_module.import_members(read_rows(f, 'csv'))
+    result['import'] = dict(imported, rejected=imported['rejected'][:100])
+    print(f"📥 Imported {imported['imported']} of {imported['rows']} rows, {len(imported['rejected'])} rejected, "
+          f"{imported['users_per_second']} users/s ({imported['seconds']})")
+    result['peak_rss_mb'] = report.peak_rss_mb()
+    print(f"📈 Peak RSS {result['peak_rss_mb']} MB")
+    out = os.path.join(args.cwd, args.out)
+    report.write_report(result, out)
+    print(f"💾 Report written to {out}")
+
+
+def compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    regressions = report.compare(old, new, args.threshold)
+    sys.exit(1 if regressions else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench', description='MLM app benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def add_network_arguments(sub, users, workers):
+        sub.add_argument('--users', type=int, default=users)
+        sub.add_argument('--shape', choices=generator.SHAPES, default='wide')
+        sub.add_argument('--active-ratio', type=float, default=0.6)
+        sub.add_argument('--max-directs', type=int, default=generator.MAX_DIRECTS)
+        sub.add_argument('--seed', type=int, default=1)
+        sub.add_argument('--backend', choices=('json', 'mongo'), default='json')
+        sub.add_argument('--mongo-uri', default='mongomock://')
+        sub.add_argument('--workers', type=int, default=workers,
+                         help='ACTIVATION_WORKERS; 0 pays activations inline')
+
+    run_parser = commands.add_parser('run', help='Generate a network and time the scenarios against it')
+    add_network_arguments(run_parser, 10000, 0)
+    run_parser.add_argument('--ops', type=int, default=200, help='Timed calls per scenario')
+    run_parser.add_argument('--scenarios', default=DEFAULT_SCENARIOS)
+    run_parser.add_argument('--out', default='bench_report.json')
+    run_parser.set_defaults(func=run, cwd=os.getcwd())
+
+    stress_parser = commands.add_parser('stress', help='Race signups and activations from many threads '
+                                                       'and check the network stays consistent')
+    add_network_arguments(stress_parser, 500, 2)
+    stress_parser.add_argument('--threads', type=int, default=8)
+    stress_parser.add_argument('--sponsors', type=int, default=5, help='Sponsors every signup thread targets')
+    stress_parser.add_argument('--signups', type=int, default=10, help='Signups per thread')
+    stress_parser.add_argument('--activations', type=int, default=40, help='Users every thread tries to activate')
+    stress_parser.add_argument('--out', default='stress_report.json')
+    stress_parser.set_defaults(func=stress_run, cwd=os.getcwd())
+
+    shared_parser = commands.add_parser('shared', help='Race signups and activations from workers forked '
+                                                       'on a shared database, check they agree and take '
+                                                       'their memory')
+    add_network_arguments(shared_parser, 100000, 2)
+    shared_parser.add_argument('--procs', type=int, default=4, help='Forked workers')
+    shared_parser.add_argument('--threads', type=int, default=4, help='Threads in every worker')
+    shared_parser.add_argument('--sponsors', type=int, default=5, help='Sponsors every signup thread targets')
+    shared_parser.add_argument('--signups', type=int, default=10, help='Signups per thread')
+    shared_parser.add_argument('--activations', type=int, default=20,
+                               help='Users every thread of every worker tries to activate')
+    shared_parser.add_argument('--ops', type=int, default=50, help='Calls per read scenario in every worker')
+    shared_parser.add_argument('--out', default='shared_report.json')
+    shared_parser.set_defaults(func=shared_run, cwd=os.getcwd())
+
+    memory_parser = commands.add_parser('memory', help='Compare the memory of the dict and record user layouts')
+    memory_parser.add_argument('--users', type=int, default=100000)
+    memory_parser.add_argument('--shape', choices=generator.SHAPES, default='wide')
+    memory_parser.add_argument('--active-ratio', type=float, default=0.6)
+    memory_parser.add_argument('--max-directs', type=int, default=generator.MAX_DIRECTS)
+    memory_parser.add_argument('--seed', type=int, default=1)
+    memory_parser.add_argument('--out', default='memory_report.json')
+    memory_parser.set_defaults(func=memory_run, cwd=os.getcwd())
+
+    audit_parser = commands.add_parser('audit', help='Time the payout audit on a generated network '
+                                                     '(which holds no payouts, so every paid member differs)')
+    audit_parser.add_argument('--users', type=int, default=1000000)
+    audit_parser.add_argument('--shape', choices=generator.SHAPES, default='wide')
+    audit_parser.add_argument('--active-ratio', type=float, default=0.6)
+    audit_parser.add_argument('--max-directs', type=int, default=generator.MAX_DIRECTS)
+    audit_parser.add_argument('--seed', type=int, default=1)
+    audit_parser.add_argument('--limit', type=int, default=100, help='Discrepancies kept in the report')
+    audit_parser.add_argument('--out', default='audit_report.json')
+    audit_parser.set_defaults(func=audit_run, cwd=os.getcwd())
+
+    import_parser = commands.add_parser('import', help='Time a bulk import of a generated network into an '
+                                                       'empty app')
+    add_network_arguments(import_parser, 100000, 0)
+    import_parser.add_argument('--shuffle', action='store_true', help='Rows in random order, not sponsors first')
+    import_parser.add_argument('--plaintext', action='store_true',
+                               help='Plaintext passwords, so the import hashes every one')
+    import_parser.add_argument('--out', default='import_report.json')
+    import_parser.set_defaults(func=import_run, cwd=os.getcwd())
+
+    compare_parser = commands.add_parser('compare', help='Compare two reports')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.2,
+                                help='Relative p99 increase reported as a regression')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
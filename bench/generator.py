@@ -0,0 +1,209 @@
+import csv
+import random
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+from storage import JsonStore, recompute_team_counts, sponsor_order
+from importer import IMPORT_FIELDS
+
+# ===== SYNTHETIC NETWORKS =====
+# Users are plain dicts shaped like the ones app.create_user stores, so a
+# generated database loads exactly like a production one. Every shape
+# respects max_directs.
+
+SHAPES = ('wide', 'deep', 'skewed')
+MAX_DIRECTS = 12  # app.MAX_DIRECTS
+PASSWORD = 'bench-pw'
+# One salted hash shared by every member keeps generation fast; logins
+# still pay the full verification cost
+PASSWORD_HASH = generate_password_hash(PASSWORD)
+ADMIN_PASSWORD_HASH = generate_password_hash('admin123')
+ADMIN_ID = 'admin-1'
+ADMIN_CODE = 'ADMIN123'
+
+
+def make_user(i, sponsor_id, created_at, active):
+    return {
+        "user_id": f"bench-{i}",
+        "username": f"bench{i}",
+        "password": PASSWORD_HASH,
+        "email": f"bench{i}@example.com",
+        "first_name": "Bench",
+        "last_name": str(i),
+        "dob": "1990-01-01",
+        "country": "India",
+        "mobile": "9999999999",
+        "state": "",
+        "country_code": "+91",
+        "is_admin": False,
+        "status": "active",
+        "activation_status": "active" if active else "inactive",
+        "activation_date": created_at if active else None,
+        "activation_cost": 100,
+        "created_at": created_at,
+        "wallet_balance": 0,
+        "activation_wallet": 0,
+        "matching_wallet": 0,
+        "referral_code": f"B{i:08d}",
+        "sponsor_id": sponsor_id,
+        "direct_referrals": [],
+        "power_leg_user": None,
+        "other_leg_users": [],
+        "matched_pairs": 0,
+        "total_income": 0,
+        "commission_received": 0
+    }
+
+
+def make_admin(created_at):
+    return {
+        "user_id": ADMIN_ID,
+        "username": "admin",
+        "password": ADMIN_PASSWORD_HASH,
+        "email": "admin@tradeera.com",
+        "first_name": "Admin",
+        "last_name": "User",
+        "is_admin": True,
+        "status": "active",
+        "activation_status": "active",
+        "activation_date": created_at,
+        "created_at": created_at,
+        "wallet_balance": 0,
+        "activation_wallet": 0,
+        "matching_wallet": 0,
+        "referral_code": ADMIN_CODE,
+        "sponsor_id": None,
+        "direct_referrals": [],
+        "power_leg_user": None,
+        "other_leg_users": [],
+        "matched_pairs": 0,
+        "total_income": 0,
+        "commission_received": 0,
+        "phone": "",
+        "country": "India",
+        "state": "",
+        "dob": ""
+    }
+
+
+class SponsorPicker:
+    """Chooses the sponsor of each new member for one tree shape"""
+
+    def __init__(self, shape, rng, max_directs):
+        if shape not in SHAPES:
+            raise ValueError(f"shape must be one of {', '.join(SHAPES)}")
+        self.shape = shape
+        self.rng = rng
+        self.max_directs = max_directs
+        self.directs = {}
+        self.ids = []
+        self.next_open = 0
+        # skewed: one ticket per member plus one per recruit, so members
+        # who already recruit a lot are picked more often
+        self.tickets = []
+
+    def add(self, user_id):
+        self.directs[user_id] = 0
+        self.ids.append(user_id)
+        self.tickets.append(user_id)
+
+    def _has_room(self, user_id):
+        return self.directs[user_id] < self.max_directs
+
+    def pick(self):
+        if self.shape == 'wide':
+            # Fill the tree level by level
+            while not self._has_room(self.ids[self.next_open]):
+                self.next_open += 1
+            sponsor_id = self.ids[self.next_open]
+        elif self.shape == 'deep':
+            # Mostly a chain, with short side branches off recent members
+            sponsor_id = self.ids[-1]
+            if self.rng.random() < 0.1:
+                sponsor_id = self.rng.choice(self.ids[-50:])
+            while not self._has_room(sponsor_id):
+                sponsor_id = self.rng.choice(self.ids[-50:])
+        else:
+            while True:
+                sponsor_id = self.rng.choice(self.tickets)
+                if self._has_room(sponsor_id):
+                    break
+            self.tickets.append(sponsor_id)
+        self.directs[sponsor_id] += 1
+        return sponsor_id
+
+
+def generate(users, shape='wide', active_ratio=0.6, max_directs=MAX_DIRECTS, seed=1):
+    """Return {user_id: user} with the admin and `users` members below it"""
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    admin = make_admin(start.isoformat())
+    db = {ADMIN_ID: admin}
+    picker = SponsorPicker(shape, rng, max_directs)
+    picker.add(ADMIN_ID)
+
+    for i in range(users):
+        sponsor_id = picker.pick()
+        created_at = (start + timedelta(seconds=i)).isoformat()
+        user = make_user(i, sponsor_id, created_at, rng.random() < active_ratio)
+        db[user['user_id']] = user
+        sponsor = db[sponsor_id]
+        sponsor['direct_referrals'].append(user['user_id'])
+        picker.add(user['user_id'])
+
+    for user in db.values():
+        directs = user['direct_referrals']
+        user['power_leg_user'] = directs[0] if directs else None
+        user['other_leg_users'] = directs[1:]
+    recompute_team_counts(db)
+    return db
+
+
+def tree_depth(db):
+    depth = {}
+    for uid in sponsor_order(db):
+        sponsor_id = db[uid].get('sponsor_id')
+        depth[uid] = depth[sponsor_id] + 1 if sponsor_id in depth else 0
+    return max(depth.values(), default=0)
+
+
+def write_json_database(db, db_file, wal_file=None, ledger_file=None):
+    """Write db as the snapshot JsonStore loads on startup"""
+    store = JsonStore(db_file, wal_file, ledger_file=ledger_file)
+    store.load()
+    store.db = db
+    store.snapshot()
+
+
+def write_store(db, store):
+    """Insert db into any Store, sponsors first"""
+    for uid in sponsor_order(db):
+        user = db[uid]
+        # insert_user links the directs and bumps the counters itself
+        store.insert_user(dict(
+            user, direct_referrals=[], power_leg_user=None, other_leg_users=[], team_size=1,
+            active_team_size=1 if user['activation_status'] == 'active' else 0
+        ))
+    store.commit()
+
+
+def write_import_file(db, path, shuffle=False, plaintext=False, seed=1):
+    """Write the members of db as an import CSV, sponsors named by username.
+
+    shuffle puts the rows in random order, so most sponsors come after
+    their directs; plaintext gives every row PASSWORD instead of its hash.
+    """
+    users = [u for u in db.values() if not u.get('is_admin')]
+    if shuffle:
+        random.Random(seed).shuffle(users)
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, IMPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for u in users:
+            sponsor = db[u['sponsor_id']]
+            writer.writerow(dict(
+                u, password=PASSWORD if plaintext else u['password'],
+                sponsor=ADMIN_CODE if sponsor.get('is_admin') else sponsor['username']
+            ))
+    return len(users)
@@ -0,0 +1,55 @@
+import gc
+import json
+import time
+import tracemalloc
+
+from records import compact_users, user_record_hook
+from storage import compute_stats
+
+# ===== MEMORY =====
+# Loads the same snapshot once per layout: the plain dicts json produces and
+# the compact records JsonStore keeps. Memory is what tracemalloc still sees
+# allocated once the users are loaded; timings come from a second, untraced
+# load plus a scan reading every user's stat fields.
+
+LAYOUTS = ('dict', 'record')
+
+
+def load_users(snapshot_file, layout):
+    with open(snapshot_file) as f:
+        if layout == 'dict':
+            return json.load(f)['users']
+        return compact_users(json.load(f, object_hook=user_record_hook)['users'])
+
+
+def measure(snapshot_file):
+    results = {}
+    for layout in LAYOUTS:
+        gc.collect()
+        tracemalloc.start()
+        users = load_users(snapshot_file, layout)
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        count = len(users)
+        del users
+        gc.collect()
+
+        start = time.perf_counter()
+        users = load_users(snapshot_file, layout)
+        load_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        compute_stats(users.values())
+        scan_seconds = time.perf_counter() - start
+        del users
+        gc.collect()
+
+        results[layout] = {
+            'users': count,
+            'mb': round(current / 2 ** 20, 1),
+            'peak_mb': round(peak / 2 ** 20, 1),
+            'bytes_per_user': round(current / count) if count else 0,
+            'load_seconds': round(load_seconds, 3),
+            'scan_seconds': round(scan_seconds, 3)
+        }
+    return results
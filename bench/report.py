@@ -0,0 +1,87 @@
+import json
+import platform
+import resource
+import subprocess
+import sys
+from datetime import datetime
+
+# ===== REPORTS =====
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(latencies, wall_seconds, errors=0, extra=None):
+    values = sorted(latencies)
+    summary = {
+        'ops': len(values),
+        'errors': errors,
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+        'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+        'max_ms': round(values[-1] * 1000, 3) if values else 0.0,
+        'throughput_ops_s': round(len(values) / wall_seconds, 1) if wall_seconds else 0.0,
+    }
+    summary.update(extra or {})
+    return summary
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def git_commit(repo_dir):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_dir,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+def base_report(repo_dir):
+    return {
+        'commit': git_commit(repo_dir),
+        'created_at': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+    }
+
+
+def write_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def compare(old, new, threshold=0.2):
+    """Print p50/p99/throughput changes between two reports, returns the regressed scenarios"""
+    print(f"old: {old.get('commit')} {old.get('dataset')}")
+    print(f"new: {new.get('commit')} {new.get('dataset')}")
+    print(f"{'scenario':<14}{'p50 ms':>22}{'p99 ms':>22}{'ops/s':>22}")
+    regressions = []
+    for name, after in new['scenarios'].items():
+        before = old['scenarios'].get(name)
+        if not before:
+            continue
+        cells = []
+        for field in ('p50_ms', 'p99_ms', 'throughput_ops_s'):
+            change = (after[field] - before[field]) / before[field] if before[field] else 0.0
+            cells.append(f"{before[field]:>9} -> {after[field]:<9}{change:+.0%}".rjust(22))
+        print(f"{name:<14}{''.join(cells)}")
+        if before['p99_ms'] and (after['p99_ms'] - before['p99_ms']) / before['p99_ms'] > threshold:
+            regressions.append(name)
+    old_rss, new_rss = old.get('peak_rss_mb'), new.get('peak_rss_mb')
+    print(f"peak RSS: {old_rss} MB -> {new_rss} MB")
+    if regressions:
+        print(f"⚠️  p99 regressed by more than {threshold:.0%}: {', '.join(regressions)}")
+    return regressions
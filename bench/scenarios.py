@@ -0,0 +1,162 @@
+import time
+
+from bench.generator import PASSWORD
+
+# ===== SCENARIOS =====
+# Each scenario drives the loaded app through its public endpoints (or, for
+# calculate_power_leg, the function itself) `ops` times and returns the
+# latency of every timed call in seconds plus any extra figures. Logging in
+# is part of the setup and never timed.
+
+
+class Context:
+    """The loaded app module plus what a scenario needs to know about the generated network"""
+
+    def __init__(self, app_module, db, rng, max_directs):
+        self.app = app_module
+        self.rng = rng
+        self.max_directs = max_directs
+        self.member_ids = [uid for uid, u in db.items() if not u.get('is_admin')]
+        self.inactive_ids = [uid for uid in self.member_ids if db[uid]['activation_status'] != 'active']
+        self.usernames = {uid: db[uid]['username'] for uid in self.member_ids}
+        self.open_codes = [u['referral_code'] for u in db.values()
+                           if len(u.get('direct_referrals', [])) < max_directs]
+        self.errors = 0
+
+    def client(self, user_id=None):
+        """A test client logged in as user_id (the admin if None)"""
+        client = self.app.app.test_client()
+        if user_id is None:
+            credentials = {'username': 'admin', 'password': 'admin123'}
+        else:
+            credentials = {'username': self.usernames[user_id], 'password': PASSWORD}
+        client.post('/api/auth/login', json=credentials)
+        return client
+
+    def sample(self, ids, count):
+        return [self.rng.choice(ids) for _ in range(count)] if ids else []
+
+    def timed(self, call):
+        start = time.perf_counter()
+        response = call()
+        elapsed = time.perf_counter() - start
+        if getattr(response, 'status_code', 200) >= 400:
+            self.errors += 1
+        return elapsed
+
+
+def signup(ctx, ops):
+    client = ctx.app.app.test_client()
+    latencies = []
+    for i in range(ops):
+        code = ctx.rng.choice(ctx.open_codes)
+        latencies.append(ctx.timed(lambda: client.post('/api/auth/signup', json={
+            'username': f'new{i}', 'password': 'bench-pw', 'email': f'new{i}@example.com',
+            'first_name': 'New', 'last_name': str(i), 'dob': '1990-01-01', 'country': 'India',
+            'mobile': '9999999999', 'state': 'S', 'referral_code': code
+        })))
+    return latencies, {}
+
+
+def activate(ctx, ops):
+    """User activations; drain_seconds is how long the queue then takes to pay everything out"""
+    user_ids = ctx.inactive_ids[:ops]
+    del ctx.inactive_ids[:ops]
+    latencies = []
+    for user_id in user_ids:
+        client = ctx.client(user_id)
+        latencies.append(ctx.timed(lambda: client.post('/api/user/activate', json={'payment_status': 'success'})))
+    start = time.perf_counter()
+    queue = ctx.app.activation_queue
+    while queue.stats()['depth']:
+        time.sleep(0.01)
+    return latencies, {'drain_seconds': time.perf_counter() - start}
+
+
+def login(ctx, ops):
+    client = ctx.app.app.test_client()
+    return [ctx.timed(lambda: client.post('/api/auth/login', json={
+        'username': ctx.usernames[uid], 'password': PASSWORD
+    })) for uid in ctx.sample(ctx.member_ids, ops)], {}
+
+
+def dashboard(ctx, ops):
+    clients = [ctx.client(uid) for uid in ctx.sample(ctx.member_ids, min(ops, 50))]
+    return [ctx.timed(lambda: clients[i % len(clients)].get('/api/user/dashboard')) for i in range(ops)], {}
+
+
+def dashboard_revalidate(ctx, ops):
+    """Dashboard polls sending back the ETag of the previous answer; not_modified counts the 304s"""
+    clients = [ctx.client(uid) for uid in ctx.sample(ctx.member_ids, min(ops, 50))]
+    etags = {}
+    not_modified = 0
+
+    def poll(index):
+        nonlocal not_modified
+        response = clients[index].get('/api/user/dashboard', headers={'If-None-Match': etags.get(index, '')})
+        if response.status_code == 304:
+            not_modified += 1
+        etags[index] = response.headers.get('ETag', '')
+        return response
+
+    latencies = [ctx.timed(lambda: poll(i % len(clients))) for i in range(ops)]
+    return latencies, {'not_modified': not_modified}
+
+
+def power_leg(ctx, ops):
+    store = ctx.app.store
+    return [ctx.timed(lambda: ctx.app.calculate_power_leg(uid, store))
+            for uid in ctx.sample(ctx.member_ids, ops)], {}
+
+
+def tree(ctx, ops):
+    clients = [ctx.client(uid) for uid in ctx.sample(ctx.member_ids, min(ops, 50))]
+    return [ctx.timed(lambda: clients[i % len(clients)].get('/api/user/tree')) for i in range(ops)], {}
+
+
+def admin_tree(ctx, ops):
+    client = ctx.client()
+    return [ctx.timed(lambda: client.get('/api/user/tree')) for _ in range(ops)], {}
+
+
+# Generated members are bench<i> named Bench <i>
+SEARCH_PREFIXES = ('bench1', 'bench42', 'bench 7', '3', 'b')
+
+
+def team_search(ctx, ops):
+    clients = [ctx.client(uid) for uid in ctx.sample(ctx.member_ids, min(ops, 50))]
+    return [ctx.timed(lambda: clients[i % len(clients)].get('/api/user/team/search', query_string={
+        'q': SEARCH_PREFIXES[i % len(SEARCH_PREFIXES)]})) for i in range(ops)], {}
+
+
+def admin_team_search(ctx, ops):
+    client = ctx.client()
+    return [ctx.timed(lambda: client.get('/api/user/team/search', query_string={
+        'q': SEARCH_PREFIXES[i % len(SEARCH_PREFIXES)], 'min_level': 2, 'activation_status': 'active'
+    })) for i in range(ops)], {}
+
+
+def admin_stats(ctx, ops):
+    client = ctx.client()
+    return [ctx.timed(lambda: client.get('/api/admin/stats')) for _ in range(ops)], {}
+
+
+def admin_users(ctx, ops):
+    client = ctx.client()
+    return [ctx.timed(lambda: client.get('/api/admin/users?limit=100')) for _ in range(ops)], {}
+
+
+SCENARIOS = {
+    'signup': signup,
+    'activate': activate,
+    'login': login,
+    'dashboard': dashboard,
+    'dashboard_revalidate': dashboard_revalidate,
+    'power_leg': power_leg,
+    'tree': tree,
+    'admin_tree': admin_tree,
+    'team_search': team_search,
+    'admin_team_search': admin_team_search,
+    'admin_stats': admin_stats,
+    'admin_users': admin_users,
+}
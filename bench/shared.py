@@ -0,0 +1,151 @@
+import hashlib
+import json
+import multiprocessing
+import time
+
+from bench import stress
+from bench.scenarios import SCENARIOS
+from records import json_default
+
+# ===== SHARED DATABASE =====
+# Forks workers from a process that loaded the app on a shared JSON database,
+# the way a preloaded gunicorn master does, and races the stress storms
+# between them: every worker makes the same signups onto the same sponsors
+# and activates the same users. Each also signs up a member that all the
+# others then log in as. Memory is taken from smaps_rollup after a round of
+# reads in every worker: pss counts shared pages once across the processes
+# sharing them, uss is what the worker holds alone. Once every worker is
+# done (logins write too) each must hold the same network as the parent,
+# which is then checked like a stress run.
+
+READ_SCENARIOS = ('dashboard', 'tree', 'admin_stats')
+PROBE_PASSWORD = 'shared-pw'
+
+
+def memory(pid='self'):
+    """rss, pss, uss and shared MB of a process"""
+    kb = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                kb[parts[0].rstrip(':')] = int(parts[1])
+    return {
+        'rss_mb': round(kb['Rss'] / 1024, 1),
+        'pss_mb': round(kb['Pss'] / 1024, 1),
+        'uss_mb': round((kb['Private_Clean'] + kb['Private_Dirty']) / 1024, 1),
+        'shared_mb': round((kb['Shared_Clean'] + kb['Shared_Dirty']) / 1024, 1)
+    }
+
+
+def digest(store):
+    """Fingerprint of every user, equal in processes holding the same network"""
+    h = hashlib.sha256()
+    for user in sorted(store.iter_users(), key=lambda u: u['user_id']):
+        h.update(json.dumps(user, sort_keys=True, default=json_default).encode())
+    return h.hexdigest()
+
+
+def drain(app, timeout=120):
+    """Wait until no process has an activation left to pay"""
+    start = time.perf_counter()
+    while True:
+        app.store.refresh()
+        if not app.activation_queue.stats()['depth']:
+            return time.perf_counter() - start
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError('activation queue did not drain')
+        time.sleep(0.01)
+
+
+def worker(ctx, index, procs, args, results, phases):
+    """Puts one result per phase: the storms, the reads, the digest"""
+    app = ctx.app
+    app.after_fork()
+    result = {'index': index}
+    phase = 0
+    try:
+        result['signup'] = stress.signup_storm(ctx, args.threads, args.sponsors, args.signups)
+        result['activate'], _, result['activated'] = stress.activation_storm(ctx, args.threads, args.activations)
+        app.app.test_client().post('/api/auth/signup', json={
+            'username': f'shared{index}', 'password': PROBE_PASSWORD, 'email': f'shared{index}@example.com',
+            'first_name': 'Shared', 'last_name': str(index), 'dob': '1990-01-01', 'country': 'India',
+            'mobile': '9999999999', 'state': 'S', 'referral_code': ctx.open_codes[-1 - index]
+        })
+        results.put(result)
+        phase += 1
+
+        phases[0].wait()
+        result = {'index': index, 'drain_seconds': round(drain(app), 3)}
+        client = app.app.test_client()
+        result['probe_logins_failed'] = sum(
+            client.post('/api/auth/login', json={'username': f'shared{i}', 'password': PROBE_PASSWORD})
+            .status_code != 200 for i in range(procs) if i != index)
+        for name in READ_SCENARIOS:
+            SCENARIOS[name](ctx, args.ops)
+        result['memory'] = memory()
+        results.put(result)
+        phase += 1
+
+        phases[1].wait()
+        app.store.refresh()
+        results.put({'index': index, 'digest': digest(app.store)})
+    except Exception as e:
+        for _ in range(phase, len(phases) + 1):
+            results.put({'index': index, 'error': repr(e)})
+
+
+def shared(ctx, procs, args):
+    app = ctx.app
+    targets = ctx.inactive_ids[:args.activations]
+    before = {uid: app.store.get_user(uid).get('wallet_balance', 0) for uid in targets}
+    result = {'procs': procs, 'threads': args.threads, 'concurrency_mode': app.CONCURRENCY_MODE,
+              'master_memory': memory()}
+
+    fork = multiprocessing.get_context('fork')
+    results = fork.Queue()
+    phases = [fork.Event(), fork.Event()]
+    workers = [fork.Process(target=worker, args=(ctx, i, procs, args, results, phases)) for i in range(procs)]
+    start = time.perf_counter()
+    for p in workers:
+        p.start()
+    ran = [results.get() for _ in workers]
+    result['storm_seconds'] = round(time.perf_counter() - start, 3)
+    phases[0].set()
+    read = sorted((results.get() for _ in workers), key=lambda r: r['index'])
+    phases[1].set()
+    done = sorted((results.get() for _ in workers), key=lambda r: r['index'])
+    for p in workers:
+        p.join()
+    errors = [{'check': 'worker_error', 'worker': r['index'], 'error': r['error']}
+              for r in ran + read + done if 'error' in r]
+    if errors:
+        result['violations'] = errors
+        return result
+
+    activated = {uid: sum(r['activated'][uid] for r in ran) for uid in targets}
+    result['signup'] = {
+        'attempts': sum(r['signup']['attempts'] for r in ran),
+        'created': sum(r['signup']['created'] for r in ran),
+        'failures': [f for r in ran for f in r['signup']['failures']]
+    }
+    result['activate'] = {
+        'attempts': sum(r['activate']['attempts'] for r in ran),
+        'activated': sum(activated.values()),
+        'failures': [f for r in ran for f in r['activate']['failures']]
+    }
+    result['workers'] = [{k: r.get(k) for k in ('drain_seconds', 'probe_logins_failed', 'memory')} for r in read]
+
+    app.store.refresh()
+    expected = digest(app.store)
+    violations = [{'check': 'same_network', 'worker': r['index']} for r in done if r['digest'] != expected]
+    violations.extend({'check': 'read_after_write', 'worker': r['index'], 'failed': r['probe_logins_failed']}
+                      for r in read if r.get('probe_logins_failed'))
+    usernames = {}
+    for user in app.store.iter_users():
+        usernames[user['username'].lower()] = usernames.get(user['username'].lower(), 0) + 1
+    violations.extend({'check': 'unique_username', 'username': name, 'users': count}
+                      for name, count in usernames.items() if count > 1)
+    violations.extend(stress.check(ctx, ctx.max_directs, before, activated))
+    result['violations'] = violations
+    return result
@@ -0,0 +1,150 @@
+import math
+import random
+import threading
+import time
+
+# ===== STRESS =====
+# Many threads race each other through the public endpoints: signups onto
+# the same few sponsors and repeated activations of the same users, by the
+# users themselves and by the admin. Once the activation queue has drained
+# the network is checked for what a lost race would leave behind.
+
+
+def _storm(threads, work):
+    """Run work(thread_index) on `threads` threads released together"""
+    barrier = threading.Barrier(threads)
+    failures = []
+
+    def target(index):
+        barrier.wait()
+        try:
+            work(index)
+        except Exception as e:
+            failures.append(repr(e))
+
+    pool = [threading.Thread(target=target, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return time.perf_counter() - start, failures
+
+
+def signup_storm(ctx, threads, sponsors, attempts):
+    """Every thread signs up `attempts` members spread over the same sponsors"""
+    codes = ctx.open_codes[:sponsors]
+    created = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def work(index):
+        client = ctx.app.app.test_client()
+        for i in range(attempts):
+            name = f'stress{index}x{i}'
+            response = client.post('/api/auth/signup', json={
+                'username': name, 'password': 'stress-pw', 'email': f'{name}@example.com',
+                'first_name': 'Stress', 'last_name': str(i), 'dob': '1990-01-01', 'country': 'India',
+                'mobile': '9999999999', 'state': 'S', 'referral_code': codes[(index + i) % len(codes)]
+            })
+            with lock:
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                if response.status_code < 400:
+                    created.append(name)
+
+    seconds, failures = _storm(threads, work)
+    return {'seconds': round(seconds, 3), 'sponsors': len(codes), 'attempts': threads * attempts,
+            'created': len(created), 'statuses': statuses, 'failures': failures}
+
+
+def activation_storm(ctx, threads, users):
+    """Every thread tries to activate the same users; odd threads go through the admin"""
+    targets = ctx.inactive_ids[:users]
+    del ctx.inactive_ids[:users]
+    before = {uid: ctx.app.store.get_user(uid).get('wallet_balance', 0) for uid in targets}
+    activated = {uid: 0 for uid in targets}
+    statuses = {}
+    lock = threading.Lock()
+
+    def work(index):
+        rng = random.Random(index)
+        order = list(targets)
+        rng.shuffle(order)
+        admin = ctx.client() if index % 2 else None
+        for uid in order:
+            if admin:
+                response = admin.put(f'/api/admin/user/{uid}/activate', json={'action': 'activate'})
+            else:
+                response = ctx.client(uid).post('/api/user/activate', json={'payment_status': 'success'})
+            with lock:
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                if response.status_code < 400:
+                    activated[uid] += 1
+
+    seconds, failures = _storm(threads, work)
+    return {'seconds': round(seconds, 3), 'users': len(targets), 'attempts': threads * len(targets),
+            'statuses': statuses, 'failures': failures}, before, activated
+
+
+def drain(queue, timeout=120):
+    start = time.perf_counter()
+    while queue.stats()['depth']:
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError('activation queue did not drain')
+        time.sleep(0.01)
+    return time.perf_counter() - start
+
+
+def check(ctx, max_directs, before, activated):
+    """Every invariant a lost race would break, as a list of violations"""
+    store = ctx.app.store
+    cost = ctx.app.ACTIVATION_COST
+    users = {u['user_id']: u for u in store.iter_users()}
+    violations = []
+
+    children = {}
+    for uid, user in users.items():
+        if user.get('sponsor_id'):
+            children.setdefault(user['sponsor_id'], []).append(uid)
+    for uid, user in users.items():
+        directs = user.get('direct_referrals', [])
+        if len(directs) > max_directs:
+            violations.append({'check': 'max_directs', 'user_id': uid, 'directs': len(directs)})
+        if sorted(directs) != sorted(children.get(uid, [])):
+            violations.append({'check': 'direct_referrals', 'user_id': uid})
+
+    for uid, count in activated.items():
+        user = users[uid]
+        if count != 1 or user.get('activation_status') != 'active':
+            violations.append({'check': 'single_activation', 'user_id': uid, 'activations': count})
+        if not math.isclose(user.get('wallet_balance', 0), before[uid] - cost, abs_tol=1e-6):
+            violations.append({'check': 'activation_charge', 'user_id': uid,
+                               'wallet_balance': user.get('wallet_balance', 0)})
+
+    for uid, user in users.items():
+        totals = store.income_totals(uid, {})
+        ledger = {t: v['amount'] for t, v in totals.items()}
+        expected = {
+            'activation_wallet': ledger.get('activation_wallet', 0),
+            'matching_wallet': ledger.get('matching_wallet', 0),
+            'total_income': sum(ledger.values())
+        }
+        for wallet, amount in expected.items():
+            if not math.isclose(user.get(wallet, 0), amount, abs_tol=1e-6):
+                violations.append({'check': 'wallet_vs_ledger', 'user_id': uid, 'wallet': wallet,
+                                   'stored': user.get(wallet, 0), 'ledger': amount})
+
+    violations.extend(dict(d, check='stats') for d in store.recompute_stats())
+    violations.extend(dict(d, check='team_counts') for d in store.recompute_team_counts())
+    return violations
+
+
+def stress(ctx, threads, sponsors, signups, users):
+    result = {'threads': threads, 'concurrency_mode': ctx.app.CONCURRENCY_MODE}
+    result['signup'] = signup_storm(ctx, threads, sponsors, signups)
+    result['activate'], before, activated = activation_storm(ctx, threads, users)
+    result['drain_seconds'] = round(drain(ctx.app.activation_queue), 3)
+    if ctx.app.MATCHING_MODE == 'settlement':
+        ctx.app.settle_matching()
+    result['violations'] = check(ctx, ctx.max_directs, before, activated)
+    return result
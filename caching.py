@@ -0,0 +1,49 @@
+import threading
+from collections import OrderedDict
+
+# ===== VERSIONED CACHE =====
+# An LRU whose entries remember the version of the data they were built
+# from. Callers read the current version off the store (a user's version,
+# branch_version, ...) and only get an entry built from that same version,
+# so nothing has to be invalidated: the writes that change the data already
+# move its version, and a stale entry is replaced on its next miss or falls
+# off the end. Works unchanged with several workers since every process
+# compares against the shared store.
+
+
+class VersionedCache:
+    def __init__(self, name, max_entries=1024, lookups=None):
+        """lookups: a Counter labelled (cache, result) counting hit, stale and miss"""
+        self.name = name
+        self.max_entries = max_entries
+        self.lookups = lookups
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _count(self, result):
+        if self.lookups:
+            self.lookups.inc(self.name, result)
+
+    def get(self, key, version):
+        """The value stored for key at version, or None"""
+        with self._lock:
+            cached = self.entries.get(key)
+            if cached is None:
+                result = 'miss'
+            elif cached[0] != version:
+                result = 'stale'
+            else:
+                self.entries.move_to_end(key)
+                result = 'hit'
+        self._count(result)
+        return cached[1] if result == 'hit' else None
+
+    def put(self, key, version, value):
+        with self._lock:
+            self.entries[key] = (version, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,135 @@
+import itertools
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+
+# ===== LIVE FEED =====
+# Events pushed to the panels over server-sent events or long polls. Each
+# user has a channel holding its last few events; admins listen on one
+# channel that gets everything. A channel exists once someone has listened
+# on it and is forgotten least recently used first, so publishing to a
+# whole upline only touches the members who actually have a panel open,
+# and a client that reconnects with the id of the last event it saw gets
+# what it missed in between. Listeners wait on their own channel's
+# condition: an idle connection costs a parked thread and nothing else,
+# and a publish only wakes the listeners of the channels it reaches.
+# A Feed only reaches listeners of its own process: where several share a
+# database, each follows the store's feed and republishes what it reads
+# under the store's ids (see app.follow_feed).
+
+ADMIN_CHANNEL = '*'
+
+
+class Channel:
+    def __init__(self, lock, history):
+        self.events = deque(maxlen=history)
+        self.changed = threading.Condition(lock)
+        self.listeners = 0
+
+    def after(self, last_id):
+        return [e for e in self.events if e['id'] > last_id]
+
+
+class Feed:
+    def __init__(self, history=50, max_channels=100000, max_listeners=1000):
+        self.history = history
+        self.max_channels = max_channels
+        self.max_listeners = max_listeners
+        self.channels = OrderedDict()
+        self.listeners = 0
+        # Ids keep growing across restarts, so a resumed client never skips new events
+        self._ids = itertools.count(time.time_ns() // 1000)
+        self.last_id = 0
+        self._lock = threading.Lock()
+
+    def active(self):
+        """Does anyone listen, or did recently?"""
+        return bool(self.channels)
+
+    def publish(self, channel_ids, event_type, data, event_id=None):
+        """Append an event to every known channel in channel_ids and to the admin channel.
+
+        event_id, if given, must be above every id published before.
+        """
+        with self._lock:
+            event = {'id': event_id if event_id is not None else next(self._ids), 'type': event_type, 'data': data}
+            self.last_id = event['id']
+            for channel_id in itertools.chain(channel_ids, (ADMIN_CHANNEL,)):
+                channel = self.channels.get(channel_id)
+                if channel is not None:
+                    channel.events.append(event)
+                    channel.changed.notify_all()
+        return event['id']
+
+    def _channel(self, channel_id):
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.channels[channel_id] = Channel(self._lock, self.history)
+        self.channels.move_to_end(channel_id)
+        if len(self.channels) > self.max_channels:
+            # Forget the oldest channel nobody is listening on
+            idle = next((cid for cid, c in self.channels.items() if not c.listeners), None)
+            if idle is not None:
+                del self.channels[idle]
+        return channel
+
+    def full(self):
+        return self.listeners >= self.max_listeners
+
+    def _join(self, channel_id):
+        with self._lock:
+            self.listeners += 1
+            channel = self._channel(channel_id)
+            channel.listeners += 1
+            return channel
+
+    def _leave(self, channel):
+        with self._lock:
+            self.listeners -= 1
+            channel.listeners -= 1
+
+    def _resume_from(self, last_id):
+        # An id from ahead of this feed (another numbering, before a restart) means from now
+        return self.last_id if last_id > self.last_id else last_id
+
+    def wait(self, channel_id, last_id, timeout):
+        """Events of channel_id after last_id, waiting up to timeout seconds for one (a long poll)"""
+        channel = self._join(channel_id)
+        try:
+            last_id = self._resume_from(last_id)
+            with self._lock:
+                channel.changed.wait_for(lambda: channel.after(last_id), timeout)
+                return channel.after(last_id)
+        finally:
+            self._leave(channel)
+
+    def listen(self, channel_id, last_id=None, heartbeat=15.0, duration=None):
+        """Yield lists of new events (empty on a heartbeat) for one connection until duration runs out.
+
+        Without last_id only events published from now on are sent.
+        """
+        channel = self._join(channel_id)
+        try:
+            if last_id is None:
+                with self._lock:
+                    last_id = channel.events[-1]['id'] if channel.events else 0
+            else:
+                last_id = self._resume_from(last_id)
+            deadline = time.monotonic() + duration if duration else None
+            while deadline is None or time.monotonic() < deadline:
+                with self._lock:
+                    channel.changed.wait_for(lambda: channel.after(last_id), heartbeat)
+                    events = channel.after(last_id)
+                if events:
+                    last_id = events[-1]['id']
+                yield events
+        finally:
+            self._leave(channel)
+
+
+def sse(events):
+    """Server-sent event text for a list of events, a comment line for none"""
+    if not events:
+        return ': keep-alive\n\n'
+    return ''.join(f"id: {e['id']}\nevent: {e['type']}\ndata: {json.dumps(e['data'])}\n\n" for e in events)
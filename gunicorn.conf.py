@@ -0,0 +1,17 @@
+import os
+
+# ===== GUNICORN =====
+# Read by gunicorn from the working directory, next to the Procfile's
+# options. With SHARED_DATABASE=1 the app is imported, and the database
+# loaded, once in the master before it forks the WEB_CONCURRENCY workers,
+# which then start their own background threads. Same test as
+# app.SHARED_DATABASE (json only): importing app here to read it would load
+# the database, and start its threads, in the master in every mode.
+preload_app = (os.environ.get('STORAGE_BACKEND', 'json') == 'json'
+               and os.environ.get('SHARED_DATABASE', '0') == '1')
+
+
+def post_fork(server, worker):
+    if preload_app:
+        import app
+        app.after_fork()
@@ -0,0 +1,138 @@
+import csv
+import json
+from datetime import datetime
+
+# ===== BULK IMPORT =====
+# Brings an existing network in from a CSV (with a header row) or JSONL
+# file, one member per row. `sponsor` names the member's sponsor: a
+# username from the same file, or the username or referral code of a member
+# already here. Rows are read as a stream and checked against the store's
+# indexes and each other, then ordered so every sponsor goes in before its
+# directs, wherever it appears in the file; a sponsor's directs keep their
+# file order, so its first one in the file is its power leg. Rows that
+# cannot go in are reported with their row number and why, along with every
+# row below them.
+
+IMPORT_FIELDS = ('username', 'password', 'email', 'first_name', 'last_name', 'dob', 'country', 'mobile',
+                 'state', 'country_code', 'sponsor', 'created_at')
+REQUIRED_FIELDS = ('username', 'password', 'email', 'first_name', 'last_name', 'sponsor')
+FORMATS = ('csv', 'jsonl')
+
+
+def read_rows(lines, fmt):
+    """(line number, fields) for every row of an iterable of text lines; fields is an error message
+    for a row that does not parse"""
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            # Values past the header land under None
+            if None in row:
+                yield reader.line_num, 'More values than columns'
+            else:
+                yield reader.line_num, row
+        return
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield number, 'Not valid JSON'
+            continue
+        yield number, row if isinstance(row, dict) else 'Not a JSON object'
+
+
+def _clean(row):
+    """The import fields of a parsed row as stripped strings, or an error message"""
+    fields = {}
+    for field in IMPORT_FIELDS:
+        value = row.get(field)
+        fields[field] = '' if value is None else str(value).strip()
+    missing = [f for f in REQUIRED_FIELDS if not fields[f]]
+    if missing:
+        return f"Missing: {', '.join(missing)}"
+    if fields['created_at']:
+        try:
+            datetime.fromisoformat(fields['created_at'])
+        except ValueError:
+            return 'created_at is not an ISO date'
+    return fields
+
+
+def plan_import(rows, store, max_directs):
+    """Check parsed rows and order them for insertion.
+
+    Returns (plan, rejects). plan lists (row number, fields, sponsor) with
+    sponsors before their directs: sponsor is ('row', n) for a member
+    imported from row n or ('user', user_id) for an existing member.
+    rejects lists {'row', 'username', 'message'}.
+    """
+    rejects = []
+    rejected = set()
+    members = {}
+    by_username = {}
+    emails = set()
+
+    def reject(number, username, message):
+        rejects.append({'row': number, 'username': username, 'message': message})
+        rejected.add(number)
+
+    for number, row in rows:
+        fields = _clean(row) if isinstance(row, dict) else row
+        if isinstance(fields, str):
+            reject(number, row.get('username') if isinstance(row, dict) else None, fields)
+            continue
+        username, email = fields['username'].lower(), fields['email'].lower()
+        if username in by_username or store.find_by_username(fields['username']):
+            reject(number, fields['username'], 'Username already exists')
+        elif email in emails or store.find_by_email(fields['email']):
+            reject(number, fields['username'], 'Email already registered')
+        else:
+            members[number] = fields
+            by_username[username] = number
+            emails.add(email)
+
+    # Directs of every row and of every existing sponsor, in file order
+    children = {}
+    existing = {}
+    failed = []
+    for number, fields in members.items():
+        ref = fields['sponsor']
+        if ref.lower() in by_username:
+            children.setdefault(('row', by_username[ref.lower()]), []).append(number)
+            continue
+        sponsor = store.find_by_username(ref) or store.find_by_referral_code(ref)
+        if not sponsor:
+            reject(number, fields['username'], f"Unknown sponsor {ref}")
+            failed.append(number)
+            continue
+        existing.setdefault(sponsor['user_id'], sponsor)
+        children.setdefault(('user', sponsor['user_id']), []).append(number)
+
+    plan = []
+    placed = set()
+    # Breadth first from the existing sponsors: every sponsor before its directs
+    queue = [('user', user_id) for user_id in existing]
+    for sponsor in queue:
+        directs = len(existing[sponsor[1]].get('direct_referrals', [])) if sponsor[0] == 'user' else 0
+        for number in children.get(sponsor, []):
+            if directs >= max_directs:
+                reject(number, members[number]['username'],
+                       f"Sponsor has reached maximum limit of {max_directs} direct members")
+                failed.append(number)
+                continue
+            plan.append((number, members[number], sponsor))
+            placed.add(number)
+            queue.append(('row', number))
+            directs += 1
+
+    # Whatever was not reached hangs below a rejected row or in a cycle
+    for number in failed:
+        for child in children.get(('row', number), []):
+            reject(child, members[child]['username'], f"Sponsor row {number} was rejected")
+            failed.append(child)
+    for number, fields in members.items():
+        if number not in placed and number not in rejected:
+            reject(number, fields['username'], 'Sponsors form a cycle')
+    rejects.sort(key=lambda r: r['row'])
+    return plan, rejects
@@ -0,0 +1,274 @@
+import cProfile
+import functools
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+# ===== INSTRUMENTATION =====
+# Metrics live in this process and are rendered in the Prometheus text
+# format by /metrics; with several gunicorn workers each one is scraped
+# separately. Logs are one JSON object per line carrying the id of the
+# request that produced them.
+
+log = logging.getLogger('mlm')
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_text(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_label_text(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in sorted(self.series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series['counts']):
+                    cumulative += count
+                    le = _label_text(self.labelnames, labels, [('le', _number(bound))])
+                    lines.append(f"{self.name}_bucket{le} {cumulative}")
+                le = _label_text(self.labelnames, labels, [('le', '+Inf')])
+                lines.append(f"{self.name}_bucket{le} {series['count']}")
+                label_text = _label_text(self.labelnames, labels)
+                lines.append(f"{self.name}_sum{label_text} {_number(series['sum'])}")
+                lines.append(f"{self.name}_count{label_text} {series['count']}")
+        return lines
+
+
+class Gauge:
+    """A value read from `fn` every time the metrics are rendered"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, fn):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}",
+                f"{self.name} {_number(self.fn())}"]
+
+
+class CounterValue(Gauge):
+    """A running total kept elsewhere, read from `fn` every time the metrics are rendered"""
+
+    kind = 'counter'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._add(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help_text, labelnames, buckets))
+
+    def gauge(self, name, help_text, fn):
+        return self._add(Gauge(name, help_text, fn))
+
+    def counter_value(self, name, help_text, fn):
+        return self._add(CounterValue(name, help_text, fn))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                log.warning('metric render failed', extra={'metric': metric.name, 'error': str(e)})
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+http_requests = registry.counter(
+    'mlm_http_requests_total', 'HTTP requests by route and status', ('method', 'route', 'status'))
+http_latency = registry.histogram(
+    'mlm_http_request_duration_seconds', 'HTTP request latency by route', ('method', 'route'))
+stage_latency = registry.histogram(
+    'mlm_stage_duration_seconds', 'Time spent in internal stages', ('stage',))
+
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as an internal stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_latency.observe(time.perf_counter() - start, name)
+
+
+def timed_stage(name):
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def instrument_methods(obj, stages):
+    """Wrap obj's methods so each call is timed, stages maps method name -> stage name"""
+    for method, name in stages.items():
+        if hasattr(obj, method):
+            setattr(obj, method, timed_stage(name)(getattr(obj, method)))
+
+
+# ===== STRUCTURED LOGS =====
+
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record; `extra` fields are kept as keys"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds the current request id (see app.start_request) to every record logged inside a request"""
+
+    def filter(self, record):
+        if not hasattr(record, 'request_id'):
+            from flask import g, has_request_context
+            if has_request_context() and 'request_id' in g:
+                record.request_id = g.request_id
+        return True
+
+
+def setup_logging(level='INFO', fmt='json'):
+    handler = logging.StreamHandler()
+    handler.addFilter(RequestIdFilter())
+    if fmt == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+    log.handlers = [handler]
+    log.setLevel(level.upper())
+    log.propagate = False
+
+
+# ===== SLOW REQUEST PROFILER =====
+
+class SlowRequestProfiler:
+    """Profiles a sample of requests and keeps the pstats of those slower than threshold_ms"""
+
+    def __init__(self, enabled=False, threshold_ms=500.0, sample_rate=1.0, out_dir='profiles', keep=50):
+        self.enabled = enabled
+        self.threshold_ms = threshold_ms
+        self.sample_rate = sample_rate
+        self.out_dir = out_dir
+        self.dumps = deque(maxlen=keep)
+
+    def start(self):
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already running in this process
+            return None
+        return profile
+
+    def finish(self, profile, duration_ms, request_id, route):
+        profile.disable()
+        if duration_ms < self.threshold_ms:
+            return None
+        os.makedirs(self.out_dir, exist_ok=True)
+        safe_route = ''.join(c if c.isalnum() else '_' for c in route).strip('_') or 'root'
+        # The id may come from the client's X-Request-ID header
+        safe_id = re.sub(r'[^A-Za-z0-9_-]', '', request_id)[:64] or 'request'
+        path = os.path.join(self.out_dir, f"{datetime.now():%Y%m%d-%H%M%S}-{safe_route}-{safe_id}.pstats")
+        profile.dump_stats(path)
+        self.dumps.append({'path': path, 'route': route, 'request_id': request_id,
+                           'duration_ms': round(duration_ms, 2)})
+        log.warning('slow request profiled', extra={'route': route, 'duration_ms': round(duration_ms, 2),
+                                                     'profile': path})
+        return path
+
+    def settings(self):
+        return {
+            'enabled': self.enabled,
+            'threshold_ms': self.threshold_ms,
+            'sample_rate': self.sample_rate,
+            'out_dir': self.out_dir,
+            'recent': list(self.dumps)
+        }
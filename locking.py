@@ -0,0 +1,32 @@
+import threading
+import zlib
+from contextlib import contextmanager
+
+# ===== USER LOCKS =====
+# A fixed pool of locks with every user id hashed onto one of them, so
+# memory does not grow with the network. A caller holding several users
+# takes their stripes in index order, which keeps two callers from ever
+# waiting on each other in a cycle. These locks only cover threads of one
+# process; across workers the optimistic `expect` writes of the store do.
+
+
+class UserLocks:
+    def __init__(self, stripes=1024):
+        self.locks = [threading.Lock() for _ in range(stripes)]
+
+    def stripe(self, user_id):
+        return zlib.crc32(str(user_id).encode()) % len(self.locks)
+
+    @contextmanager
+    def hold(self, user_ids):
+        """Hold the locks of every id in user_ids (None ids are skipped)"""
+        stripes = sorted({self.stripe(uid) for uid in user_ids if uid is not None})
+        taken = []
+        try:
+            for i in stripes:
+                self.locks[i].acquire()
+                taken.append(i)
+            yield
+        finally:
+            for i in reversed(taken):
+                self.locks[i].release()
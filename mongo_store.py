@@ -0,0 +1,696 @@
+import heapq
+import re
+from datetime import datetime, timedelta
+
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from storage import (
+    Store, DuplicateUserError, ConflictError, recompute_team_counts, sponsor_order, ANCESTRY_LEVELS,
+    STAT_WALLETS, user_stats, stats_delta, compute_stats, stats_drift, search_keys, search_key
+)
+
+# ===== MONGODB BACKEND =====
+# One document per user with _id = user_id. Each document also stores its
+# first ANCESTRY_LEVELS `ancestors` (sponsor first) and its `depth` below
+# the root, so upline counters move with a single update_many, and a
+# downline, one level of it or an "is X under Y" check is one indexed query.
+# Deeper relations hop ANCESTRY_LEVELS levels at a time, as in
+# storage.AncestryIndex, which keeps documents small on long chains. Wallets and
+# counters only ever change through $inc, so concurrent workers never
+# overwrite each other's credits. `search_keys` holds the member's team
+# search keys for prefix queries. Income entries go to a separate `income`
+# collection with _id = entry_id.
+
+# Fields kept for indexing only, never handed back to the app
+_INTERNAL_FIELDS = {
+    '_id': 0, 'username_lower': 0, 'email_lower': 0, 'ancestors': 0, 'depth': 0, 'applying_entries': 0,
+    'search_keys': 0
+}
+_USER_FIELDS = _INTERNAL_FIELDS
+# Team search needs the depth to tell the level
+_SEARCH_FIELDS = {k: v for k, v in _INTERNAL_FIELDS.items() if k != 'depth'}
+# Unique indexes of users (by the name the server reports) and the field
+# DuplicateUserError names for each
+_UNIQUE_INDEXES = {'username_lower_1': 'username', 'email_lower_1': 'email', 'referral_code_1': 'referral_code'}
+# Fields user_stats() reads
+_STAT_FIELDS = dict.fromkeys(('is_admin', 'status', 'activation_status') + STAT_WALLETS, 1)
+
+# A worker that claimed an event and died releases it after this long; the
+# payouts are idempotent, so a second run only pays what the first did not.
+CLAIM_TIMEOUT = timedelta(seconds=60)
+# A feed seq is taken before its row is written; feed_since waits this long
+# for a missing one before going past it. Rows expire after FEED_TTL.
+FEED_GAP_WAIT = timedelta(seconds=2)
+FEED_TTL = timedelta(hours=1)
+
+
+def _user_query(filters):
+    query = {'is_admin': {'$ne': True}}
+    for field in ('status', 'activation_status'):
+        if filters.get(field):
+            query[field] = filters[field]
+    created = {}
+    if filters.get('created_from'):
+        created['$gte'] = filters['created_from']
+    if filters.get('created_to'):
+        created['$lte'] = filters['created_to']
+    if created:
+        query['created_at'] = created
+    return query
+
+
+def _after_query(field, descending, after):
+    """Keyset condition for rows sorted after storage.sort_key `after`"""
+    has_value, value, user_id = after
+    if descending:
+        if not has_value:
+            return {field: None, '_id': {'$lt': user_id}}
+        return {'$or': [
+            {field: {'$lt': value}},
+            {field: value, '_id': {'$lt': user_id}},
+            {field: None}
+        ]}
+    if not has_value:
+        return {'$or': [{field: None, '_id': {'$gt': user_id}}, {field: {'$ne': None}}]}
+    return {'$or': [{field: {'$gt': value}}, {field: value, '_id': {'$gt': user_id}}]}
+
+
+def _income_query(user_id, filters):
+    query = {'user_id': user_id}
+    if filters.get('type'):
+        query['type'] = filters['type']
+    date = {}
+    if filters.get('date_from'):
+        date['$gte'] = filters['date_from']
+    if filters.get('date_to'):
+        date['$lte'] = filters['date_to']
+    if date:
+        query['date'] = date
+    return query
+
+
+def _expect_query(query, expect):
+    for field, value in (expect or {}).items():
+        # Counters and versions missing on old documents read as 0
+        query[field] = {'$in': [0, None]} if value == 0 else value
+    return query
+
+
+def _connect(uri):
+    if uri.startswith('mongomock://'):
+        import mongomock
+        return mongomock.MongoClient()
+    return MongoClient(uri)
+
+
+def _below(sponsor_id, sponsor):
+    """`ancestors` and `depth` of a direct of sponsor"""
+    return ([sponsor_id] + sponsor.get('ancestors', []))[:ANCESTRY_LEVELS], sponsor.get('depth', 0) + 1
+
+
+class MongoStore(Store):
+    """User database shared by every worker through MongoDB"""
+
+    def __init__(self, uri, db_name, client=None):
+        self.client = client or _connect(uri)
+        self.mdb = self.client[db_name]
+        self.users = self.mdb['users']
+        self.events = self.mdb['events']
+        self.counters = self.mdb['counters']
+        self.income = self.mdb['income']
+        self.feed = self.mdb['feed']
+
+    def load(self):
+        self.users.create_index([('username_lower', ASCENDING)], unique=True)
+        self.users.create_index([('email_lower', ASCENDING)], unique=True)
+        self.users.create_index([('referral_code', ASCENDING)], unique=True)
+        self.users.create_index([('ancestors', ASCENDING), ('depth', ASCENDING)])
+        self.users.create_index([('sponsor_id', ASCENDING)])
+        self.users.create_index([('search_keys', ASCENDING)])
+        self.users.create_index([('created_at', ASCENDING), ('_id', ASCENDING)])
+        self.users.create_index([('activation_status', ASCENDING), ('created_at', ASCENDING)])
+        self.users.create_index([('matching_dirty_seq', ASCENDING)], sparse=True)
+        self.events.create_index([('status', ASCENDING), ('seq', ASCENDING)])
+        self.feed.create_index([('at', ASCENDING)], expireAfterSeconds=int(FEED_TTL.total_seconds()))
+        self.income.create_index([('user_id', ASCENDING), ('date', ASCENDING), ('_id', ASCENDING)])
+        self.income.create_index([('user_id', ASCENDING), ('type', ASCENDING), ('date', ASCENDING), ('_id', ASCENDING)])
+        self.income.create_index([('applied', ASCENDING), ('reserved_at', ASCENDING)])
+        self._migrate_income_history()
+        self._repair_income()
+        if self.users.find_one({'$or': [{'depth': {'$exists': False}},
+                                        {f'ancestors.{ANCESTRY_LEVELS}': {'$exists': True}}]}, {'_id': 1}):
+            # No ancestry yet, or the uncapped one of older versions
+            self.rebuild_ancestry()
+        for doc in self.users.find({'search_keys': {'$exists': False}}, {'username': 1, 'first_name': 1,
+                                                                         'last_name': 1}):
+            self.users.update_one({'_id': doc['_id']}, {'$set': {'search_keys': sorted(search_keys(doc))}})
+        if self.users.find_one({'team_size': {'$exists': False}}, {'_id': 1}):
+            self.recompute_team_counts()
+        if not self.counters.find_one({'_id': 'user_stats'}, {'_id': 1}):
+            self.recompute_stats()
+
+    # ----- reads -----
+
+    def get_user(self, user_id):
+        return self.users.find_one({'_id': user_id}, _USER_FIELDS)
+
+    def get_users(self, user_ids):
+        return {u['user_id']: u for u in self.users.find({'_id': {'$in': list(user_ids)}}, _USER_FIELDS)}
+
+    def find_by_username(self, username):
+        return self.users.find_one({'username_lower': (username or '').lower()}, _USER_FIELDS)
+
+    def find_by_email(self, email):
+        return self.users.find_one({'email_lower': (email or '').lower()}, _USER_FIELDS)
+
+    def find_by_referral_code(self, code):
+        return self.users.find_one({'referral_code': code}, _USER_FIELDS)
+
+    def iter_users(self):
+        return self.users.find({}, _USER_FIELDS)
+
+    def count_users(self):
+        return self.users.count_documents({})
+
+    def query_users(self, filters, sort='created_at', descending=False, after=None, limit=None):
+        query = _user_query(filters)
+        if after is not None:
+            query = {'$and': [query, _after_query(sort, descending, after)]}
+        direction = DESCENDING if descending else ASCENDING
+        cursor = self.users.find(query, _USER_FIELDS).sort([(sort, direction), ('_id', direction)])
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return cursor
+
+    def count_users_matching(self, filters):
+        return self.users.count_documents(_user_query(filters))
+
+    def _upline_ids(self, ancestors, limit=None):
+        """The whole upline from a document's `ancestors`, hopping ANCESTRY_LEVELS at a time"""
+        ids = list(ancestors)
+        chunk = ids
+        while len(chunk) == ANCESTRY_LEVELS and (limit is None or len(ids) < limit):
+            doc = self.users.find_one({'_id': chunk[-1]}, {'ancestors': 1})
+            chunk = doc.get('ancestors', []) if doc else []
+            ids.extend(chunk)
+        return ids if limit is None else ids[:limit]
+
+    def _team_roots(self, leader_id, depth, max_level=None):
+        """The leader and its members every ANCESTRY_LEVELS levels down (above max_level):
+        a member is in the team, that far down, if one of them is in its `ancestors`"""
+        roots = frontier = [leader_id]
+        level = ANCESTRY_LEVELS
+        while frontier and (max_level is None or level < max_level):
+            frontier = [row['_id'] for row in self.users.find(
+                {'ancestors': {'$in': frontier}, 'depth': depth + level}, {'_id': 1})]
+            roots = roots + frontier
+            level += ANCESTRY_LEVELS
+        return roots
+
+    def get_upline(self, user_id, limit=None):
+        doc = self.users.find_one({'_id': user_id}, {'ancestors': 1})
+        if not doc:
+            return []
+        ancestors = self._upline_ids(doc.get('ancestors', []), limit)
+        found = self.get_users(ancestors)
+        return [found[a] for a in ancestors if a in found]
+
+    def get_subtree(self, user_id):
+        doc = self.users.find_one({'_id': user_id}, _SEARCH_FIELDS)
+        if not doc:
+            return {}
+        roots = self._team_roots(user_id, doc.pop('depth'))
+        subtree = {user_id: doc}
+        for u in self.users.find({'ancestors': {'$in': roots}}, _USER_FIELDS):
+            subtree[u['user_id']] = u
+        return subtree
+
+    def get_downline_ids(self, user_id, level):
+        doc = self.users.find_one({'_id': user_id}, {'depth': 1})
+        if not doc:
+            return []
+        roots = self._team_roots(user_id, doc['depth'], level)
+        rows = self.users.find({'ancestors': {'$in': roots}, 'depth': doc['depth'] + level}, {'_id': 1})
+        return [row['_id'] for row in rows.sort([('created_at', ASCENDING), ('_id', ASCENDING)])]
+
+    def is_in_team(self, member_id, leader_id):
+        if member_id == leader_id:
+            return self.users.find_one({'_id': member_id}, {'_id': 1}) is not None
+        member = self.users.find_one({'_id': member_id}, {'ancestors': 1, 'depth': 1})
+        if not member or leader_id in member.get('ancestors', []):
+            return member is not None
+        if len(member.get('ancestors', [])) < ANCESTRY_LEVELS:
+            return False
+        leader = self.users.find_one({'_id': leader_id}, {'depth': 1})
+        if not leader:
+            return False
+        levels = member['depth'] - leader['depth']
+        while member and levels > ANCESTRY_LEVELS:
+            member = self.users.find_one({'_id': member['ancestors'][-1]}, {'ancestors': 1})
+            levels -= ANCESTRY_LEVELS
+        return bool(member) and 0 < levels <= len(member['ancestors']) and member['ancestors'][levels - 1] == leader_id
+
+    def search_team(self, leader_id, prefix, filters, after=None, limit=None):
+        leader = self.users.find_one({'_id': leader_id}, {'depth': 1})
+        if not leader:
+            return []
+        # An anchored regex is answered from the search_keys index
+        roots = self._team_roots(leader_id, leader['depth'], filters.get('max_level'))
+        query = {'ancestors': {'$in': roots}, 'search_keys': {'$regex': '^' + re.escape(prefix)}}
+        depth = {}
+        if filters.get('min_level'):
+            depth['$gte'] = leader['depth'] + filters['min_level']
+        if filters.get('max_level'):
+            depth['$lte'] = leader['depth'] + filters['max_level']
+        if depth:
+            query['depth'] = depth
+        if filters.get('activation_status'):
+            query['activation_status'] = filters['activation_status']
+        after = tuple(after) if after is not None else None
+        rows = []
+        for doc in self.users.find(query, _SEARCH_FIELDS):
+            level = doc.pop('depth') - leader['depth']
+            key = search_key(doc, prefix)
+            if key and (after is None or key > after):
+                rows.append((key, doc, level))
+        if limit is not None:
+            rows = heapq.nsmallest(limit, rows, key=lambda row: row[0])
+        else:
+            rows.sort(key=lambda row: row[0])
+        return [(doc, level) for _, doc, level in rows]
+
+    def query_income(self, user_id, filters, descending=False, after=None, limit=None):
+        query = _income_query(user_id, filters)
+        query['applied'] = True
+        if after is not None:
+            date, entry_id = after
+            op = '$lt' if descending else '$gt'
+            query = {'$and': [query, {'$or': [{'date': {op: date}}, {'date': date, '_id': {op: entry_id}}]}]}
+        direction = DESCENDING if descending else ASCENDING
+        cursor = self.income.find(query, {'_id': 0, 'user_id': 0, 'applied': 0})
+        cursor = cursor.sort([('date', direction), ('_id', direction)])
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return list(cursor)
+
+    def income_totals(self, user_id, filters):
+        # Served from the (user_id, type, date) index
+        query = _income_query(user_id, filters)
+        query['applied'] = True
+        totals = {}
+        for row in self.income.aggregate([
+            {'$match': query},
+            {'$group': {'_id': '$type', 'count': {'$sum': 1}, 'amount': {'$sum': '$amount'}}}
+        ]):
+            totals[row['_id']] = {'count': row['count'], 'amount': row['amount']}
+        return totals
+
+    def _migrate_income_history(self):
+        """Move income_history lists embedded by older versions into the income collection"""
+        for doc in self.users.find({'income_history.0': {'$exists': True}}, {'income_history': 1}):
+            for i, entry in enumerate(doc['income_history']):
+                entry_id = entry.get('entry_id') or f"{doc['_id']}:{i}"
+                self.income.update_one({'_id': entry_id}, {'$setOnInsert': dict(
+                    entry, entry_id=entry_id, user_id=doc['_id'], applied=True
+                )}, upsert=True)
+        self.users.update_many({'income_history': {'$exists': True}}, {'$unset': {'income_history': ''}})
+
+    # ----- writes -----
+
+    def insert_user(self, user, expect_sponsor=None):
+        sponsor_id = user.get('sponsor_id')
+        doc = dict(user)
+        doc['_id'] = user['user_id']
+        doc['username_lower'] = user['username'].lower()
+        doc['email_lower'] = user['email'].lower()
+        doc['search_keys'] = sorted(search_keys(user))
+        doc['ancestors'] = []
+        doc['depth'] = 0
+        sponsor = None
+        if sponsor_id:
+            # Take the slot under the sponsor first, so a sponsor that moved
+            # on (expect_sponsor) never gets a member it did not agree to
+            sponsor = self.users.find_one_and_update(
+                _expect_query({'_id': sponsor_id}, expect_sponsor),
+                {'$push': {'direct_referrals': user['user_id']}, '$inc': {'version': 1}},
+                projection={'direct_referrals': 1, 'ancestors': 1, 'depth': 1},
+                return_document=ReturnDocument.AFTER
+            )
+            if sponsor:
+                doc['ancestors'], doc['depth'] = _below(sponsor_id, sponsor)
+            elif expect_sponsor:
+                raise ConflictError(sponsor_id)
+
+        try:
+            self.users.insert_one(doc)
+        except DuplicateKeyError as e:
+            if sponsor:
+                self.users.update_one({'_id': sponsor_id}, {'$pull': {'direct_referrals': user['user_id']}})
+            raise DuplicateUserError(self._duplicate_field(e, doc))
+        self._bump_stats(user_stats(user))
+
+        if not sponsor:
+            return
+        directs = sponsor['direct_referrals']
+        # Only the writer that saw the current list may store the legs
+        self.users.update_one({'_id': sponsor_id, 'direct_referrals': {'$size': len(directs)}}, {'$set': {
+            'power_leg_user': directs[0],
+            'other_leg_users': directs[1:]
+        }})
+        inc = {'team_size': user.get('team_size', 1), 'branch_version': 1}
+        if user.get('activation_status') == 'active':
+            inc['active_team_size'] = 1
+        self.users.update_many({'_id': {'$in': self._upline_ids(doc['ancestors'])}}, {'$inc': inc})
+
+    def _duplicate_field(self, error, doc):
+        """The field of doc that a DuplicateKeyError is about"""
+        match = re.search(r'index: (\S+)', (error.details or {}).get('errmsg') or str(error))
+        if match and match.group(1) in _UNIQUE_INDEXES:
+            return _UNIQUE_INDEXES[match.group(1)]
+        # Servers (and mongomock) that do not name the index
+        for name, field in _UNIQUE_INDEXES.items():
+            key = name[:-len('_1')]
+            if self.users.find_one({key: doc.get(key)}, {'_id': 1}):
+                return field
+        return 'username'
+
+    def insert_users(self, users, expect_sponsors=None):
+        # One query finds the taken names, one update per existing sponsor
+        # takes the slots for all of its new directs, one insert_many adds
+        # the documents with their counters already summed, and one
+        # update_many per existing sponsor moves its upline.
+        expect_sponsors = expect_sponsors or {}
+        skipped = []
+        left_out = set()
+
+        def leave_out(user, reason):
+            left_out.add(user['user_id'])
+            skipped.append({'user_id': user['user_id'], 'reason': reason})
+
+        taken = {'username': set(), 'email': set()}
+        for i in range(0, len(users), 10000):
+            chunk = users[i:i + 10000]
+            for doc in self.users.find({'$or': [
+                {'username_lower': {'$in': [u['username'].lower() for u in chunk]}},
+                {'email_lower': {'$in': [u['email'].lower() for u in chunk]}}
+            ]}, {'username_lower': 1, 'email_lower': 1}):
+                taken['username'].add(doc['username_lower'])
+                taken['email'].add(doc['email_lower'])
+        new_ids = {u['user_id'] for u in users}
+        batch = []
+        for user in users:
+            if user.get('sponsor_id') in left_out:
+                leave_out(user, 'sponsor')
+            elif user['username'].lower() in taken['username']:
+                leave_out(user, 'username')
+            elif user['email'].lower() in taken['email']:
+                leave_out(user, 'email')
+            else:
+                taken['username'].add(user['username'].lower())
+                taken['email'].add(user['email'].lower())
+                batch.append(user)
+
+        outside = {}
+        for user in batch:
+            if user.get('sponsor_id') and user['sponsor_id'] not in new_ids:
+                outside.setdefault(user['sponsor_id'], []).append(user['user_id'])
+        sponsors = {}
+        for sponsor_id, user_ids in outside.items():
+            sponsor = self.users.find_one_and_update(
+                _expect_query({'_id': sponsor_id}, expect_sponsors.get(sponsor_id)),
+                {'$push': {'direct_referrals': {'$each': user_ids}}, '$inc': {'version': len(user_ids)}},
+                projection={'direct_referrals': 1, 'ancestors': 1, 'depth': 1},
+                return_document=ReturnDocument.AFTER
+            )
+            if sponsor:
+                sponsors[sponsor_id] = sponsor
+        docs = {}
+        for user in batch:
+            sponsor_id = user.get('sponsor_id')
+            if sponsor_id in left_out or (sponsor_id in outside and sponsor_id not in sponsors):
+                leave_out(user, 'sponsor')
+                continue
+            doc = dict(user, _id=user['user_id'], username_lower=user['username'].lower(),
+                       email_lower=user['email'].lower(), search_keys=sorted(search_keys(user)),
+                       direct_referrals=list(user.get('direct_referrals', [])))
+            sponsor = docs.get(sponsor_id) or sponsors.get(sponsor_id)
+            doc['ancestors'], doc['depth'] = _below(sponsor_id, sponsor) if sponsor else ([], 0)
+            if sponsor_id in docs:
+                docs[sponsor_id]['direct_referrals'].append(user['user_id'])
+            docs[user['user_id']] = doc
+        if not docs:
+            return skipped
+
+        below = {}
+        for doc in reversed(list(docs.values())):
+            team, active = below.pop(doc['_id'], (0, 0))
+            if team:
+                doc['team_size'] = doc.get('team_size', 1) + team
+                doc['active_team_size'] = doc.get('active_team_size', 0) + active
+                doc['branch_version'] = doc.get('branch_version', 0) + 1
+            if doc.get('activation_status') == 'active':
+                active += 1
+            sponsor_team, sponsor_active = below.get(doc.get('sponsor_id'), (0, 0))
+            below[doc.get('sponsor_id')] = (sponsor_team + doc.get('team_size', 1), sponsor_active + active)
+            directs = doc['direct_referrals']
+            doc['power_leg_user'] = directs[0] if directs else None
+            doc['other_leg_users'] = directs[1:]
+
+        self.users.insert_many(list(docs.values()))
+        self._bump_stats(compute_stats(docs.values()))
+        for sponsor_id, sponsor in sponsors.items():
+            team, active = below.get(sponsor_id, (0, 0))
+            self.users.update_many({'_id': {'$in': [sponsor_id] + self._upline_ids(sponsor.get('ancestors', []))}},
+                                   {'$inc': {'team_size': team, 'active_team_size': active, 'branch_version': 1}})
+            directs = sponsor['direct_referrals']
+            self.users.update_one({'_id': sponsor_id, 'direct_referrals': {'$size': len(directs)}}, {'$set': {
+                'power_leg_user': directs[0],
+                'other_leg_users': directs[1:]
+            }})
+        return skipped
+
+    def _bump_stats(self, delta):
+        if delta:
+            self.counters.update_one({'_id': 'user_stats'}, {'$inc': delta}, upsert=True)
+
+    def _update_activation(self, user_id, status, update, cost=0, expect=None):
+        """Apply update and move active_team_size along the upline if the status flipped"""
+        update.setdefault('$set', {})['activation_status'] = status
+        update.setdefault('$inc', {})['version'] = 1
+        before = self.users.find_one_and_update(
+            _expect_query({'_id': user_id}, expect), update, projection=dict(_STAT_FIELDS, ancestors=1)
+        )
+        if not before:
+            return False
+        after = dict(before, activation_status=status,
+                     wallet_balance=before.get('wallet_balance', 0) - cost)
+        self._bump_stats(stats_delta(user_stats(before), user_stats(after)))
+        was_active = before.get('activation_status') == 'active'
+        is_active = status == 'active'
+        if was_active != is_active:
+            self.users.update_many(
+                {'_id': {'$in': [user_id] + self._upline_ids(before.get('ancestors', []))}},
+                {'$inc': {'active_team_size': 1 if is_active else -1, 'branch_version': 1}}
+            )
+        return True
+
+    def activate(self, user_id, date, cost, seq=None, expect=None):
+        # $min keeps the first seq while the user stays active; deactivate
+        # unsets it so a later activation starts over
+        return self._update_activation(user_id, 'active', {
+            '$set': {'activation_date': date},
+            '$min': {'activation_seq': seq},
+            '$inc': {'wallet_balance': -cost}
+        }, cost, expect)
+
+    def deactivate(self, user_id):
+        self._update_activation(user_id, 'inactive', {'$unset': {'activation_seq': ''}})
+
+    def _bump_income_stats(self, user, wallet, amount):
+        if user and not user.get('is_admin'):
+            self._bump_stats(stats_delta({}, {wallet: amount, 'total_income': amount}))
+
+    def credit(self, user_id, wallet, amount):
+        user = self.users.find_one_and_update(
+            {'_id': user_id}, {'$inc': {wallet: amount, 'total_income': amount}},
+            projection={'is_admin': 1}
+        )
+        self._bump_income_stats(user, wallet, amount)
+
+    def append_income(self, user_id, entry):
+        try:
+            self.income.insert_one(dict(entry, _id=entry['entry_id'], user_id=user_id, applied=True))
+        except DuplicateKeyError:
+            pass
+
+    def set_fields(self, user_id, fields):
+        before = self.users.find_one_and_update({'_id': user_id}, {'$set': fields}, projection=_STAT_FIELDS)
+        if before:
+            self._bump_stats(stats_delta(user_stats(before), user_stats(dict(before, **fields))))
+
+    def payout(self, user_id, wallet, amount, entry, inc=None, expect=None):
+        # The ledger row and the wallet live in different documents, so a
+        # payout is three steps: reserve the row (unapplied), credit the user
+        # while remembering the entry_id in applying_entries, then publish
+        # the row and forget the id. A rerun after a crash in between finds
+        # the reservation and the guard and finishes the same payout.
+        entry_id = entry['entry_id']
+        row = dict(entry, _id=entry_id, user_id=user_id, applied=False, reserved_at=datetime.now())
+        reserved = self.income.find_one_and_update({'_id': entry_id}, {'$setOnInsert': row}, upsert=True)
+        if reserved and reserved['applied']:
+            return False
+
+        query = _expect_query({'_id': user_id, 'applying_entries': {'$ne': entry_id}}, expect)
+        user = self.users.find_one_and_update(query, {
+            '$inc': dict(inc or {}, **{wallet: amount, 'total_income': amount}),
+            '$push': {'applying_entries': entry_id}
+        }, projection={'is_admin': 1})
+        if user:
+            self._bump_income_stats(user, wallet, amount)
+            if reserved:
+                self.income.replace_one({'_id': entry_id}, row)
+        elif not self.users.find_one({'_id': user_id, 'applying_entries': entry_id}, {'_id': 1}):
+            # Nothing was credited: expect did not match or the user is gone
+            self.income.delete_one({'_id': entry_id, 'applied': False})
+            return False
+
+        self._publish_income(user_id, entry_id)
+        return user is not None
+
+    def mark_matching_dirty(self, seqs):
+        by_seq = {}
+        for user_id, seq in seqs.items():
+            by_seq.setdefault(seq, []).append(user_id)
+        for seq, user_ids in by_seq.items():
+            self.users.update_many({'_id': {'$in': user_ids}}, {'$max': {'matching_dirty_seq': seq}})
+
+    def matching_dirty_users(self):
+        return list(self.users.find({'matching_dirty_seq': {'$exists': True}}, _USER_FIELDS))
+
+    def clear_matching_dirty(self, user_id, seq):
+        self.users.update_one({'_id': user_id, 'matching_dirty_seq': seq}, {'$unset': {'matching_dirty_seq': ''}})
+
+    def _publish_income(self, user_id, entry_id):
+        self.income.update_one({'_id': entry_id}, {'$set': {'applied': True}, '$unset': {'reserved_at': ''}})
+        self.users.update_one({'_id': user_id}, {'$pull': {'applying_entries': entry_id}})
+
+    def _repair_income(self):
+        """Finish or drop payouts whose worker died between the reserve and publish steps"""
+        stale = {'applied': False, 'reserved_at': {'$lt': datetime.now() - CLAIM_TIMEOUT}}
+        for row in self.income.find(stale, {'user_id': 1}):
+            if self.users.find_one({'_id': row['user_id'], 'applying_entries': row['_id']}, {'_id': 1}):
+                self._publish_income(row['user_id'], row['_id'])
+            else:
+                self.income.delete_one({'_id': row['_id'], 'applied': False})
+
+    # ----- activation events -----
+
+    def next_event_seq(self):
+        counter = self.counters.find_one_and_update(
+            {'_id': 'event_seq'}, {'$inc': {'value': 1}},
+            upsert=True, return_document=ReturnDocument.AFTER
+        )
+        return counter['value']
+
+    def enqueue_event(self, event):
+        self.events.insert_one(dict(event, _id=event['event_id']))
+
+    def claim_event(self):
+        now = datetime.now()
+        self.events.update_many(
+            {'status': 'processing', 'claimed_at': {'$lt': now - CLAIM_TIMEOUT}},
+            {'$set': {'status': 'pending'}}
+        )
+        event = self.events.find_one_and_update(
+            {'status': 'pending'},
+            {'$set': {'status': 'processing', 'claimed_at': now}},
+            sort=[('seq', ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+        if event:
+            event.pop('_id')
+            event.pop('claimed_at')
+        return event
+
+    def complete_event(self, event_id, status, processed_at, error=None):
+        self.events.update_one({'_id': event_id}, {
+            '$set': {'status': status, 'processed_at': processed_at, 'error': error}
+        })
+
+    def get_event(self, event_id):
+        return self.events.find_one({'_id': event_id}, {'_id': 0, 'claimed_at': 0})
+
+    def event_stats(self):
+        unfinished = {'status': {'$in': ['pending', 'processing']}}
+        oldest = self.events.find_one(unfinished, {'created_at': 1}, sort=[('seq', ASCENDING)])
+        return {
+            'depth': self.events.count_documents(unfinished),
+            'oldest_created_at': oldest['created_at'] if oldest else None
+        }
+
+    # ----- live feed -----
+
+    def publish_feed(self, event):
+        seq = self.counters.find_one_and_update({'_id': 'feed'}, {'$inc': {'seq': 1}}, upsert=True,
+                                                return_document=ReturnDocument.AFTER)['seq']
+        self.feed.insert_one(dict(event, _id=seq, at=datetime.now()))
+
+    def feed_since(self, cursor):
+        if cursor is None:
+            last = self.feed.find_one({}, {'_id': 1}, sort=[('_id', DESCENDING)])
+            return [], last['_id'] if last else 0
+        settled = datetime.now() - FEED_GAP_WAIT
+        events = []
+        for row in self.feed.find({'_id': {'$gt': cursor}}).sort('_id', ASCENDING):
+            if row['_id'] != cursor + 1 and row['at'] > settled:
+                # An earlier seq may still be on its way
+                break
+            cursor = row['_id']
+            events.append({'id': row['_id'], 'channels': row['channels'], 'type': row['type'],
+                           'data': row['data']})
+        return events, cursor
+
+    def recompute_team_counts(self):
+        db = {u['user_id']: u for u in self.users.find({}, {
+            'user_id': 1, 'sponsor_id': 1, 'direct_referrals': 1,
+            'activation_status': 1, 'team_size': 1, 'active_team_size': 1
+        })}
+        drift = recompute_team_counts(db)
+        for d in drift:
+            self.users.update_one({'_id': d['user_id']}, {
+                '$set': {
+                    'team_size': d['expected_team_size'],
+                    'active_team_size': d['expected_active_team_size']
+                },
+                '$inc': {'branch_version': 1}
+            })
+        return drift
+
+    def rebuild_ancestry(self):
+        db = {u['_id']: u for u in self.users.find({}, {
+            'user_id': 1, 'sponsor_id': 1, 'direct_referrals': 1, 'ancestors': 1, 'depth': 1
+        })}
+        drift = []
+        for uid in sponsor_order(db):
+            u = db[uid]
+            sponsor = db.get(u.get('sponsor_id'))
+            ancestors, depth = _below(sponsor['_id'], sponsor) if sponsor else ([], 0)
+            if u.get('ancestors') != ancestors or u.get('depth') != depth:
+                drift.append({'user_id': uid, 'upline': u.get('ancestors'), 'expected_upline': ancestors})
+                self.users.update_one({'_id': uid}, {'$set': {'ancestors': ancestors, 'depth': depth}})
+            u['ancestors'] = ancestors
+            u['depth'] = depth
+        return drift
+
+    def get_stats(self):
+        doc = self.counters.find_one({'_id': 'user_stats'}, {'_id': 0}) or {}
+        return {name: value for name, value in doc.items() if value}
+
+    def recompute_stats(self):
+        # Writes racing with the rebuild can leave a small drift behind; the
+        # next check reports and fixes it.
+        expected = compute_stats(self.users.find({}, _STAT_FIELDS))
+        drift = stats_drift(self.get_stats(), expected)
+        self.counters.replace_one({'_id': 'user_stats'}, dict(expected, _id='user_stats'), upsert=True)
+        return drift
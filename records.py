@@ -0,0 +1,202 @@
+import sys
+from collections import deque
+from collections.abc import Mapping, MutableMapping
+from itertools import compress, repeat
+from operator import is_not
+
+# ===== COMPACT USER RECORDS =====
+# JsonStore keeps every user in memory, so each one is a __slots__ record
+# rather than a dict carrying its ~30 keys. User ids and low-cardinality
+# strings are interned: a sponsor link or a direct referral is a pointer to
+# the id string its user already holds, not another copy of it. Timestamps
+# stay ISO strings: user listings sort and filter on them for every user,
+# and formatting them back from numbers costs more than the bytes saved.
+# power_leg_user and other_leg_users are always the first and the other
+# direct referrals, so they are read from direct_referrals instead of being
+# stored. A record reads and writes like the dict it replaces; keys outside
+# FIELDS go to a per-record dict that stays None for most users.
+
+FIELDS = (
+    'user_id', 'username', 'password', 'email', 'first_name', 'last_name', 'dob', 'country',
+    'mobile', 'state', 'country_code', 'phone', 'is_admin', 'status', 'activation_status',
+    'activation_date', 'activation_cost', 'activation_seq', 'created_at', 'wallet_balance',
+    'activation_wallet', 'matching_wallet', 'total_income', 'commission_received',
+    'referral_code', 'sponsor_id', 'direct_referrals', 'matched_pairs', 'team_size',
+    'active_team_size', 'branch_version', 'version'
+)
+DERIVED = ('power_leg_user', 'other_leg_users')
+
+_SLOTS = frozenset(FIELDS)
+_INTERNED = frozenset(('user_id', 'sponsor_id', 'dob', 'country', 'state', 'country_code', 'status',
+                       'activation_status'))
+# Slots stored as given
+_PLAIN = _SLOTS - _INTERNED - {'direct_referrals'}
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+class UserRecord(MutableMapping):
+    __slots__ = FIELDS + ('_extra',)
+
+    def __init__(self, fields=()):
+        self._extra = None
+        for key, value in (fields.items() if isinstance(fields, Mapping) else fields):
+            if key in _PLAIN:
+                setattr(self, key, value)
+            else:
+                self[key] = value
+
+    def __getitem__(self, key):
+        if key in _SLOTS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if key in DERIVED:
+            directs = getattr(self, 'direct_referrals', ())
+            if key == 'power_leg_user':
+                return directs[0] if directs else None
+            return list(directs[1:])
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def get(self, key, default=None):
+        if key in _SLOTS:
+            return getattr(self, key, default)
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        if key in _SLOTS:
+            return hasattr(self, key)
+        return key in DERIVED or (self._extra is not None and key in self._extra)
+
+    def __setitem__(self, key, value):
+        if key in _PLAIN:
+            setattr(self, key, value)
+        elif key in _SLOTS:
+            if key in _INTERNED:
+                value = _intern(value)
+            elif key == 'direct_referrals':
+                value = tuple(_intern(v) for v in value)
+            setattr(self, key, value)
+        elif key not in DERIVED:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _SLOTS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif key in DERIVED or self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+            if not self._extra:
+                self._extra = None
+
+    def __iter__(self):
+        for key in FIELDS:
+            if hasattr(self, key):
+                yield key
+        yield from DERIVED
+        if self._extra:
+            yield from list(self._extra)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __bool__(self):
+        return True
+
+    def __repr__(self):
+        return f"UserRecord({dict(self)!r})"
+
+    def copy(self):
+        return dict(self)
+
+
+def user_record_hook(obj):
+    """json object_hook turning user objects into records as they are parsed"""
+    if 'user_id' in obj and 'username' in obj:
+        return UserRecord(obj)
+    return obj
+
+
+def json_default(obj):
+    """json default writing records as plain objects"""
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    return str(obj)
+
+
+def compact_users(users):
+    """{user_id: UserRecord} for a parsed {user_id: user}, keyed by each record's interned id"""
+    db = {}
+    for user in users.values():
+        if not isinstance(user, UserRecord):
+            user = UserRecord(user)
+        db[user['user_id']] = user
+    return db
+
+
+# ===== COLUMNS =====
+# The binary snapshot stores users column by column: one list per field,
+# with Ellipsis where a user has no value, so a load is a parse per column
+# plus a pass per field filling that slot of every record. A table may
+# instead leave the missing values out of its columns and list their
+# indexes per field under 'missing'.
+
+MISSING = ...
+
+
+def to_columns(users):
+    columns = [[] for _ in FIELDS]
+    extra = []
+    for user in users:
+        if not isinstance(user, UserRecord):
+            user = UserRecord(user)
+        for column, field in zip(columns, FIELDS):
+            column.append(getattr(user, field, MISSING))
+        extra.append(user._extra)
+    return {'fields': list(FIELDS), 'columns': columns, 'extra': extra}
+
+
+def from_columns(table, progress=None):
+    """{user_id: UserRecord} from to_columns output; progress(n) is called after each field"""
+    count = len(table['extra'])
+    records = list(map(UserRecord.__new__, repeat(UserRecord, count)))
+    # Slot descriptors set through map run without a Python frame per value
+    deque(map(UserRecord._extra.__set__, records, table['extra']), maxlen=0)
+    missing = table.get('missing') or repeat(None)
+    for field, column, absent in zip(table['fields'], table['columns'], missing):
+        targets = records
+        if absent:
+            present = bytearray(b'\x01') * count
+            for i in absent:
+                present[i] = 0
+            targets = compress(records, present)
+        elif absent is None and MISSING in column:
+            present = list(map(is_not, column, repeat(MISSING)))
+            targets, column = compress(records, present), compress(column, present)
+        if field in _INTERNED:
+            # Parsed strings are new objects; ids must be the interned ones
+            column = map(_intern, column)
+        elif field == 'direct_referrals':
+            column = (tuple(map(_intern, directs)) for directs in column)
+        if field in _SLOTS:
+            deque(map(getattr(UserRecord, field).__set__, targets, column), maxlen=0)
+        else:
+            for record, value in zip(targets, column):
+                record[field] = value
+        if progress:
+            progress(count)
+    return {record.user_id: record for record in records}
@@ -0,0 +1,1715 @@
+import bisect
+import fcntl
+import gc
+import heapq
+import json
+import logging
+import marshal
+import math
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+
+from records import (
+    MISSING, UserRecord, compact_users, from_columns, json_default, to_columns, user_record_hook
+)
+
+log = logging.getLogger('mlm.storage')
+
+# ===== STORAGE BACKENDS =====
+# The app talks to a Store. JsonStore (below) keeps everything in one process,
+# or in the workers forked from it (see share()); MongoStore (mongo_store.py)
+# lets several gunicorn workers or nodes share one database. STORAGE_BACKEND
+# in app.py picks one.
+
+
+class DuplicateUserError(Exception):
+    """Raised by insert_user when a unique field is already taken"""
+
+    def __init__(self, field):
+        super().__init__(field)
+        self.field = field
+
+
+class ConflictError(Exception):
+    """Raised when an optimistic write finds that its `expect` fields changed underneath it"""
+
+
+def matches_expect(doc, expect):
+    """Counters and versions missing on old documents read as 0"""
+    return all(doc.get(field, 0) == value for field, value in (expect or {}).items())
+
+
+class Store:
+    """Interface every storage backend implements"""
+
+    def load(self):
+        """Open the backend and make sure derived data (counters, indexes) is present"""
+        raise NotImplementedError
+
+    def get_user(self, user_id):
+        raise NotImplementedError
+
+    def get_users(self, user_ids):
+        """Return {user_id: user} for the ids that exist"""
+        raise NotImplementedError
+
+    def find_by_username(self, username):
+        raise NotImplementedError
+
+    def find_by_email(self, email):
+        raise NotImplementedError
+
+    def find_by_referral_code(self, code):
+        raise NotImplementedError
+
+    def iter_users(self):
+        raise NotImplementedError
+
+    def count_users(self):
+        raise NotImplementedError
+
+    def query_users(self, filters, sort='created_at', descending=False, after=None, limit=None):
+        """Non-admin users matching filters, ordered by sort_key(user, sort).
+
+        `after` is the sort key of the last row of the previous page; rows
+        strictly after it (in the requested direction) are returned.
+        """
+        raise NotImplementedError
+
+    def count_users_matching(self, filters):
+        raise NotImplementedError
+
+    def get_upline(self, user_id, limit=None):
+        """Sponsors of user_id, nearest first"""
+        raise NotImplementedError
+
+    def get_subtree(self, user_id):
+        """Return {user_id: user} for user_id and its whole downline"""
+        raise NotImplementedError
+
+    def get_downline_ids(self, user_id, level):
+        """Ids of the members exactly `level` levels below user_id, in joining order"""
+        raise NotImplementedError
+
+    def is_in_team(self, member_id, leader_id):
+        """Is member_id the leader or somewhere in the leader's downline?"""
+        raise NotImplementedError
+
+    def rebuild_ancestry(self):
+        """Rebuild the ancestor index from sponsor_id, returns the users whose entries were wrong"""
+        raise NotImplementedError
+
+    def search_team(self, leader_id, prefix, filters, after=None, limit=None):
+        """Members of the leader's downline with a search key starting with prefix, as (user, level) pairs
+        ordered by search_key(user, prefix).
+
+        `after` is the search key of the last member of the previous page.
+        """
+        raise NotImplementedError
+
+    def query_income(self, user_id, filters, descending=False, after=None, limit=None):
+        """Ledger entries of user_id matching income filters, ordered by ledger_key.
+
+        `after` is the ledger key of the last entry of the previous page.
+        """
+        raise NotImplementedError
+
+    def income_totals(self, user_id, filters):
+        """Return {type: {'count': n, 'amount': sum}} for the entries matching filters"""
+        raise NotImplementedError
+
+    def insert_user(self, user, expect_sponsor=None):
+        """Add a user under its sponsor and bump the upline team counters.
+
+        Raises ConflictError, adding nothing, if a field of the sponsor
+        differs from expect_sponsor.
+        """
+        raise NotImplementedError
+
+    def insert_users(self, users, expect_sponsors=None):
+        """insert_user for many new users, sponsors before their directs, moving every
+        upline counter once.
+
+        expect_sponsors maps existing sponsors to the fields they must still
+        have. Returns [{'user_id', 'reason'}] for the users left out: reason
+        is 'username' or 'email' when it is taken, 'sponsor' when the sponsor
+        failed its expect or was itself left out.
+        """
+        raise NotImplementedError
+
+    def activate(self, user_id, date, cost, seq=None, expect=None):
+        """Mark a user active; seq is the activation event that pays its upline.
+
+        Returns False without changing anything if a field differs from expect.
+        """
+        raise NotImplementedError
+
+    def deactivate(self, user_id):
+        raise NotImplementedError
+
+    def credit(self, user_id, wallet, amount):
+        """Atomically add amount to a wallet and to total_income"""
+        raise NotImplementedError
+
+    def append_income(self, user_id, entry):
+        """Add an entry to the income ledger; an entry_id already there is ignored"""
+        raise NotImplementedError
+
+    def set_fields(self, user_id, fields):
+        raise NotImplementedError
+
+    def payout(self, user_id, wallet, amount, entry, inc=None, expect=None):
+        """Credit a wallet, record the income entry and bump the `inc` counters as one change.
+
+        Returns False without changing anything if a field differs from
+        `expect` or the entry_id was already paid, so callers can re-read and
+        retry and a replayed event never pays twice.
+        """
+        raise NotImplementedError
+
+    def mark_matching_dirty(self, seqs):
+        """Flag users for the next matching settlement.
+
+        seqs is {user_id: activation seq}; each user's matching_dirty_seq is
+        raised to at least that seq.
+        """
+        raise NotImplementedError
+
+    def matching_dirty_users(self):
+        """Every user flagged by mark_matching_dirty and not cleared since"""
+        raise NotImplementedError
+
+    def clear_matching_dirty(self, user_id, seq):
+        """Unflag a settled user, unless a later activation flagged it again meanwhile"""
+        raise NotImplementedError
+
+    # ----- activation events -----
+
+    def next_event_seq(self):
+        raise NotImplementedError
+
+    def enqueue_event(self, event):
+        raise NotImplementedError
+
+    def claim_event(self):
+        """Mark the oldest pending event as processing and return it, or None"""
+        raise NotImplementedError
+
+    def complete_event(self, event_id, status, processed_at, error=None):
+        raise NotImplementedError
+
+    def get_event(self, event_id):
+        raise NotImplementedError
+
+    def event_stats(self):
+        """Return {'depth': unfinished events, 'oldest_created_at': ISO date or None}"""
+        raise NotImplementedError
+
+    # ----- live feed -----
+
+    def publish_feed(self, event):
+        """Hand a feed event ({'channels', 'type', 'data'}) to every process using this database"""
+        raise NotImplementedError
+
+    def feed_since(self, cursor):
+        """Feed events published after cursor, each with a shared `id`; returns (events, cursor).
+
+        A None cursor starts from now.
+        """
+        raise NotImplementedError
+
+    def recompute_team_counts(self):
+        """Rebuild team counters from the sponsor tree, returns the drift found"""
+        raise NotImplementedError
+
+    def get_stats(self):
+        """Return the running aggregate stats (see user_stats)"""
+        raise NotImplementedError
+
+    def recompute_stats(self):
+        """Rebuild the aggregate stats from every user, returns the drift found"""
+        raise NotImplementedError
+
+    def commit(self):
+        """Make the mutations of the current request durable"""
+
+    def refresh(self):
+        """Catch up with what other processes wrote, returns how many of their commits were applied"""
+        return 0
+
+    def snapshot(self):
+        """Compact the on-disk representation, if the backend has one"""
+
+    def after_fork(self):
+        """Reopen whatever a process forked after load() must not share with its parent"""
+
+    def claim(self):
+        """Make sure no other process writes the database while this one does, for
+        backends that cannot share it; raises RuntimeError if one already does"""
+
+    def load_progress(self):
+        """What load() has done so far, for the readiness endpoint"""
+        return {}
+
+
+# ===== JSON FILE BACKEND =====
+# The database lives in memory and is persisted as a compacted snapshot plus
+# an append-only write-ahead log. Every mutation is expressed as an op that is
+# applied to the in-memory dict and buffered; commit() appends the buffered
+# ops as one JSON line and fsyncs it, so a request that touches many users
+# (an activation paying 30 uplines) is replayed all-or-nothing. Every
+# SNAPSHOT_EVERY commits the whole dict is written to a temp file, renamed
+# over the snapshot and the log is truncated. Income entries are not part of
+# the snapshot: each snapshot first appends the entries added since the last
+# one to a separate ledger file, which is never rewritten.
+#
+# Snapshots are JSON (users_database.json) or binary (users_database.snap,
+# see "binary snapshots" below). Either loads; snapshots are written in the
+# store's encoding and, when both files exist, the newer one is read. The
+# file of the other encoding is left alone: `flask convert-snapshot`
+# converts one into the other by hand.
+#
+# share() lets processes forked after load() (preloaded gunicorn workers)
+# write the same files while keeping the loaded data copy-on-write. The WAL
+# is then also the change feed: a process writing holds an exclusive flock
+# on it from its first op to its commit, and first applies whatever the
+# others appended, so expects are checked against every committed write.
+# refresh() applies new records without the lock, for reads. Snapshots no
+# longer truncate the WAL, as the other processes are still reading it; it
+# is compacted by the next share() that finds no process following it (each
+# holds a shared flock on the .followers file). A process writing the files
+# on its own holds an exclusive flock on it instead (claim()), so a second
+# one, or a sharing one, cannot start next to it unnoticed.
+
+SNAPSHOT_FORMAT = 2
+SNAPSHOT_ENCODINGS = ('json', 'binary')
+# Finished events kept around for status queries
+EVENT_HISTORY = 10000
+# Feed events kept for feed_since, and how many a WAL record can number
+FEED_BUFFER = 10000
+FEED_IDS_PER_RECORD = 1000
+
+# ----- binary snapshots -----
+# SNAPSHOT_MAGIC, one byte of binary layout version, then sections, each an
+# unsigned 64-bit little-endian length followed by that many bytes of UTF-8
+# JSON:
+#   header   {'format', 'seq', 'event_seq', 'events', 'fields'}
+#   for every name in header['fields'], two sections:
+#            the (ascending) indexes of the users without that field,
+#            the values of the users that have it, in user order
+#   extra    every user's dict of keys outside FIELDS, or null
+# Users are in the same order in every column (records.to_columns). Each
+# column parses as one plain JSON array, with no per-user object hook,
+# which is what makes this layout load faster than a JSON snapshot.
+# Version 1 was a marshal dump; it is still read so an existing .snap can be
+# loaded (by the Python version that wrote it) and written out again.
+
+SNAPSHOT_MAGIC = b'MLMSNAP'
+BINARY_VERSION = 2
+_SECTION_LENGTH = struct.Struct('<Q')
+
+
+def _write_section(f, value):
+    data = json.dumps(value, separators=(',', ':'), default=json_default).encode()
+    f.write(_SECTION_LENGTH.pack(len(data)))
+    f.write(data)
+
+
+def _read_sections(raw, offset):
+    while offset < len(raw):
+        if offset + _SECTION_LENGTH.size > len(raw):
+            raise ValueError('binary snapshot is truncated')
+        (length,) = _SECTION_LENGTH.unpack_from(raw, offset)
+        offset += _SECTION_LENGTH.size
+        if offset + length > len(raw):
+            raise ValueError('binary snapshot is truncated')
+        yield json.loads(raw[offset:offset + length])
+        offset += length
+
+
+def write_binary(f, header, users):
+    table = to_columns(users)
+    f.write(SNAPSHOT_MAGIC + bytes([BINARY_VERSION]))
+    _write_section(f, dict(header, fields=table['fields']))
+    for column in table['columns']:
+        _write_section(f, [i for i, value in enumerate(column) if value is MISSING])
+        _write_section(f, [value for value in column if value is not MISSING])
+    _write_section(f, table['extra'])
+
+
+def read_binary(raw, progress=None):
+    version = raw[len(SNAPSHOT_MAGIC)]
+    if version == 1:
+        data = marshal.loads(memoryview(raw)[len(SNAPSHOT_MAGIC) + 1:])
+        data['users'] = from_columns(data['users'], progress)
+        return data
+    if version != BINARY_VERSION:
+        raise ValueError(f"binary snapshot version {version} is not supported")
+    sections = list(_read_sections(raw, len(SNAPSHOT_MAGIC) + 1))
+    data = sections[0] if sections else {}
+    fields = data.pop('fields', [])
+    if len(sections) != 2 * len(fields) + 2:
+        raise ValueError('binary snapshot is truncated')
+    data['users'] = from_columns({'fields': fields, 'columns': sections[2:-1:2],
+                                  'missing': sections[1:-1:2], 'extra': sections[-1]}, progress)
+    return data
+
+
+def read_snapshot(path, progress=None):
+    """Parse a snapshot of either encoding into {'seq', 'event_seq', 'events', 'users'}"""
+    # Nothing parsed here is garbage, so collections during the load would
+    # only rescan the growing heap
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(path, 'rb') as f:
+            raw = f.read()
+        if raw.startswith(SNAPSHOT_MAGIC):
+            return read_binary(raw, progress)
+        data = json.loads(raw, object_hook=user_record_hook)
+        del raw
+        if data.get('format') != SNAPSHOT_FORMAT:
+            # Plain {user_id: user} file written before the journal existed
+            return {'seq': 0, 'event_seq': 0, 'events': [], 'users': compact_users(data)}
+        data['users'] = compact_users(data['users'])
+        return data
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def write_snapshot(path, seq, event_seq, events, users, encoding='json'):
+    """Write a snapshot through a temp file renamed over path"""
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'wb' if encoding == 'binary' else 'w') as f:
+        if encoding == 'binary':
+            write_binary(f, {
+                'format': SNAPSHOT_FORMAT,
+                'seq': seq,
+                'event_seq': event_seq,
+                'events': list(events)
+            }, users.values())
+        else:
+            json.dump({
+                'format': SNAPSHOT_FORMAT,
+                'seq': seq,
+                'event_seq': event_seq,
+                'events': list(events),
+                'users': users
+            }, f, default=json_default)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+
+def bump_team_counts(user_id, field, delta, db):
+    """Add delta to a team counter of user_id and all of its uplines.
+
+    Also bumps their branch_version, which read caches of anything built
+    from a user's downline compare against.
+    """
+    current_id = user_id
+    while current_id:
+        u = db.get(current_id)
+        if not u:
+            break
+        u[field] = u.get(field, 0) + delta
+        u['branch_version'] = u.get('branch_version', 0) + 1
+        current_id = u.get('sponsor_id')
+
+
+def joining_key(user):
+    return (user.get('created_at') or '', user['user_id'])
+
+
+def sponsor_order(db):
+    """User ids in joining order, every sponsor before its directs even where their dates disagree"""
+    order = []
+    placed = set()
+    waiting = {}
+    for uid in sorted(db, key=lambda uid: joining_key(db[uid])):
+        sponsor_id = db[uid].get('sponsor_id')
+        if sponsor_id in db and sponsor_id not in placed:
+            waiting.setdefault(sponsor_id, []).append(uid)
+            continue
+        stack = [uid]
+        while stack:
+            uid = stack.pop()
+            order.append(uid)
+            placed.add(uid)
+            stack.extend(reversed(waiting.pop(uid, ())))
+    return order
+
+
+def recompute_team_counts(db):
+    """Rebuild team counters from scratch, returns the users whose stored counters were wrong"""
+    order = sponsor_order(db)
+
+    sizes = {}
+    active_sizes = {}
+    for uid in reversed(order):
+        u = db[uid]
+        sizes[uid] = 1
+        active_sizes[uid] = 1 if u.get('activation_status') == 'active' else 0
+        for d in u.get('direct_referrals', []):
+            if d in sizes:
+                sizes[uid] += sizes[d]
+                active_sizes[uid] += active_sizes[d]
+
+    drift = []
+    for uid in order:
+        u = db[uid]
+        if u.get('team_size') != sizes[uid] or u.get('active_team_size') != active_sizes[uid]:
+            drift.append({
+                'user_id': uid,
+                'team_size': u.get('team_size'),
+                'expected_team_size': sizes[uid],
+                'active_team_size': u.get('active_team_size'),
+                'expected_active_team_size': active_sizes[uid]
+            })
+            u['team_size'] = sizes[uid]
+            u['active_team_size'] = active_sizes[uid]
+            u['branch_version'] = u.get('branch_version', 0) + 1
+
+    return drift
+
+
+# ===== AGGREGATE STATS =====
+# Running totals over non-admin users for the admin dashboard, kept as a
+# flat {name: number} dict so a backend can store them in one document and
+# move them with $inc. Every write adds the difference between the touched
+# user's contribution after and before it.
+
+STAT_WALLETS = ('wallet_balance', 'activation_wallet', 'matching_wallet', 'total_income')
+
+
+def user_stats(user):
+    """A user's contribution to the aggregate stats; admins do not count"""
+    if not user or user.get('is_admin'):
+        return {}
+    stats = {
+        'users': 1,
+        f"status:{user.get('status')}": 1,
+        f"activation_status:{user.get('activation_status')}": 1
+    }
+    for wallet in STAT_WALLETS:
+        stats[wallet] = user.get(wallet, 0)
+    return stats
+
+
+def stats_delta(before, after):
+    delta = dict(after)
+    for name, value in before.items():
+        delta[name] = delta.get(name, 0) - value
+    return {name: value for name, value in delta.items() if value}
+
+
+def add_stats(stats, delta):
+    for name, value in delta.items():
+        stats[name] = stats.get(name, 0) + value
+
+
+def compute_stats(users):
+    stats = {}
+    for user in users:
+        add_stats(stats, user_stats(user))
+    return stats
+
+
+def stats_drift(stored, expected):
+    """Stats whose stored value differs from the recomputed one"""
+    drift = []
+    for name in sorted(set(stored) | set(expected)):
+        value, expected_value = stored.get(name, 0), expected.get(name, 0)
+        if not math.isclose(value, expected_value, abs_tol=1e-6):
+            drift.append({'stat': name, 'stored': value, 'expected': expected_value})
+    return drift
+
+
+# ===== OPS =====
+# Each op is a plain dict with an 'op' name. Apply functions must be
+# deterministic: they run for live requests and again on WAL replay.
+
+def _apply_create_user(db, rec):
+    user = UserRecord(rec['user'])
+    user_id = user['user_id']
+    db[user_id] = user
+    sponsor = db.get(user.get('sponsor_id'))
+    if not sponsor:
+        return
+    sponsor['direct_referrals'] = [*sponsor.get('direct_referrals', []), user_id]
+    sponsor['version'] = sponsor.get('version', 0) + 1
+    bump_team_counts(sponsor['user_id'], 'team_size', user.get('team_size', 1), db)
+    if user.get('activation_status') == 'active':
+        bump_team_counts(sponsor['user_id'], 'active_team_size', 1, db)
+    sponsor['power_leg_user'] = sponsor['direct_referrals'][0]
+    sponsor['other_leg_users'] = sponsor['direct_referrals'][1:]
+
+
+def _apply_create_users(db, rec):
+    """create_user for a batch, sponsors first, with each upline's counters moved once"""
+    users = [UserRecord(u) for u in rec['users']]
+    for user in users:
+        db[user['user_id']] = user
+        sponsor = db.get(user.get('sponsor_id'))
+        if sponsor:
+            sponsor['direct_referrals'] = [*sponsor.get('direct_referrals', []), user['user_id']]
+            sponsor['version'] = sponsor.get('version', 0) + 1
+    # Members joined below every user of the batch, deepest first
+    below = {}
+    for user in reversed(users):
+        team, active = below.pop(user['user_id'], (0, 0))
+        if team:
+            user['team_size'] = user.get('team_size', 1) + team
+            user['active_team_size'] = user.get('active_team_size', 0) + active
+            user['branch_version'] = user.get('branch_version', 0) + 1
+        if user.get('activation_status') == 'active':
+            active += 1
+        sponsor_team, sponsor_active = below.get(user.get('sponsor_id'), (0, 0))
+        below[user.get('sponsor_id')] = (sponsor_team + user.get('team_size', 1), sponsor_active + active)
+    # What is left hangs below users that were already there
+    for sponsor_id, (team, active) in below.items():
+        if sponsor_id in db:
+            bump_team_counts(sponsor_id, 'team_size', team, db)
+            if active:
+                bump_team_counts(sponsor_id, 'active_team_size', active, db)
+
+
+def _set_activation_status(db, user, status):
+    was_active = user.get('activation_status') == 'active'
+    user['activation_status'] = status
+    user['version'] = user.get('version', 0) + 1
+    is_active = status == 'active'
+    if was_active != is_active:
+        bump_team_counts(user['user_id'], 'active_team_size', 1 if is_active else -1, db)
+
+
+def _apply_activate(db, rec):
+    user = db[rec['user_id']]
+    if user.get('activation_status') != 'active':
+        user['activation_seq'] = rec.get('seq')
+    _set_activation_status(db, user, 'active')
+    user['activation_date'] = rec['date']
+    user['wallet_balance'] = user.get('wallet_balance', 0) - rec['cost']
+
+
+def _apply_deactivate(db, rec):
+    user = db[rec['user_id']]
+    _set_activation_status(db, user, 'inactive')
+    user.pop('activation_seq', None)
+
+
+def _apply_credit(db, rec):
+    user = db[rec['user_id']]
+    user[rec['wallet']] = user.get(rec['wallet'], 0) + rec['amount']
+    user['total_income'] = user.get('total_income', 0) + rec['amount']
+
+
+def _apply_set(db, rec):
+    db[rec['user_id']].update(rec['fields'])
+
+
+def _apply_inc(db, rec):
+    user = db[rec['user_id']]
+    for field, delta in rec['fields'].items():
+        user[field] = user.get(field, 0) + delta
+
+
+def _apply_mark_matching_dirty(db, rec):
+    for user_id, seq in rec['seqs'].items():
+        user = db.get(user_id)
+        if user is not None and user.get('matching_dirty_seq', 0) < seq:
+            user['matching_dirty_seq'] = seq
+
+
+def _apply_clear_matching_dirty(db, rec):
+    user = db.get(rec['user_id'])
+    if user is not None and user.get('matching_dirty_seq') == rec['seq']:
+        del user['matching_dirty_seq']
+
+
+APPLY = {
+    'create_user': _apply_create_user,
+    'create_users': _apply_create_users,
+    'activate': _apply_activate,
+    'deactivate': _apply_deactivate,
+    'credit': _apply_credit,
+    'set': _apply_set,
+    'inc': _apply_inc,
+    'mark_matching_dirty': _apply_mark_matching_dirty,
+    'clear_matching_dirty': _apply_clear_matching_dirty,
+}
+
+
+def apply_op(db, rec):
+    APPLY[rec['op']](db, rec)
+
+
+# ===== USER QUERIES =====
+# filters: status, activation_status, created_from, created_to (ISO dates,
+# inclusive). Sort keys put users without a value first and break ties on
+# user_id, so they can be used as pagination cursors.
+
+def sort_key(user, field):
+    value = user.get(field)
+    return (value is not None, value, user['user_id'])
+
+
+def matches_filters(user, filters):
+    if user.get('is_admin'):
+        return False
+    for field in ('status', 'activation_status'):
+        if filters.get(field) and user.get(field) != filters[field]:
+            return False
+    created_at = user.get('created_at') or ''
+    if filters.get('created_from') and created_at < filters['created_from']:
+        return False
+    if filters.get('created_to') and created_at > filters['created_to']:
+        return False
+    return True
+
+
+# ===== TEAM SEARCH =====
+# A member is found by a prefix of its lowercased username, first name, last
+# name or full name: its search keys. Names never change once a member joins,
+# so neither do its keys. Results are ordered by the smallest key of the
+# member that starts with the prefix, then user_id, which is also the
+# pagination cursor. filters: min_level, max_level (levels below the leader,
+# directs are level 1) and activation_status.
+
+def _search_names(user):
+    first = (user.get('first_name') or '').lower()
+    last = (user.get('last_name') or '').lower()
+    return (user.get('username') or '').lower(), first, last, f"{first} {last}".strip()
+
+
+def search_keys(user):
+    return set(_search_names(user)) - {''}
+
+
+def search_key(user, prefix):
+    """Sort key of user in a search for (non-empty) prefix, None if none of its keys starts with it"""
+    matched = [key for key in _search_names(user) if key.startswith(prefix)]
+    return (min(matched), user['user_id']) if matched else None
+
+
+def matches_team_filters(user, level, filters):
+    if filters.get('min_level') and level < filters['min_level']:
+        return False
+    if filters.get('max_level') and level > filters['max_level']:
+        return False
+    if filters.get('activation_status') and user.get('activation_status') != filters['activation_status']:
+        return False
+    return True
+
+
+# ===== INCOME LEDGER =====
+# Income entries live outside the user documents, one row per payout keyed
+# by its entry_id. income filters: type, date_from, date_to (ISO dates,
+# inclusive, compared like created_from/created_to).
+
+def ledger_key(entry):
+    return (entry['date'], entry['entry_id'])
+
+
+class Ledger:
+    """Income entries per user, kept sorted by ledger_key.
+
+    Each (user, type) also keeps cumulative amounts, so the totals of any
+    date range are two bisects and a subtraction.
+    """
+
+    def __init__(self):
+        self.ids = set()
+        self.entries = {}
+        self.keys = {}
+        self.by_type = {}
+
+    def add(self, user_id, entry):
+        """Insert an entry, returns False if its entry_id is already in the ledger"""
+        if entry['entry_id'] in self.ids:
+            return False
+        self.ids.add(entry['entry_id'])
+        key = ledger_key(entry)
+        keys = self.keys.setdefault(user_id, [])
+        pos = bisect.bisect(keys, key)
+        keys.insert(pos, key)
+        self.entries.setdefault(user_id, []).insert(pos, entry)
+
+        types = self.by_type.setdefault(user_id, {})
+        typed = types.setdefault(entry.get('type'), {'keys': [], 'entries': [], 'cum': []})
+        pos = bisect.bisect(typed['keys'], key)
+        typed['keys'].insert(pos, key)
+        typed['entries'].insert(pos, entry)
+        typed['cum'].insert(pos, 0)
+        # Entries almost always arrive in date order, so this touches one slot
+        cum = typed['cum']
+        for i in range(pos, len(cum)):
+            cum[i] = (cum[i - 1] if i else 0) + typed['entries'][i].get('amount', 0)
+        return True
+
+    def _range(self, keys, filters, descending=False, after=None):
+        lo, hi = 0, len(keys)
+        if filters.get('date_from'):
+            lo = bisect.bisect_left(keys, (filters['date_from'],))
+        if filters.get('date_to'):
+            hi = bisect.bisect_right(keys, (filters['date_to'], chr(0x10ffff)))
+        if after is not None:
+            if descending:
+                hi = min(hi, bisect.bisect_left(keys, tuple(after)))
+            else:
+                lo = max(lo, bisect.bisect_right(keys, tuple(after)))
+        return lo, max(lo, hi)
+
+    def query(self, user_id, filters, descending=False, after=None, limit=None):
+        if filters.get('type'):
+            typed = self.by_type.get(user_id, {}).get(filters['type'], {})
+            keys, entries = typed.get('keys', []), typed.get('entries', [])
+        else:
+            keys, entries = self.keys.get(user_id, []), self.entries.get(user_id, [])
+        lo, hi = self._range(keys, filters, descending, after)
+        if limit is not None:
+            if descending:
+                lo = max(lo, hi - limit)
+            else:
+                hi = min(hi, lo + limit)
+        page = entries[lo:hi]
+        return page[::-1] if descending else page
+
+    def totals(self, user_id, filters):
+        totals = {}
+        for income_type, typed in self.by_type.get(user_id, {}).items():
+            if filters.get('type') and income_type != filters['type']:
+                continue
+            lo, hi = self._range(typed['keys'], filters)
+            if hi > lo:
+                cum = typed['cum']
+                totals[income_type] = {'count': hi - lo, 'amount': cum[hi - 1] - (cum[lo - 1] if lo else 0)}
+        return totals
+
+
+# ===== SECONDARY INDEXES =====
+
+class UserIndex:
+    """Maps lowercased username/email and referral_code to user_id"""
+
+    def __init__(self):
+        self.username = {}
+        self.email = {}
+        self.referral_code = {}
+
+    def build(self, db):
+        self.__init__()
+        for user in db.values():
+            self.add(user)
+
+    def add(self, user):
+        user_id = user['user_id']
+        if user.get('username'):
+            self.username.setdefault(user['username'].lower(), user_id)
+        if user.get('email'):
+            self.email.setdefault(user['email'].lower(), user_id)
+        if user.get('referral_code'):
+            self.referral_code.setdefault(user['referral_code'], user_id)
+
+
+# Levels of ancestry kept per user: enough for every level income payout
+# without a walk. Deeper relations are answered by hopping ANCESTRY_LEVELS
+# levels at a time.
+ANCESTRY_LEVELS = 30
+
+
+class AncestryIndex:
+    """Closure table of (ancestor, descendant, depth) rows up to ANCESTRY_LEVELS deep.
+
+    Users are added in joining order, so each level lists its members in
+    joining order too.
+    """
+
+    def __init__(self):
+        self.depth = {}
+        self.up = {}
+        self.down = {}
+
+    def build(self, db):
+        self.__init__()
+        for uid in sponsor_order(db):
+            self.add(db[uid])
+
+    def add(self, user):
+        user_id = user['user_id']
+        sponsor_id = user.get('sponsor_id')
+        if sponsor_id in self.depth:
+            up = [sponsor_id] + self.up[sponsor_id][:ANCESTRY_LEVELS - 1]
+            self.depth[user_id] = self.depth[sponsor_id] + 1
+        else:
+            up = []
+            self.depth[user_id] = 0
+        self.up[user_id] = up
+        self.down[user_id] = {}
+        for level, ancestor_id in enumerate(up, start=1):
+            self.down[ancestor_id].setdefault(level, []).append(user_id)
+
+    def upline(self, user_id, limit=None):
+        ids = list(self.up.get(user_id, []))
+        chunk = ids
+        while len(chunk) == ANCESTRY_LEVELS and (limit is None or len(ids) < limit):
+            chunk = self.up[chunk[-1]]
+            ids.extend(chunk)
+        return ids if limit is None else ids[:limit]
+
+    def is_descendant(self, member_id, leader_id):
+        if member_id not in self.depth or leader_id not in self.depth:
+            return False
+        levels = self.depth[member_id] - self.depth[leader_id]
+        if levels <= 0:
+            return member_id == leader_id
+        while levels > ANCESTRY_LEVELS:
+            member_id = self.up[member_id][-1]
+            levels -= ANCESTRY_LEVELS
+        return self.up[member_id][levels - 1] == leader_id
+
+    def level(self, user_id, level):
+        if level <= ANCESTRY_LEVELS:
+            return list(self.down.get(user_id, {}).get(level, []))
+        ids = []
+        for uid in self.down.get(user_id, {}).get(ANCESTRY_LEVELS, []):
+            ids.extend(self.level(uid, level - ANCESTRY_LEVELS))
+        return ids
+
+
+class SearchIndex:
+    """Sorted (search key, user_id) rows of every user, held in chunks so an insert only moves one chunk"""
+
+    CHUNK = 1000
+
+    def __init__(self):
+        self.chunks = []
+        self.maxes = []
+
+    def build(self, db):
+        rows = sorted((key, uid) for uid, user in db.items() for key in search_keys(user))
+        self.chunks = [rows[i:i + self.CHUNK] for i in range(0, len(rows), self.CHUNK)]
+        self.maxes = [chunk[-1] for chunk in self.chunks]
+
+    def add(self, user):
+        for key in search_keys(user):
+            row = (key, user['user_id'])
+            if not self.chunks:
+                self.chunks.append([row])
+                self.maxes.append(row)
+                continue
+            i = min(bisect.bisect_left(self.maxes, row), len(self.chunks) - 1)
+            chunk = self.chunks[i]
+            bisect.insort(chunk, row)
+            self.maxes[i] = chunk[-1]
+            if len(chunk) > 2 * self.CHUNK:
+                self.chunks[i:i + 1] = [chunk[:self.CHUNK], chunk[self.CHUNK:]]
+                self.maxes[i:i + 1] = [chunk[self.CHUNK - 1], chunk[-1]]
+
+    def _after(self, row):
+        """(chunk, offset) of the first row past `row`"""
+        i = bisect.bisect_right(self.maxes, row)
+        if i == len(self.chunks):
+            return i, 0
+        return i, bisect.bisect_right(self.chunks[i], row)
+
+    def count(self, prefix):
+        """Rows whose key starts with prefix"""
+        i, lo = self._after((prefix,))
+        j, hi = self._after((prefix + chr(0x10ffff),))
+        return sum(len(chunk) for chunk in self.chunks[i:j]) - lo + hi
+
+    def scan(self, prefix, after=None):
+        """Rows whose key starts with prefix, in order, past `after` if given"""
+        i, offset = self._after((prefix,) if after is None else max((prefix,), tuple(after)))
+        while i < len(self.chunks):
+            for row in self.chunks[i][offset:]:
+                if not row[0].startswith(prefix):
+                    return
+                yield row
+            i, offset = i + 1, 0
+
+
+class JsonStore(Store):
+    """In-memory user database persisted as snapshot + write-ahead log"""
+
+    def __init__(self, db_file, wal_file=None, snapshot_every=1000, ledger_file=None,
+                 snapshot_encoding='json', snapshot_file=None):
+        if snapshot_encoding not in SNAPSHOT_ENCODINGS:
+            raise ValueError(f"snapshot_encoding must be one of {', '.join(SNAPSHOT_ENCODINGS)}")
+        self.db_file = db_file
+        self.snap_file = snapshot_file or os.path.splitext(db_file)[0] + '.snap'
+        self.wal_file = wal_file or os.path.splitext(db_file)[0] + '.wal'
+        self.ledger_file = ledger_file or os.path.splitext(db_file)[0] + '.ledger'
+        self.followers_file = os.path.splitext(self.wal_file)[0] + '.followers'
+        self.snapshot_every = snapshot_every
+        self.snapshot_encoding = snapshot_encoding
+        self.db = {}
+        # Built from db on first use, see _built
+        self._index = None
+        self._ancestry = None
+        self._search_index = None
+        self._stats = None
+        self._matching_dirty = None
+        self.progress = {'phase': 'idle'}
+        self.ledger = Ledger()
+        self._ledger_tail = []
+        self.events = OrderedDict()
+        self.event_seq = 0
+        self.seq = 0
+        self.commits_since_snapshot = 0
+        # _lock guards the WAL file; _apply_lock guards the in-memory data.
+        # Ops from different requests only ever touch a user's fields through
+        # increments or causally ordered steps (a user is created before it
+        # is paid), so the WAL order of two concurrent commits does not matter.
+        self._lock = threading.Lock()
+        self._apply_lock = threading.RLock()
+        self._local = threading.local()
+        self._inflight = 0
+        self._snapshot_due = False
+        self._pending_events = []
+        self._claimed = set()
+        self._wal = None
+        self.shared = False
+        self._tail = None
+        self._tail_offset = 0
+        self._followers = None
+        self._feed = deque(maxlen=FEED_BUFFER)
+
+    # ----- loading -----
+
+    def load(self):
+        """Load the ledger and the latest snapshot and replay the WAL tail on top of them"""
+        start = time.monotonic()
+        self.progress = {'phase': 'ledger', 'ledger_entries': 0, 'users': 0, 'wal_records': 0}
+        self._read_ledger()
+        self.progress['phase'] = 'snapshot'
+        self._read_snapshot()
+        migrated = self._migrate_income_history()
+        self.progress['phase'] = 'wal'
+        replayed = self._replay_wal()
+        self._wal = open(self.wal_file, 'a')
+        self.commits_since_snapshot = replayed
+        if any('team_size' not in u or 'active_team_size' not in u for u in self.db.values()):
+            # Database written before the team counters existed
+            recompute_team_counts(self.db)
+            self.snapshot()
+        elif migrated:
+            self.snapshot()
+        self.progress.update(phase='done', users=len(self.db), seconds=round(time.monotonic() - start, 3))
+        return self.db
+
+    def load_progress(self):
+        return dict(self.progress)
+
+    # ----- sharing -----
+
+    def claim(self):
+        """Own the files without sharing them (see above); call before load()"""
+        followers = open(self.followers_file, 'a')
+        try:
+            fcntl.flock(followers.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            followers.close()
+            raise RuntimeError(f"{self.wal_file} is in use by another process: stop it, "
+                               "or run every process with SHARED_DATABASE=1")
+        self._followers = followers
+
+    def share(self):
+        """Get ready to be forked into processes that all write this database (see above)"""
+        with open(self.followers_file, 'a') as followers:
+            try:
+                fcntl.flock(followers.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Processes sharing the database are running: their WAL stays as it is
+                pass
+            else:
+                if self.commits_since_snapshot:
+                    self.snapshot()
+        # Built here, the indexes are shared with the forks as well
+        for name in ('index', 'ancestry', 'search_index', 'stats', 'matching_dirty'):
+            getattr(self, name)
+        self.shared = True
+        self.after_fork()
+        self._tail_offset = os.fstat(self._tail.fileno()).st_size
+
+    def after_fork(self):
+        """Own files and locks for a forked process; an inherited flock would be shared with the parent"""
+        self._lock = threading.Lock()
+        self._apply_lock = threading.RLock()
+        self._writer = threading.Lock()
+        self._local = threading.local()
+        self._wal.close()
+        self._wal = open(self.wal_file, 'a')
+        if self._tail:
+            self._tail.close()
+        self._tail = open(self.wal_file, 'rb')
+        if self._followers:
+            self._followers.close()
+        self._followers = open(self.followers_file, 'a')
+        fcntl.flock(self._followers.fileno(), fcntl.LOCK_SH)
+
+    def refresh(self):
+        if not self.shared or os.fstat(self._tail.fileno()).st_size == self._tail_offset:
+            return 0
+        applied = 0
+        with self._apply_lock:
+            self._tail.seek(self._tail_offset)
+            data = self._tail.read()
+            # A record still being written is left for the next call
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].splitlines():
+                entry = json.loads(line)
+                if entry['seq'] <= self.seq:
+                    continue
+                for rec in entry['ops']:
+                    self._apply(rec)
+                self._collect_feed(entry['seq'], entry['ops'])
+                self.seq = entry['seq']
+                applied += 1
+            self._tail_offset += end
+        return applied
+
+    def _begin_write(self):
+        """In shared mode, hold the WAL lock from a thread's first op until its commit"""
+        if not self.shared or getattr(self._local, 'writing', False):
+            return
+        self._writer.acquire()
+        fcntl.flock(self._wal.fileno(), fcntl.LOCK_EX)
+        self._local.writing = True
+        self.refresh()
+        if os.fstat(self._tail.fileno()).st_size > self._tail_offset:
+            # Torn write of a process that died holding the lock
+            log.warning('ignoring torn WAL record', extra={'offset': self._tail_offset})
+            os.truncate(self.wal_file, self._tail_offset)
+
+    def _end_write(self):
+        if getattr(self._local, 'writing', False):
+            self._local.writing = False
+            fcntl.flock(self._wal.fileno(), fcntl.LOCK_UN)
+            self._writer.release()
+
+    # ----- lazy indexes -----
+    # The indexes and the running stats are derived from db, so load() leaves
+    # them out and the first reader builds them under the apply lock. Writes
+    # before that skip them: the build sees every user already applied.
+
+    def _built(self, name, build):
+        value = getattr(self, name)
+        if value is None:
+            with self._apply_lock:
+                value = getattr(self, name)
+                if value is None:
+                    value = build()
+                    setattr(self, name, value)
+        return value
+
+    def _build_index(self, cls):
+        index = cls()
+        index.build(self.db)
+        return index
+
+    @property
+    def index(self):
+        return self._built('_index', lambda: self._build_index(UserIndex))
+
+    @property
+    def ancestry(self):
+        return self._built('_ancestry', lambda: self._build_index(AncestryIndex))
+
+    @property
+    def search_index(self):
+        return self._built('_search_index', lambda: self._build_index(SearchIndex))
+
+    @property
+    def stats(self):
+        return self._built('_stats', lambda: compute_stats(self.db.values()))
+
+    @property
+    def matching_dirty(self):
+        return self._built('_matching_dirty', lambda: {
+            uid for uid, u in self.db.items() if 'matching_dirty_seq' in u
+        })
+
+    def _read_ledger(self):
+        if not os.path.exists(self.ledger_file):
+            return
+        good_offset = 0
+        with open(self.ledger_file, 'rb') as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    log.warning('ignoring torn ledger record', extra={'offset': good_offset})
+                    break
+                good_offset += len(line)
+                self.ledger.add(row['user_id'], row['entry'])
+                self.progress['ledger_entries'] += 1
+        if good_offset != os.path.getsize(self.ledger_file):
+            with open(self.ledger_file, 'r+b') as f:
+                f.truncate(good_offset)
+
+    def _migrate_income_history(self):
+        """Move income_history lists embedded by older versions into the ledger"""
+        migrated = 0
+        for user_id, user in self.db.items():
+            for i, entry in enumerate(user.pop('income_history', None) or []):
+                entry = dict(entry)
+                entry.setdefault('entry_id', f"{user_id}:{i}")
+                self._apply_income({'user_id': user_id, 'entry': entry})
+                migrated += 1
+        return migrated
+
+    def _snapshot_path(self, encoding):
+        return self.snap_file if encoding == 'binary' else self.db_file
+
+    def _read_snapshot(self):
+        # Both files exist once the encoding was switched; the newer one is
+        # the snapshot
+        paths = [p for p in (self.db_file, self.snap_file) if os.path.exists(p)]
+        if not paths:
+            return
+        path = max(paths, key=os.path.getmtime)
+        try:
+            data = read_snapshot(path, progress=lambda n: self.progress.update(users=n))
+        except (OSError, ValueError, EOFError, TypeError) as e:
+            raise RuntimeError(f"Cannot read database snapshot {path}: {e}")
+        self.db = data['users']
+        self.progress['users'] = len(self.db)
+        self.seq = data['seq']
+        self.event_seq = data.get('event_seq', 0)
+        for event in data.get('events', []):
+            self._apply_enqueue_event({'event': event})
+
+    def _replay_wal(self):
+        if not os.path.exists(self.wal_file):
+            return 0
+        replayed = 0
+        good_offset = 0
+        with open(self.wal_file, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn write from a crash; everything after it is dropped
+                    log.warning('ignoring torn WAL record', extra={'offset': good_offset})
+                    break
+                good_offset += len(line)
+                if entry['seq'] <= self.seq:
+                    continue
+                for rec in entry['ops']:
+                    self._apply(rec)
+                self.seq = entry['seq']
+                replayed += 1
+                self.progress['wal_records'] = replayed
+        if good_offset != os.path.getsize(self.wal_file):
+            with open(self.wal_file, 'r+b') as f:
+                f.truncate(good_offset)
+        return replayed
+
+    # ----- reads -----
+
+    def get_user(self, user_id):
+        return self.db.get(user_id)
+
+    def get_users(self, user_ids):
+        return {uid: self.db[uid] for uid in user_ids if uid in self.db}
+
+    def iter_users(self):
+        return iter(list(self.db.values()))
+
+    def count_users(self):
+        return len(self.db)
+
+    def query_users(self, filters, sort='created_at', descending=False, after=None, limit=None):
+        def key(u):
+            return sort_key(u, sort)
+        rows = [u for u in list(self.db.values()) if matches_filters(u, filters)]
+        if after is not None:
+            after = tuple(after)
+            rows = [u for u in rows if (key(u) < after if descending else key(u) > after)]
+        if limit is not None:
+            pick = heapq.nlargest if descending else heapq.nsmallest
+            return pick(limit, rows, key=key)
+        rows.sort(key=key, reverse=descending)
+        return rows
+
+    def count_users_matching(self, filters):
+        return sum(1 for u in list(self.db.values()) if matches_filters(u, filters))
+
+    def get_upline(self, user_id, limit=None):
+        return [self.db[uid] for uid in self.ancestry.upline(user_id, limit)]
+
+    def get_subtree(self, user_id):
+        subtree = {}
+        stack = [user_id]
+        while stack:
+            uid = stack.pop()
+            u = self.db.get(uid)
+            if u and uid not in subtree:
+                subtree[uid] = u
+                stack.extend(u.get('direct_referrals', []))
+        return subtree
+
+    def get_downline_ids(self, user_id, level):
+        with self._apply_lock:
+            ids = self.ancestry.level(user_id, level)
+            if level > ANCESTRY_LEVELS:
+                # Joined up from several members' levels
+                ids.sort(key=lambda uid: joining_key(self.db[uid]))
+            return ids
+
+    def is_in_team(self, member_id, leader_id):
+        return self.ancestry.is_descendant(member_id, leader_id)
+
+    def rebuild_ancestry(self):
+        with self._apply_lock:
+            expected = self._build_index(AncestryIndex)
+            drift = [
+                {'user_id': uid, 'upline': self.ancestry.up.get(uid), 'expected_upline': up}
+                for uid, up in expected.up.items()
+                if self.ancestry.up.get(uid) != up or self.ancestry.depth.get(uid) != expected.depth[uid]
+            ]
+            self._ancestry = expected
+        return drift
+
+    def search_team(self, leader_id, prefix, filters, after=None, limit=None):
+        # Either walk the matching keys in order until the page is full, or
+        # walk the team and sort its matches. The first reads about
+        # limit * len(db) / team keys when matches spread evenly over the
+        # network, but a team can also hold only the last of them: it gives
+        # up once it has read as many keys as the team has members.
+        with self._apply_lock:
+            leader = self.db.get(leader_id)
+            if leader is None:
+                return []
+            ancestry = self.ancestry
+            team = leader.get('team_size', 1) - 1
+            expected = self.search_index.count(prefix)
+            if limit is not None:
+                expected = min(expected, limit * len(self.db) // max(team, 1))
+            if team < expected:
+                return self._search_levels(leader_id, prefix, filters, after, limit)
+            base = ancestry.depth[leader_id]
+            page = []
+            for read, (key, uid) in enumerate(self.search_index.scan(prefix, after)):
+                if read > team:
+                    return self._search_levels(leader_id, prefix, filters, after, limit)
+                if uid == leader_id or not ancestry.is_descendant(uid, leader_id):
+                    continue
+                user = self.db[uid]
+                # A member is listed once, under its smallest matching key
+                if search_key(user, prefix)[0] != key:
+                    continue
+                level = ancestry.depth[uid] - base
+                if matches_team_filters(user, level, filters):
+                    page.append((user, level))
+                    if len(page) == limit:
+                        break
+            return page
+
+    def _search_levels(self, leader_id, prefix, filters, after, limit):
+        after = tuple(after) if after is not None else None
+        rows = []
+        level = filters.get('min_level') or 1
+        while not (filters.get('max_level') and level > filters['max_level']):
+            member_ids = self.ancestry.level(leader_id, level)
+            if not member_ids:
+                break
+            for uid in member_ids:
+                user = self.db[uid]
+                if not matches_team_filters(user, level, filters):
+                    continue
+                key = search_key(user, prefix)
+                if key and (after is None or key > after):
+                    rows.append((key, user, level))
+            level += 1
+        if limit is not None:
+            rows = heapq.nsmallest(limit, rows, key=lambda row: row[0])
+        else:
+            rows.sort(key=lambda row: row[0])
+        return [(user, level) for _, user, level in rows]
+
+    def query_income(self, user_id, filters, descending=False, after=None, limit=None):
+        with self._apply_lock:
+            return self.ledger.query(user_id, filters, descending, after, limit)
+
+    def income_totals(self, user_id, filters):
+        with self._apply_lock:
+            return self.ledger.totals(user_id, filters)
+
+    def find_by_username(self, username):
+        return self.db.get(self.index.username.get((username or '').lower()))
+
+    def find_by_email(self, email):
+        return self.db.get(self.index.email.get((email or '').lower()))
+
+    def find_by_referral_code(self, code):
+        return self.db.get(self.index.referral_code.get(code))
+
+    # ----- writing -----
+
+    def _pending(self):
+        if not hasattr(self._local, 'ops'):
+            self._local.ops = []
+        return self._local.ops
+
+    def insert_user(self, user, expect_sponsor=None):
+        self._begin_write()
+        with self._apply_lock:
+            if self.find_by_username(user['username']):
+                raise DuplicateUserError('username')
+            if self.find_by_email(user['email']):
+                raise DuplicateUserError('email')
+            if self.find_by_referral_code(user.get('referral_code')):
+                raise DuplicateUserError('referral_code')
+            if expect_sponsor and not matches_expect(self.db.get(user.get('sponsor_id')) or {}, expect_sponsor):
+                raise ConflictError(user.get('sponsor_id'))
+            self.record('create_user', user=user)
+
+    def insert_users(self, users, expect_sponsors=None):
+        expect_sponsors = expect_sponsors or {}
+        skipped = []
+        batch = []
+        left_out = set()
+        taken = {'username': set(), 'email': set()}
+        self._begin_write()
+        with self._apply_lock:
+            for user in users:
+                sponsor_id = user.get('sponsor_id')
+                if sponsor_id in left_out or (
+                        sponsor_id in expect_sponsors
+                        and not matches_expect(self.db.get(sponsor_id) or {}, expect_sponsors[sponsor_id])):
+                    reason = 'sponsor'
+                elif user['username'].lower() in taken['username'] or self.find_by_username(user['username']):
+                    reason = 'username'
+                elif user['email'].lower() in taken['email'] or self.find_by_email(user['email']):
+                    reason = 'email'
+                else:
+                    batch.append(user)
+                    taken['username'].add(user['username'].lower())
+                    taken['email'].add(user['email'].lower())
+                    continue
+                left_out.add(user['user_id'])
+                skipped.append({'user_id': user['user_id'], 'reason': reason})
+            if batch:
+                self.record('create_users', users=batch)
+        return skipped
+
+    def activate(self, user_id, date, cost, seq=None, expect=None):
+        self._begin_write()
+        with self._apply_lock:
+            if expect and not matches_expect(self.db.get(user_id) or {}, expect):
+                return False
+            self.record('activate', user_id=user_id, date=date, cost=cost, seq=seq)
+        return True
+
+    def deactivate(self, user_id):
+        self.record('deactivate', user_id=user_id)
+
+    def credit(self, user_id, wallet, amount):
+        self.record('credit', user_id=user_id, wallet=wallet, amount=amount)
+
+    def append_income(self, user_id, entry):
+        self.record('income', user_id=user_id, entry=entry)
+
+    def set_fields(self, user_id, fields):
+        self.record('set', user_id=user_id, fields=fields)
+
+    def payout(self, user_id, wallet, amount, entry, inc=None, expect=None):
+        self._begin_write()
+        with self._apply_lock:
+            user = self.db.get(user_id)
+            if not user:
+                return False
+            if not matches_expect(user, expect) or entry['entry_id'] in self.ledger.ids:
+                return False
+            self.credit(user_id, wallet, amount)
+            self.append_income(user_id, entry)
+            if inc:
+                self.record('inc', user_id=user_id, fields=inc)
+        return True
+
+    def mark_matching_dirty(self, seqs):
+        self.record('mark_matching_dirty', seqs=seqs)
+
+    def matching_dirty_users(self):
+        with self._apply_lock:
+            return [self.db[uid] for uid in self.matching_dirty]
+
+    def clear_matching_dirty(self, user_id, seq):
+        self.record('clear_matching_dirty', user_id=user_id, seq=seq)
+
+    def recompute_team_counts(self):
+        with self._apply_lock:
+            drift = recompute_team_counts(self.db)
+        self.snapshot()
+        return drift
+
+    def get_stats(self):
+        return dict(self.stats)
+
+    def recompute_stats(self):
+        with self._apply_lock:
+            expected = compute_stats(self.db.values())
+            drift = stats_drift(self.stats, expected)
+            self._stats = expected
+        return drift
+
+    # ----- activation events -----
+
+    def next_event_seq(self):
+        self._begin_write()
+        with self._apply_lock:
+            self.event_seq += 1
+            return self.event_seq
+
+    def enqueue_event(self, event):
+        self.record('enqueue_event', event=event)
+
+    def claim_event(self):
+        if self.shared:
+            return self._claim_shared_event()
+        with self._apply_lock:
+            while self._pending_events:
+                _, event_id = heapq.heappop(self._pending_events)
+                event = self.events.get(event_id)
+                if event and event['status'] == 'pending' and event_id not in self._claimed:
+                    self._claimed.add(event_id)
+                    return dict(event, status='processing')
+        return None
+
+    def _claim_shared_event(self):
+        # The claim is committed on its own so other processes skip the
+        # event. Claims are not replayed by load(): an event whose process
+        # died before completing it runs again after a restart.
+        self.refresh()
+        if not self._pending_events:
+            return None
+        self._begin_write()
+        try:
+            with self._apply_lock:
+                while self._pending_events:
+                    _, event_id = heapq.heappop(self._pending_events)
+                    event = self.events.get(event_id)
+                    if event and event['status'] == 'pending' and event_id not in self._claimed:
+                        self.record('claim_event', event_id=event_id)
+                        return dict(event, status='processing')
+        finally:
+            self.commit()
+        return None
+
+    def complete_event(self, event_id, status, processed_at, error=None):
+        self.record('complete_event', event_id=event_id, status=status,
+                    processed_at=processed_at, error=error)
+
+    def get_event(self, event_id):
+        event = self.events.get(event_id)
+        if event and event['status'] == 'pending' and event_id in self._claimed:
+            return dict(event, status='processing')
+        return event
+
+    def event_stats(self):
+        oldest = None
+        depth = 0
+        for event in self.events.values():
+            if event['status'] == 'pending':
+                depth += 1
+                if oldest is None or event['created_at'] < oldest:
+                    oldest = event['created_at']
+        return {'depth': depth, 'oldest_created_at': oldest}
+
+    # ----- live feed -----
+    # Feed events are 'feed' ops, so they reach the other processes with the
+    # WAL record of the change they report. Each is numbered after that
+    # record's seq, which every process sees the same.
+
+    def publish_feed(self, event):
+        had_ops = bool(self._pending())
+        self.record('feed', event=event)
+        if not had_ops:
+            self.commit()
+
+    def feed_since(self, cursor):
+        self.refresh()
+        with self._apply_lock:
+            if cursor is None:
+                return [], self._feed[-1]['id'] if self._feed else 0
+            events = [e for e in self._feed if e['id'] > cursor]
+        return events, events[-1]['id'] if events else cursor
+
+    def _collect_feed(self, seq, ops):
+        feed_ops = (rec for rec in ops if rec['op'] == 'feed')
+        for i, rec in enumerate(feed_ops):
+            self._feed.append(dict(rec['event'], id=seq * FEED_IDS_PER_RECORD + i))
+
+    def _apply_enqueue_event(self, rec, committed=True):
+        event = dict(rec['event'])
+        self.events[event['event_id']] = event
+        self.event_seq = max(self.event_seq, event['seq'])
+        if committed:
+            self._make_claimable(event['event_id'])
+
+    def _make_claimable(self, event_id):
+        # Only once the enqueue is in the WAL: a worker paying an event that
+        # a crash then loses would see it pending again after the reload
+        event = self.events.get(event_id)
+        if event and event['status'] == 'pending':
+            heapq.heappush(self._pending_events, (event['seq'], event_id))
+
+    def _apply_complete_event(self, rec):
+        event = self.events.get(rec['event_id'])
+        if not event:
+            return
+        event.update(status=rec['status'], processed_at=rec['processed_at'], error=rec['error'])
+        self._claimed.discard(rec['event_id'])
+        self.events.move_to_end(rec['event_id'])
+        # Forget the oldest finished events; pending ones are never dropped
+        while len(self.events) > EVENT_HISTORY:
+            oldest_id, oldest = next(iter(self.events.items()))
+            if oldest['status'] == 'pending':
+                break
+            del self.events[oldest_id]
+
+    # ----- journal -----
+
+    def _apply_income(self, rec):
+        if self.ledger.add(rec['user_id'], rec['entry']):
+            self._ledger_tail.append({'user_id': rec['user_id'], 'entry': rec['entry']})
+
+    def _apply(self, rec, committed=True):
+        op = rec['op']
+        if op == 'income':
+            self._apply_income(rec)
+        elif op == 'enqueue_event':
+            self._apply_enqueue_event(rec, committed)
+        elif op == 'complete_event':
+            self._apply_complete_event(rec)
+        elif op == 'claim_event':
+            if self.shared:
+                self._claimed.add(rec['event_id'])
+        elif op == 'feed':
+            # Collected once committed; old ones replayed by load() are stale
+            pass
+        elif op == 'create_user':
+            apply_op(self.db, rec)
+            # Index the stored record, whose ids are the interned ones
+            user = self.db[rec['user']['user_id']]
+            if self._index is not None:
+                self._index.add(user)
+            if self._ancestry is not None:
+                self._ancestry.add(user)
+            if self._search_index is not None:
+                self._search_index.add(user)
+            if self._stats is not None:
+                add_stats(self._stats, user_stats(user))
+        elif op == 'create_users':
+            apply_op(self.db, rec)
+            for u in rec['users']:
+                user = self.db[u['user_id']]
+                if self._index is not None:
+                    self._index.add(user)
+                if self._ancestry is not None:
+                    self._ancestry.add(user)
+                if self._search_index is not None:
+                    self._search_index.add(user)
+                if self._stats is not None:
+                    add_stats(self._stats, user_stats(user))
+        elif op in ('mark_matching_dirty', 'clear_matching_dirty'):
+            apply_op(self.db, rec)
+            if self._matching_dirty is not None:
+                if op == 'mark_matching_dirty':
+                    self._matching_dirty.update(uid for uid in rec['seqs'] if uid in self.db)
+                elif 'matching_dirty_seq' not in self.db.get(rec['user_id'], ()):
+                    self._matching_dirty.discard(rec['user_id'])
+        elif self._stats is None:
+            apply_op(self.db, rec)
+        else:
+            # Other ops change stat fields of rec['user_id'] only
+            before = user_stats(self.db.get(rec['user_id']))
+            apply_op(self.db, rec)
+            add_stats(self._stats, stats_delta(before, user_stats(self.db.get(rec['user_id']))))
+
+    def record(self, op, **fields):
+        """Apply a mutation to the in-memory database and buffer it for the next commit"""
+        rec = {'op': op, **fields}
+        self._begin_write()
+        with self._apply_lock:
+            self._apply(rec, committed=False)
+            pending = self._pending()
+            if not pending:
+                self._inflight += 1
+            pending.append(rec)
+
+    def commit(self):
+        """Append buffered mutations to the WAL as one fsync'd record"""
+        ops = self._pending()
+        if ops:
+            self._local.ops = []
+            with self._lock:
+                self.seq += 1
+                self._wal.write(json.dumps({'seq': self.seq, 'ops': ops}, default=str) + '\n')
+                self._wal.flush()
+                os.fsync(self._wal.fileno())
+                self.commits_since_snapshot += 1
+                with self._apply_lock:
+                    if self.shared:
+                        # Our own record, nothing for refresh() to apply
+                        self._tail_offset = os.fstat(self._wal.fileno()).st_size
+                    for rec in ops:
+                        if rec['op'] == 'enqueue_event':
+                            self._make_claimable(rec['event']['event_id'])
+                    self._collect_feed(self.seq, ops)
+                    self._inflight -= 1
+                    if not self.shared and (self.commits_since_snapshot >= self.snapshot_every
+                                            or self._snapshot_due):
+                        self._write_snapshot()
+        self._end_write()
+
+    def snapshot(self):
+        """Write a compacted snapshot and truncate the WAL"""
+        self.commit()
+        self._begin_write()
+        try:
+            with self._lock:
+                with self._apply_lock:
+                    self._snapshot_due = True
+                    self._write_snapshot()
+        finally:
+            self._end_write()
+
+    def _write_snapshot(self):
+        # Ops applied in memory but not yet committed by another thread would
+        # end up both in the snapshot and in a later WAL record, so wait for
+        # the last one in flight to commit.
+        if self._inflight:
+            self._snapshot_due = True
+            return
+        if self._ledger_tail:
+            # Entries still in the WAL on a crash after this are skipped on
+            # replay by their entry_id
+            with open(self.ledger_file, 'a') as f:
+                for row in self._ledger_tail:
+                    f.write(json.dumps(row, default=str) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._ledger_tail = []
+        path = self._snapshot_path(self.snapshot_encoding)
+        write_snapshot(path, self.seq, self.event_seq, self.events.values(), self.db, self.snapshot_encoding)
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        # Records up to self.seq are in the snapshot; replay skips them even
+        # if we crash before the truncate below.
+        if not self.shared:
+            self._wal.close()
+            self._wal = open(self.wal_file, 'w')
+        self.commits_since_snapshot = 0
+        self._snapshot_due = False
+        log.info('snapshot written', extra={'file': path, 'seq': self.seq})
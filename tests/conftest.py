@@ -0,0 +1,32 @@
+import os
+import sys
+
+import mongomock
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import JsonStore  # noqa: E402
+from mongo_store import MongoStore  # noqa: E402
+
+# ===== FIXTURES =====
+# `store` runs a test once per backend: a JsonStore in a temporary
+# directory and a MongoStore on mongomock.
+
+
+def make_store(backend, path):
+    if backend == 'json':
+        return JsonStore(str(path / 'users.json'))
+    return MongoStore('mongomock://', 'mlm_test', client=mongomock.MongoClient())
+
+
+@pytest.fixture(params=['json', 'mongo'])
+def backend(request):
+    return request.param
+
+
+@pytest.fixture
+def store(backend, tmp_path):
+    store = make_store(backend, tmp_path)
+    store.load()
+    return store
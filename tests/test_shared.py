@@ -0,0 +1,26 @@
+import json
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# ===== SHARED DATABASE =====
+# A small `python -m bench shared`: two workers forked on a shared JSON
+# database race signups and activations, then must hold the same network
+# as their parent (and each other) and pass the stress checks.
+
+
+def test_forked_workers_agree(tmp_path):
+    env = dict(os.environ, PASSWORD_HASH_METHOD='pbkdf2:sha256:1000', LOG_LEVEL='WARNING', PYTHONPATH=REPO_DIR)
+    run = subprocess.run(
+        [sys.executable, '-m', 'bench', 'shared', '--users', '150', '--procs', '2', '--threads', '2',
+         '--sponsors', '3', '--signups', '5', '--activations', '10', '--ops', '5', '--out', 'shared_report.json'],
+        cwd=tmp_path, env=env, capture_output=True, text=True, timeout=300)
+    assert os.path.exists(tmp_path / 'shared_report.json'), run.stderr
+    result = json.loads((tmp_path / 'shared_report.json').read_text())
+    assert result['violations'] == []
+    assert len(result['workers']) == 2
+    assert result['signup']['failures'] == [] and result['activate']['failures'] == []
+    assert result['signup']['created'] > 0 and result['activate']['activated'] == 10
+    assert run.returncode == 0, run.stdout + run.stderr
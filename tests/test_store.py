@@ -0,0 +1,227 @@
+import threading
+
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+from bench.generator import ADMIN_ID, generate, make_user, write_store
+from storage import ANCESTRY_LEVELS, DuplicateUserError, JsonStore, joining_key
+from conftest import make_store
+
+# ===== STORE CONTRACT =====
+# The same tests run against every backend (see conftest.store); a few at
+# the end cover what only one of them does.
+
+NOW = '2025-01-01T00:00:00'
+
+
+def upline(db, user_id):
+    ids = []
+    while db[user_id].get('sponsor_id'):
+        user_id = db[user_id]['sponsor_id']
+        ids.append(user_id)
+    return ids
+
+
+def levels_below(db, leader_id, level):
+    """What get_downline_ids should return, straight from the sponsor links"""
+    ids = [leader_id]
+    for _ in range(level):
+        ids = [d for uid in ids for d in db[uid]['direct_referrals']]
+    return sorted(ids, key=lambda uid: joining_key(db[uid]))
+
+
+def deepest(db):
+    return max(db, key=lambda uid: len(upline(db, uid)))
+
+
+def event(i, seq):
+    return {'event_id': f'e{i}', 'seq': seq, 'type': 'activation', 'user_id': f'bench-{i}', 'cost': 100,
+            'status': 'pending', 'created_at': NOW, 'processed_at': None, 'error': None}
+
+
+def test_lookups(store):
+    write_store(generate(5), store)
+    assert store.find_by_username('BENCH3')['user_id'] == 'bench-3'
+    assert store.find_by_email('Bench3@Example.com')['user_id'] == 'bench-3'
+    assert store.find_by_referral_code('B00000003')['user_id'] == 'bench-3'
+    assert store.count_users() == 6
+
+
+@pytest.mark.parametrize('field, value', [
+    ('username', 'BENCH1'), ('email', 'bench1@example.com'), ('referral_code', 'B00000001')
+])
+def test_duplicates_name_their_field(store, field, value):
+    write_store(generate(3), store)
+    user = make_user(99, ADMIN_ID, NOW, False)
+    user[field] = value
+    with pytest.raises(DuplicateUserError) as e:
+        store.insert_user(user)
+    store.commit()
+    assert e.value.field == field
+    assert store.get_user('bench-99') is None
+    assert 'bench-99' not in store.get_user(ADMIN_ID)['direct_referrals']
+
+
+@pytest.mark.parametrize('shape', ['wide', 'deep'])
+def test_team_counters_follow_inserts(store, shape):
+    db = generate(150, shape=shape)
+    write_store(db, store)
+    for uid, user in db.items():
+        stored = store.get_user(uid)
+        assert (stored['team_size'], stored['active_team_size']) == (user['team_size'], user['active_team_size'])
+    assert store.recompute_team_counts() == []
+
+
+def test_upline_and_downline_past_the_stored_ancestry(store):
+    db = generate(200, shape='deep')
+    write_store(db, store)
+    member_id = deepest(db)
+    chain = upline(db, member_id)
+    assert len(chain) > ANCESTRY_LEVELS
+    assert [u['user_id'] for u in store.get_upline(member_id)] == chain
+    assert [u['user_id'] for u in store.get_upline(member_id, limit=5)] == chain[:5]
+    for level in (1, 2, ANCESTRY_LEVELS, ANCESTRY_LEVELS + 3):
+        assert store.get_downline_ids(ADMIN_ID, level) == levels_below(db, ADMIN_ID, level)
+    assert set(store.get_subtree(chain[-3])) == {chain[-3]} | {
+        uid for uid in db if chain[-3] in upline(db, uid)
+    }
+    for uid in db:
+        assert store.is_in_team(member_id, uid) == (uid in chain or uid == member_id)
+    assert not store.is_in_team(ADMIN_ID, member_id)
+
+
+def test_levels_are_in_joining_order(store):
+    db = generate(120)
+    write_store(db, store)
+    for level in (1, 2, 3):
+        assert store.get_downline_ids(ADMIN_ID, level) == levels_below(db, ADMIN_ID, level)
+
+
+def test_team_search(store):
+    db = generate(120, shape='deep')
+    write_store(db, store)
+    found = store.search_team(ADMIN_ID, 'bench1', {})
+    assert {doc['user_id'] for doc, _ in found} == {uid for uid in db if db[uid]['username'].startswith('bench1')}
+    assert all(level == len(upline(db, doc['user_id'])) for doc, level in found)
+    near = store.search_team(ADMIN_ID, 'bench1', {'max_level': 3})
+    assert {doc['user_id'] for doc, _ in near} == {doc['user_id'] for doc, level in found if level <= 3}
+
+
+def test_activation_moves_active_counts_up_the_line(store):
+    db = generate(30, active_ratio=0)
+    write_store(db, store)
+    member_id = deepest(db)
+    chain = upline(db, member_id)
+    before = {uid: store.get_user(uid)['active_team_size'] for uid in chain}
+    assert not store.activate(member_id, NOW, 100, seq=1, expect={'version': 99})
+    assert store.activate(member_id, NOW, 100, seq=1)
+    store.commit()
+    assert store.get_user(member_id)['activation_status'] == 'active'
+    assert {uid: store.get_user(uid)['active_team_size'] for uid in chain} == {
+        uid: size + 1 for uid, size in before.items()
+    }
+
+
+def test_payout_pays_an_entry_once(store):
+    write_store(generate(3), store)
+    entry = {'entry_id': 'e1:L1', 'type': 'level_income', 'amount': 10.0, 'date': NOW}
+    assert store.payout('bench-0', 'activation_wallet', 10.0, dict(entry))
+    store.commit()
+    assert not store.payout('bench-0', 'activation_wallet', 10.0, dict(entry))
+    assert not store.payout('bench-1', 'activation_wallet', 10.0, dict(entry, entry_id='e1:L2'),
+                            expect={'version': 99})
+    store.commit()
+    assert store.get_user('bench-0')['activation_wallet'] == 10.0
+    assert store.get_user('bench-0')['total_income'] == 10.0
+    assert store.get_user('bench-1')['activation_wallet'] == 0
+    assert [e['entry_id'] for e in store.query_income('bench-0', {})] == ['e1:L1']
+
+
+def test_events_are_claimed_once_in_order(store):
+    for i in range(3):
+        store.enqueue_event(event(i, store.next_event_seq()))
+        store.commit()
+    assert [store.claim_event()['event_id'] for _ in range(3)] == ['e0', 'e1', 'e2']
+    assert store.claim_event() is None
+    store.complete_event('e0', 'done', NOW)
+    store.commit()
+    assert store.get_event('e0')['status'] == 'done'
+    assert store.get_event('e1')['status'] == 'processing'
+    assert store.event_stats()['depth'] == 2
+
+
+def test_feed_reaches_every_follower(backend, tmp_path):
+    store = make_store(backend, tmp_path)
+    store.load()
+    write_store(generate(3), store)
+    assert store.feed_since(None) == ([], 0)
+    store.publish_feed({'channels': ['bench-1'], 'type': 'income', 'data': {'amount': 10.0}})
+    store.activate('bench-2', NOW, 100, seq=1)
+    store.publish_feed({'channels': ['bench-2'], 'type': 'activated', 'data': {}})
+    store.commit()
+    events, cursor = store.feed_since(0)
+    assert [(e['channels'], e['type']) for e in events] == [(['bench-1'], 'income'), (['bench-2'], 'activated')]
+    assert events[0]['id'] < events[1]['id'] == cursor
+    assert store.feed_since(cursor) == ([], cursor)
+    assert store.feed_since(None) == ([], cursor)
+
+
+# ----- JsonStore -----
+
+def test_json_levels_survive_a_reload(tmp_path):
+    db = generate(120)
+    store = make_store('json', tmp_path)
+    store.load()
+    write_store(db, store)
+    store.snapshot()
+    reloaded = make_store('json', tmp_path)
+    reloaded.load()
+    for level in (1, 2, 3):
+        assert reloaded.get_downline_ids(ADMIN_ID, level) == levels_below(db, ADMIN_ID, level)
+
+
+def test_json_event_is_claimable_once_committed(tmp_path):
+    store = JsonStore(str(tmp_path / 'users.json'))
+    store.load()
+    store.enqueue_event(event(0, store.next_event_seq()))
+    claimed = []
+    worker = threading.Thread(target=lambda: claimed.append(store.claim_event()))
+    worker.start()
+    worker.join()
+    assert claimed == [None]
+    store.commit()
+    assert store.claim_event()['event_id'] == 'e0'
+
+
+def test_json_feed_event_rides_in_the_commit(tmp_path):
+    store = make_store('json', tmp_path)
+    store.load()
+    write_store(generate(3), store)
+    store.activate('bench-2', NOW, 100, seq=1)
+    store.publish_feed({'channels': ['bench-2'], 'type': 'activated', 'data': {}})
+    assert store.feed_since(0) == ([], 0)
+    store.commit()
+    assert [e['type'] for e in store.feed_since(0)[0]] == ['activated']
+
+
+# ----- MongoStore -----
+
+def test_mongo_ancestry_is_capped(tmp_path):
+    db = generate(200, shape='deep')
+    store = make_store('mongo', tmp_path)
+    store.load()
+    write_store(db, store)
+    assert max(len(doc['ancestors']) for doc in store.users.find({}, {'ancestors': 1})) == ANCESTRY_LEVELS
+    # Full paths written by older versions are cut down on load
+    member_id = deepest(db)
+    store.users.update_one({'_id': member_id}, {'$set': {'ancestors': upline(db, member_id)}})
+    store.load()
+    assert len(store.users.find_one({'_id': member_id})['ancestors']) == ANCESTRY_LEVELS
+    assert [u['user_id'] for u in store.get_upline(member_id)] == upline(db, member_id)
+
+
+def test_mongo_names_the_index_of_a_duplicate(tmp_path):
+    store = make_store('mongo', tmp_path)
+    error = DuplicateKeyError('E11000 duplicate key error collection: mlm_test.users index: referral_code_1 '
+                              'dup key: { referral_code: "B00000001" }', 11000)
+    assert store._duplicate_field(error, {}) == 'referral_code'
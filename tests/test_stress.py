@@ -0,0 +1,29 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# ===== STRESS =====
+# A small `python -m bench stress`: a few threads racing signups and
+# activations on a few hundred users, with cheap password hashing. The app
+# reads its settings at import, so every mode runs in its own process.
+
+
+@pytest.mark.parametrize('mode', ['lock', 'optimistic'])
+def test_racing_threads_leave_no_violations(mode, tmp_path):
+    env = dict(os.environ, CONCURRENCY_MODE=mode, PASSWORD_HASH_METHOD='pbkdf2:sha256:1000',
+               LOG_LEVEL='WARNING', PYTHONPATH=REPO_DIR)
+    run = subprocess.run(
+        [sys.executable, '-m', 'bench', 'stress', '--users', '150', '--threads', '4', '--sponsors', '3',
+         '--signups', '5', '--activations', '15', '--out', 'stress_report.json'],
+        cwd=tmp_path, env=env, capture_output=True, text=True, timeout=300)
+    assert os.path.exists(tmp_path / 'stress_report.json'), run.stderr
+    result = json.loads((tmp_path / 'stress_report.json').read_text())
+    assert result['concurrency_mode'] == mode
+    assert result['signup']['failures'] == [] and result['activate']['failures'] == []
+    assert result['violations'] == []
+    assert run.returncode == 0, run.stdout + run.stderr